@@ -0,0 +1,52 @@
+"""
+Micro-benchmark of the AWS client creation overhead.
+
+Compares building a new boto3 client on every call, which is what `iblaws.utils.get_service_client` used to do,
+with the shared client registry. No network call is made.
+
+    python benchmarks/bench_client_factory.py --calls 200 --threads 8
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+import iblaws.utils
+
+
+def per_call_client(service_name='ec2', region_name='eu-west-2'):
+    return boto3.client(
+        service_name=service_name,
+        aws_access_key_id=os.getenv('AWS_ACCESS_KEY'),
+        aws_secret_access_key=os.getenv('AWS_SECRET_KEY'),
+        region_name=region_name,
+    )
+
+
+def shared_client(service_name='ec2', region_name='eu-west-2'):
+    return iblaws.utils.get_service_client(service_name=service_name, region_name=region_name)
+
+
+def run(factory, calls, threads):
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(lambda i: factory(service_name='ec2' if i % 2 else 'ssm'), range(calls)))
+    return time.perf_counter() - t0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='AWS client creation micro-benchmark')
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+    os.environ.setdefault('AWS_ACCESS_KEY', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_KEY', 'benchmark')
+    # boto3.client uses the default session which is not thread-safe, the per-call version is run sequentially
+    per_call = run(per_call_client, args.calls, threads=1)
+    shared = run(shared_client, args.calls, threads=args.threads)
+    print(f'per-call clients: {args.calls} calls in {per_call:.3f} s, {per_call / args.calls * 1e3:.3f} ms per call')
+    print(f'shared clients:   {args.calls} calls in {shared:.3f} s, {shared / args.calls * 1e3:.3f} ms per call')
+    print(f'speedup: x{per_call / shared:.0f}')
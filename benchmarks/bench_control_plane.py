@@ -0,0 +1,166 @@
+"""
+Offline benchmark suite of the control-plane code paths against stubbed AWS clients.
+
+Each scenario runs a code path of iblaws many times, concurrently where it is in production, against the in-memory
+clients of `stubs.py` with an injected latency per API call, and reports the throughput, the p50 / p99 latency of
+one operation and the number of API calls per operation:
+
+- start: `InstanceManager.start_and_prepare_instance` end-to-end, SSH faked, one thread per instance
+- prefix-list: add and remove of an entry by N concurrent workers, with injected version conflicts
+- security-group: update of the rule of each instance, one call per rule against one batched reconciliation
+- ssm: detection of the completion of N commands, one `get_command_invocation` per command against the
+  `CommandTracker`, the latency being the delay between the completion of a command and its detection
+
+    PYTHONPATH=src python benchmarks/bench_control_plane.py --latency 0.02 --workers 16
+    PYTHONPATH=src python benchmarks/bench_control_plane.py prefix-list --conflict-rate 0.2
+"""
+
+import argparse
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import iblaws.commands
+import iblaws.compute
+import iblaws.metrics
+import iblaws.prefix_lists
+import iblaws.utils
+from stubs import FakeSSHSession, StubEC2, StubSSM
+
+
+def percentile(values, q):
+    """Nearest-rank percentile, q in [0, 100]."""
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def report(name, latencies, elapsed, calls):
+    n = len(latencies)
+    api_calls = sum(calls.values())
+    print(
+        f'{name:>28}: {n / elapsed:8.1f} ops/s | p50 {percentile(latencies, 50) * 1e3:8.1f} ms | '
+        f'p99 {percentile(latencies, 99) * 1e3:8.1f} ms | {api_calls / n:5.1f} API calls/op'
+    )
+
+
+def timed(func, *args):
+    t0 = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - t0
+
+
+def run_concurrently(func, items, workers):
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        latencies = list(executor.map(lambda item: timed(func, item), items))
+    return latencies, time.perf_counter() - t0
+
+
+def bench_start(args):
+    ec2 = StubEC2(n_instances=args.workers, latency=args.latency, boot_time=args.boot_time, waiter_delay=args.boot_time / 10)
+    iblaws.metrics.reset()
+    iblaws.metrics.enable()
+    with (
+        mock.patch('iblaws.utils.get_service_client', return_value=ec2),
+        mock.patch('iblaws.ssh.get_ssh_session', side_effect=lambda ip, *a, **k: FakeSSHSession(ip, latency=args.ssh_latency)),
+    ):
+        instances = [iblaws.compute.InstanceManager(instance_id, 'us-east-1') for instance_id in ec2.instances]
+        latencies, elapsed = run_concurrently(lambda im: im.start_and_prepare_instance(), instances, args.workers)
+    iblaws.metrics.disable()
+    report('start_and_prepare_instance', latencies, elapsed, ec2.calls)
+    for name, span in iblaws.metrics.snapshot()['spans'].items():
+        if name.startswith('start_and_prepare_instance.'):
+            print(f'{"":>28}  {name.split(".")[-1]:>22}: mean {span["sum"] / span["count"] * 1e3:8.1f} ms')
+
+
+def bench_prefix_list(args):
+    ec2 = StubEC2(latency=args.latency, settle=args.settle, conflict_rate=args.conflict_rate)
+    writer = iblaws.prefix_lists.PrefixListWriter(ec2, ec2.prefix_list_id, poll_interval=args.settle / 4, backoff=args.settle / 2)
+
+    def register(i):
+        description, cidr = f'Lightning AI Worker #{i:02}', f'10.0.{i // 256}.{i % 256}/32'
+        writer.add(description, cidr)
+        writer.remove(description)
+
+    latencies, elapsed = run_concurrently(register, range(args.workers * args.repeat), args.workers)
+    report(f'prefix list add+remove x{args.workers}', latencies, elapsed, ec2.calls)
+
+
+def bench_security_group(args):
+    rules = {f'i-{i:04d}': f'10.2.{i // 256}.{i % 256}/32' for i in range(args.workers)}
+    ec2 = StubEC2(latency=args.latency)
+    latencies, elapsed = run_concurrently(
+        lambda item: iblaws.utils.ec2_update_security_group_rule(ec2, 'sg-stub', *item), rules.items(), 1
+    )
+    report('security group, per rule', latencies, elapsed, ec2.calls)
+    ec2 = StubEC2(latency=args.latency)
+    elapsed = timed(iblaws.utils.ec2_reconcile_security_group_rules, ec2, 'sg-stub', rules)
+    # one operation registers all the rules, reported per rule to compare with the above
+    report('security group, reconciled', [elapsed] * len(rules), elapsed, ec2.calls)
+
+
+def bench_ssm(args):
+    def duration():
+        return random.uniform(0.5, 1.5) * args.command_duration
+
+    # baseline: one thread per command polling get_command_invocation at a fixed interval
+    ssm = StubSSM(latency=args.latency, duration=duration)
+    commands = [(ssm.send_command(InstanceIds=[f'i-{i:04d}'])['Command']['CommandId'], f'i-{i:04d}') for i in range(args.workers)]
+    ssm.calls.clear()
+
+    def poll(command):
+        while ssm.get_command_invocation(CommandId=command[0], InstanceId=command[1])['Status'] == 'InProgress':
+            time.sleep(args.poll_interval)
+        return time.monotonic() - ssm.commands[command][1]
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        lags = list(executor.map(poll, commands))
+    report('ssm, polling per command', lags, time.perf_counter() - t0, ssm.calls)
+
+    ssm = StubSSM(latency=args.latency, duration=duration)
+    tracker = iblaws.commands.CommandTracker(ssm, min_interval=args.poll_interval, max_interval=args.command_duration)
+    lags, lock = [], threading.Lock()
+
+    def on_completion(invocation):
+        with lock:
+            lags.append(time.monotonic() - ssm.commands[(invocation['CommandId'], invocation['InstanceId'])][1])
+
+    for i in range(args.workers):
+        command_id = ssm.send_command(InstanceIds=[f'i-{i:04d}'])['Command']['CommandId']
+        tracker.track(command_id, f'i-{i:04d}', expected_duration=args.command_duration, callback=on_completion)
+    ssm.calls.clear()
+    t0 = time.perf_counter()
+    tracker.wait()
+    report('ssm, CommandTracker', lags, time.perf_counter() - t0, ssm.calls)
+
+
+SCENARIOS = {
+    'start': bench_start,
+    'prefix-list': bench_prefix_list,
+    'security-group': bench_security_group,
+    'ssm': bench_ssm,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmark suite of the iblaws control plane')
+    parser.add_argument('scenarios', nargs='*', help=f'scenarios to run among {", ".join(SCENARIOS)}, all by default')
+    parser.add_argument('--workers', type=int, default=16, help='concurrent workers, instances or commands')
+    parser.add_argument('--repeat', type=int, default=2, help='operations per worker for the prefix list')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per API call')
+    parser.add_argument('--conflict-rate', type=float, default=0.1, help='rate of injected prefix list version conflicts')
+    parser.add_argument('--settle', type=float, default=0.1, help='seconds a prefix list modification stays in progress')
+    parser.add_argument('--boot-time', type=float, default=0.5, help='seconds for an instance to reach running')
+    parser.add_argument('--ssh-latency', type=float, default=0.1, help='seconds to prepare the volume over SSH')
+    parser.add_argument('--command-duration', type=float, default=1.0, help='mean run time of an SSM command in seconds')
+    parser.add_argument('--poll-interval', type=float, default=0.05, help='shortest delay between two polls of a command')
+    args = parser.parse_args()
+    if unknown := set(args.scenarios) - set(SCENARIOS):
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+    random.seed(0)
+    for scenario in args.scenarios or SCENARIOS:
+        SCENARIOS[scenario](args)
@@ -0,0 +1,41 @@
+"""
+Cold-start benchmark of the iblaws and ibllightning imports.
+
+Each module is imported in a fresh interpreter several times, the median import time is reported along with the
+heavy dependencies that the import pulled in.
+
+    PYTHONPATH=src python benchmarks/bench_import_time.py --repeat 10
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+HEAVY_MODULES = ('boto3', 'botocore', 'paramiko', 'pydantic', 'dotenv', 'requests', 'one', 'ibllib')
+MODULES = ('iblaws.compute', 'iblaws.utils', 'iblaws.prefix_lists', 'iblaws.ssh', 'ibllightning')
+
+SCRIPT = """
+import json, sys, time
+t0 = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - t0
+print(json.dumps({{'elapsed': elapsed, 'loaded': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def import_time(module):
+    script = SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+    return json.loads(subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import time benchmark')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    args = parser.parse_args()
+    for module in args.modules:
+        results = [import_time(module) for _ in range(args.repeat)]
+        elapsed = statistics.median(r['elapsed'] for r in results)
+        print(f'{module:>20}: {elapsed * 1e3:7.1f} ms, heavy modules loaded: {", ".join(results[0]["loaded"]) or "none"}')
@@ -0,0 +1,68 @@
+"""
+Throughput benchmark of concurrent prefix-list registrations against a stubbed EC2 client.
+
+Each worker thread registers its own entry and then removes it, as `manage_firewall_access` does around a task.
+The baseline calls the one-entry helpers of `iblaws.utils` and retries on version conflicts, the other run goes
+through the shared `PrefixListWriter`.
+
+    python benchmarks/bench_prefix_list_writer.py --workers 30 --latency 0.02 --settle 0.2
+"""
+
+import argparse
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import botocore.exceptions
+
+import iblaws.utils
+from iblaws.prefix_lists import PrefixListWriter
+from stubs import StubPrefixListEC2
+
+
+def with_retries(func, *args, **kwargs):
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except botocore.exceptions.ClientError:
+            time.sleep(random.uniform(0.05, 0.25))
+
+
+def helpers_worker(ec2, i):
+    description, cidr = f'Lightning AI Worker #{i:02}', f'10.0.{i // 256}.{i % 256}/32'
+    with_retries(iblaws.utils.ec2_add_managed_prefix_list_item, ec2, ec2.prefix_list_id, description, cidr)
+    with_retries(iblaws.utils.ec2_remove_managed_prefix_list_item, ec2, ec2.prefix_list_id, description)
+
+
+def writer_worker(writer, i):
+    description, cidr = f'Lightning AI Worker #{i:02}', f'10.0.{i // 256}.{i % 256}/32'
+    writer.add(description, cidr)
+    writer.remove(description)
+
+
+def run(worker, target, n_workers):
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        list(executor.map(lambda i: worker(target, i), range(n_workers)))
+    return time.perf_counter() - t0
+
+
+def report(name, elapsed, ec2, n_workers):
+    calls = ', '.join(f'{k}: {v}' for k, v in sorted(ec2.calls.items()))
+    print(
+        f'{name:>8}: {2 * n_workers / elapsed:6.1f} registrations/s, {elapsed:.2f} s, {ec2.version - 1} list versions | {calls}'
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prefix list writer throughput benchmark')
+    parser.add_argument('--workers', type=int, default=30)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per API call')
+    parser.add_argument('--settle', type=float, default=0.2, help='seconds a modification stays in progress')
+    args = parser.parse_args()
+
+    ec2 = StubPrefixListEC2(latency=args.latency, settle=args.settle)
+    report('helpers', run(helpers_worker, ec2, args.workers), ec2, args.workers)
+    ec2 = StubPrefixListEC2(latency=args.latency, settle=args.settle)
+    writer = PrefixListWriter(ec2, ec2.prefix_list_id, poll_interval=args.settle / 4, backoff=args.settle / 2)
+    report('writer', run(writer_worker, writer, args.workers), ec2, args.workers)
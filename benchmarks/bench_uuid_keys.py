@@ -0,0 +1,56 @@
+"""
+Benchmark of the removal of the dataset UUIDs from the attribute names of the objects loaded by `OneLightningAI`.
+
+On the S3 mount the files carry the UUID of their dataset, which `alfio.load_object` keeps in the attribute names,
+e.g. 'times.<uuid>'. The objects are built with many attributes of large arrays and their keys renamed by:
+
+- split: the former per-key split on dots and UUID test of each part, repeated for each load
+- strip_uuid_keys: one regular expression per key, memoized per dataset, the arrays not copied
+
+    PYTHONPATH=src python benchmarks/bench_uuid_keys.py --attributes 200 --loads 100
+"""
+
+import argparse
+import time
+import uuid
+from itertools import filterfalse
+
+import numpy as np
+from one.alf.io import AlfBunch
+from one.alf.spec import is_uuid_string
+
+from ibllightning.one import strip_uuid, strip_uuid_keys
+
+
+def split(obj):
+    for k in list(obj.keys()):
+        obj['.'.join(filterfalse(is_uuid_string, k.split('.')))] = obj.pop(k)
+    return obj
+
+
+def make_object(n_attributes, size):
+    array = np.zeros(size)
+    return AlfBunch({f'attr{i}_clock.{uuid.uuid4()}': array[i:] for i in range(n_attributes)})
+
+
+def bench(name, func, objects):
+    t0 = time.perf_counter()
+    for obj in objects:
+        values = list(obj.values())
+        func(obj)
+        assert all(a is b for a, b in zip(values, obj.values()))
+    elapsed = time.perf_counter() - t0
+    print(f'{name:>16}: {elapsed / len(objects) * 1e6:8.1f} us per object')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the UUID stripping of attribute names')
+    parser.add_argument('--attributes', type=int, default=200, help='attributes per object')
+    parser.add_argument('--size', type=int, default=1_000_000, help='elements of the arrays')
+    parser.add_argument('--loads', type=int, default=100, help='loads of the same object')
+    args = parser.parse_args()
+    template = make_object(args.attributes, args.size)
+    bench('split', split, [AlfBunch(template) for _ in range(args.loads)])
+    strip_uuid.cache_clear()
+    bench('strip_uuid_keys', strip_uuid_keys, [AlfBunch(template) for _ in range(args.loads)])
+    print(f'{"":>16}  {strip_uuid.cache_info()}')
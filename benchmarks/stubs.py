@@ -0,0 +1,317 @@
+"""
+In-memory stand-ins for the AWS clients used by the benchmarks.
+
+The stubs implement just enough of the boto3 client API for the iblaws code paths, with configurable latency
+per call so that concurrency effects show up in the timings, and an optional rate of injected version conflicts
+on the prefix list.
+"""
+
+import datetime
+import itertools
+import random
+import threading
+import time
+from collections import Counter
+
+import botocore.exceptions
+
+
+def client_error(code: str, operation_name: str, message: str = '') -> botocore.exceptions.ClientError:
+    return botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': message or code}}, operation_name)
+
+
+class StubPrefixListEC2:
+    """
+    EC2 client holding a single managed prefix list.
+
+    A modification moves the list to `modify-in-progress` for `settle` seconds, during which any other
+    modification fails with `IncorrectState`, and a modification against a stale version fails with
+    `PrefixListVersionMismatch`, as on AWS.
+
+    Parameters
+    ----------
+    prefix_list_id : str
+        The ID of the simulated prefix list.
+    latency : float
+        Seconds spent in every API call.
+    settle : float
+        Seconds for which the list stays in `modify-in-progress` after a successful modification.
+    max_entries : int
+        Maximum number of entries of the list.
+    page_size : int
+        Number of entries per page of `get_managed_prefix_list_entries`.
+    conflict_rate : float
+        Probability that a modification fails with `PrefixListVersionMismatch`, as if another process had modified
+        the list first.
+    """
+
+    def __init__(self, prefix_list_id='pl-stub', latency=0.01, settle=0.05, max_entries=1000, page_size=100, conflict_rate=0.0):
+        self.prefix_list_id = prefix_list_id
+        self.latency = latency
+        self.settle = settle
+        self.max_entries = max_entries
+        self.page_size = page_size
+        self.conflict_rate = conflict_rate
+        self.version = 1
+        self.entries = {}  # cidr -> description
+        self.calls = Counter()
+        self._history = {1: {}}
+        self._modified_at = -float('inf')
+        self._lock = threading.Lock()
+
+    def _call(self, operation_name):
+        with self._lock:
+            self.calls[operation_name] += 1
+        time.sleep(self.latency)
+
+    def _state(self):
+        return 'modify-in-progress' if time.monotonic() - self._modified_at < self.settle else 'modify-complete'
+
+    def describe_managed_prefix_lists(self, PrefixListIds=None, **kwargs):
+        self._call('DescribeManagedPrefixLists')
+        with self._lock:
+            return {
+                'PrefixLists': [
+                    {
+                        'PrefixListId': self.prefix_list_id,
+                        'Version': self.version,
+                        'State': self._state(),
+                        'MaxEntries': self.max_entries,
+                    }
+                ]
+            }
+
+    def get_managed_prefix_list_entries(self, PrefixListId, TargetVersion=None, NextToken=None, MaxResults=None, **kwargs):
+        self._call('GetManagedPrefixListEntries')
+        with self._lock:
+            entries = self._history[TargetVersion or self.version]
+        entries = [{'Cidr': cidr, 'Description': d} for cidr, d in entries.items()]
+        start = int(NextToken or 0)
+        response = {'Entries': entries[start : start + self.page_size]}
+        if start + self.page_size < len(entries):
+            response['NextToken'] = str(start + self.page_size)
+        return response
+
+    def modify_managed_prefix_list(self, PrefixListId, CurrentVersion, AddEntries=(), RemoveEntries=(), DryRun=False, **kwargs):
+        self._call('ModifyManagedPrefixList')
+        with self._lock:
+            if self._state() == 'modify-in-progress':
+                raise client_error('IncorrectState', 'ModifyManagedPrefixList')
+            if CurrentVersion != self.version or random.random() < self.conflict_rate:
+                raise client_error('PrefixListVersionMismatch', 'ModifyManagedPrefixList')
+            entries = dict(self.entries)
+            for entry in RemoveEntries:
+                if entry['Cidr'] not in entries:
+                    raise client_error('InvalidPrefixListModification', 'ModifyManagedPrefixList', f'{entry["Cidr"]} not found')
+                entries.pop(entry['Cidr'])
+            for entry in AddEntries:
+                entries[entry['Cidr']] = entry.get('Description', '')
+            if len(entries) > self.max_entries:
+                raise client_error('PrefixListMaxEntriesExceeded', 'ModifyManagedPrefixList')
+            self.entries = entries
+            self.version += 1
+            self._history[self.version] = entries
+            self._modified_at = time.monotonic()
+            return {'PrefixList': {'PrefixListId': self.prefix_list_id, 'Version': self.version, 'State': 'modify-in-progress'}}
+
+
+class _Paginator:
+    def __init__(self, method, result_key, page_size):
+        self.method = method
+        self.result_key = result_key
+        self.page_size = page_size
+
+    def paginate(self, PaginationConfig=None, **kwargs):
+        items = self.method(**kwargs)[self.result_key]
+        page_size = (PaginationConfig or {}).get('PageSize', self.page_size)
+        for start in range(0, max(len(items), 1), page_size):
+            yield {self.result_key: items[start : start + page_size]}
+
+
+class _InstanceRunningWaiter:
+    def __init__(self, ec2, delay):
+        self.ec2 = ec2
+        self.delay = delay
+
+    def wait(self, InstanceIds, **kwargs):
+        while True:
+            states = [
+                i['State']['Name']
+                for r in self.ec2.describe_instances(InstanceIds=InstanceIds)['Reservations']
+                for i in r['Instances']
+            ]
+            if all(state == 'running' for state in states):
+                return
+            time.sleep(self.delay)
+
+
+class StubEC2(StubPrefixListEC2):
+    """
+    EC2 client with instances and a security group on top of the managed prefix list.
+
+    A started instance is `pending` for `boot_time` seconds and then `running` with a public IP. The
+    `instance_running` waiter polls `describe_instances` every `waiter_delay` seconds.
+
+    Parameters
+    ----------
+    n_instances : int
+        Number of stopped instances, with IDs i-0000 to i-NNNN.
+    boot_time : float
+        Seconds between the start of an instance and its `running` state.
+    waiter_delay : float
+        Seconds between two polls of the `instance_running` waiter.
+    **kwargs
+        Options of `StubPrefixListEC2`.
+    """
+
+    def __init__(self, n_instances=0, boot_time=0.1, waiter_delay=0.02, **kwargs):
+        super().__init__(**kwargs)
+        self.boot_time = boot_time
+        self.waiter_delay = waiter_delay
+        self.instances = {f'i-{i:04d}': {'started': None, 'ip': f'10.1.{i // 256}.{i % 256}'} for i in range(n_instances)}
+        self.ip_ranges = {}  # cidr -> description, all in a single permission
+
+    def _instance_state(self, instance):
+        if instance['started'] is None:
+            return 'stopped'
+        return 'running' if time.monotonic() - instance['started'] >= self.boot_time else 'pending'
+
+    def describe_instances(self, InstanceIds=None, Filters=None, **kwargs):
+        self._call('DescribeInstances')
+        instances = []
+        with self._lock:
+            for instance_id in InstanceIds or self.instances:
+                instance = self.instances[instance_id]
+                state = self._instance_state(instance)
+                description = {'InstanceId': instance_id, 'State': {'Name': state}, 'InstanceType': 'g4dn.8xlarge'}
+                if state == 'running':
+                    description['PublicIpAddress'] = instance['ip']
+                instances.append(description)
+        return {'Reservations': [{'Instances': instances}]}
+
+    def get_paginator(self, operation_name):
+        assert operation_name == 'describe_instances'
+        return _Paginator(self.describe_instances, 'Reservations', page_size=1)
+
+    def get_waiter(self, waiter_name):
+        assert waiter_name == 'instance_running'
+        return _InstanceRunningWaiter(self, self.waiter_delay)
+
+    def start_instances(self, InstanceIds, **kwargs):
+        self._call('StartInstances')
+        with self._lock:
+            for instance_id in InstanceIds:
+                if self.instances[instance_id]['started'] is None:
+                    self.instances[instance_id]['started'] = time.monotonic()
+        return {'StartingInstances': [{'InstanceId': i} for i in InstanceIds]}
+
+    def stop_instances(self, InstanceIds, **kwargs):
+        self._call('StopInstances')
+        with self._lock:
+            for instance_id in InstanceIds:
+                self.instances[instance_id]['started'] = None
+        return {'StoppingInstances': [{'InstanceId': i} for i in InstanceIds]}
+
+    def describe_security_groups(self, GroupIds, **kwargs):
+        self._call('DescribeSecurityGroups')
+        with self._lock:
+            ip_ranges = [{'CidrIp': cidr, 'Description': d} for cidr, d in self.ip_ranges.items()]
+        return {'SecurityGroups': [{'GroupId': GroupIds[0], 'IpPermissions': [{'IpProtocol': '-1', 'IpRanges': ip_ranges}]}]}
+
+    def revoke_security_group_ingress(self, GroupId, IpPermissions, **kwargs):
+        self._call('RevokeSecurityGroupIngress')
+        with self._lock:
+            for permission in IpPermissions:
+                for ip_range in permission['IpRanges']:
+                    if self.ip_ranges.pop(ip_range['CidrIp'], None) is None:
+                        raise client_error('InvalidPermission.NotFound', 'RevokeSecurityGroupIngress')
+
+    def authorize_security_group_ingress(self, GroupId, IpPermissions, **kwargs):
+        self._call('AuthorizeSecurityGroupIngress')
+        with self._lock:
+            for permission in IpPermissions:
+                for ip_range in permission['IpRanges']:
+                    if ip_range['CidrIp'] in self.ip_ranges:
+                        raise client_error('InvalidPermission.Duplicate', 'AuthorizeSecurityGroupIngress')
+                    self.ip_ranges[ip_range['CidrIp']] = ip_range.get('Description', '')
+
+
+class StubSSM:
+    """
+    SSM client whose commands run for a given duration.
+
+    Parameters
+    ----------
+    latency : float
+        Seconds spent in every API call.
+    duration : callable
+        Function returning the run time in seconds of a new command.
+    """
+
+    def __init__(self, latency=0.01, duration=lambda: 1.0):
+        self.latency = latency
+        self.duration = duration
+        self.calls = Counter()
+        self.commands = {}  # (command id, instance id) -> (requested datetime, monotonic end time)
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def _call(self, operation_name):
+        with self._lock:
+            self.calls[operation_name] += 1
+        time.sleep(self.latency)
+
+    def send_command(self, InstanceIds, **kwargs):
+        self._call('SendCommand')
+        command_id = f'cmd-{next(self._ids):06d}'
+        with self._lock:
+            for instance_id in InstanceIds:
+                self.commands[(command_id, instance_id)] = (
+                    datetime.datetime.now(datetime.timezone.utc),
+                    time.monotonic() + self.duration(),
+                )
+        return {'Command': {'CommandId': command_id}}
+
+    def _invocation(self, command_id, instance_id):
+        requested, end = self.commands[(command_id, instance_id)]
+        status = 'Success' if time.monotonic() >= end else 'InProgress'
+        return {'CommandId': command_id, 'InstanceId': instance_id, 'Status': status, 'RequestedDateTime': requested}
+
+    def get_command_invocation(self, CommandId, InstanceId, **kwargs):
+        self._call('GetCommandInvocation')
+        with self._lock:
+            return self._invocation(CommandId, InstanceId)
+
+    def list_command_invocations(self, CommandId=None, InstanceId=None, Filters=None, **kwargs):
+        self._call('ListCommandInvocations')
+        with self._lock:
+            keys = [
+                k
+                for k in self.commands
+                if (CommandId is None or k[0] == CommandId) and (InstanceId is None or k[1] == InstanceId)
+            ]
+            return {'CommandInvocations': [self._invocation(*key) for key in keys]}
+
+    def get_paginator(self, operation_name):
+        assert operation_name == 'list_command_invocations'
+        return _Paginator(self._list_pages, 'CommandInvocations', page_size=50)
+
+    def _list_pages(self, **kwargs):
+        # one API call per page, as with the real paginator
+        invocations = self.list_command_invocations(**kwargs)['CommandInvocations']
+        with self._lock:
+            self.calls['ListCommandInvocations'] += max(0, (len(invocations) - 1) // 50)
+        return {'CommandInvocations': invocations}
+
+
+class FakeSSHSession:
+    """Stand-in for `iblaws.ssh.SSHSession` whose volume preparation takes `latency` seconds."""
+
+    def __init__(self, host_ip, latency=0.05):
+        self.host_ip = host_ip
+        self.latency = latency
+
+    def prepare_volume(self, volume_id='AWS', mount_point='/mnt/s0', scratch='scratch', format_volume=None):
+        time.sleep(self.latency)
+        size = 900 * 1024**3
+        return {'device': '/dev/nvme1n1', 'formatted': 1, 'mounted': 1, 'size_bytes': size, 'available_bytes': size}
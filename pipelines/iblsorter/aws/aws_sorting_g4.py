@@ -1,8 +1,7 @@
-import time
-
 import iblutil.util
 import iblaws.utils
 import iblaws.compute
+import iblaws.history
 # 98.84.125.97
 
 logger = iblutil.util.setup_logger('iblaws', level='INFO')
@@ -36,26 +35,12 @@ pids = [
     'becce8b9-db96-4ace-ad99-66397ca9e181',
     '85b98361-9706-4318-8923-6988d4e804e8',
 ]
-for pid in pids:
-    command_id = im.run_command(f'/home/ubuntu/entrypoint.sh {pid}')
-    logger.critical(f'Started command for pid {pid}, with cid {command_id}...')
-    while True:
-        time.sleep(600)
-        if command_id is None:
-            command = next(
-                (c for c in ssm.list_commands(InstanceId=instance_id, MaxResults=10)['Commands'] if c['Comment'] == pid)
-            )
-        else:
-            command = ssm.get_command_invocation(CommandId=command_id, InstanceId=instance_id)
-        match command['Status']:
-            case 'Success':
-                logger.critical(f'Command for pid {pid} completed successfully')
-                break
-            case 'InProgress':
-                logger.info(f'Command for pid {pid} status: {command["Status"]}')
-                continue
-            case _:
-                logger.error(f'Command for pid {pid} status: {command["Status"]}')
-                raise ValueError(f' Weird command status: {command["Status"]}')
+# runs the pids on all the prepared instances, longest first, re-queuing each failed pid once
+scheduler = iblaws.compute.FleetScheduler(
+    [im], command_template='/home/ubuntu/entrypoint.sh {pid}', max_retries=1, history=iblaws.history.RunHistory()
+)
+results = scheduler.run(pids)
+for pid, status in results.items():
+    logger.critical(f'pid {pid}: {status}')
 
 # %%
@@ -11,5 +11,8 @@ sudo docker compose exec spikesorter pip install pydantic_settings
 sudo docker compose exec spikesorter pip install -U ibl-neuropixel
 eid=7ae3865a-d8f4-4b73-938e-ddaec33f8bc6
 probe_name=probe00
+start=$SECONDS
 sudo docker compose exec spikesorter python /root/Documents/PYTHON/ibl-sorter/examples/run_ibl_recording.py $eid $probe_name --cache_dir /mnt/s0 --scratch_dir /mnt/s0/scratch
+# summary of the run, recorded in the run history of the scheduler
+echo "iblaws-report sort=$((SECONDS - start))"
 sudo shutdown -h now
@@ -1,37 +1,150 @@
 """bash
 python spike_sort.py bcb1dac7-6d2b-47ad-bbbe-a4aaf9774481
+python spike_sort.py bcb1dac7-6d2b-47ad-bbbe-a4aaf9774481 069c2674-80b0-44b4-a3d9-28337512967f --prefetch-dir /mnt/s0/scratch
+
+With several pids, the raw ephys files of the next pid are copied to the prefetch folder while the current one sorts.
+With a worker id, as given by `iblaws.lightning.JobFanOut`, the machine registers in the HTTPS prefix list for the run.
 """
 
 import argparse
+import contextlib
+import logging
+import os
+import time
 from pathlib import Path
 
+from iblaws.compute import FirewallLease
+from iblaws.history import RunHistory
+from iblaws.lightning import WORKER_DESCRIPTION
+from iblaws.logs import report_line
+
 # NB: ibllightning is found in the ibl-aws package https://github.com/int-brain-lab/ibl-aws
 from ibllightning import OneLightningAI as ONE
 from ibllightning import LightningAIDataHandler
+from ibllightning.prefetch import DEFAULT_RESERVE, SCRATCH_DIR, Prefetcher, raw_ephys_files
 from ibllib.pipes.ephys_tasks import SpikeSorting
 
-SCRATCH_DIR = Path('/tmp/iblsorter')
-SCRATCH_DIR.mkdir(parents=True, exist_ok=True)
+_logger = logging.getLogger('ibllightning')
 
+SORT_SCRATCH_DIR = Path('/tmp/iblsorter')
+
+
+def writable_dir(path):
+    """Create a folder if needed, returns False if it cannot be created or written to."""
+    try:
+        Path(path).mkdir(parents=True, exist_ok=True)
+    except OSError:
+        return False
+    return os.access(path, os.W_OK)
+
+
+def recording_info(staging_dir):
+    """Size of the staged raw data and duration of the recording from its spikeglx meta file."""
+    if staging_dir is None:
+        return None, None
+    files = [f for f in Path(staging_dir).rglob('*') if f.is_file()]
+    meta = next((f for f in files if '.ap.' in f.name and f.suffix == '.meta'), None)
+    duration = None
+    if meta is not None:
+        fields = dict(line.split('=', 1) for line in meta.read_text().splitlines() if '=' in line)
+        duration = float(fields['fileTimeSecs']) if 'fileTimeSecs' in fields else None
+    return sum(f.stat().st_size for f in files), duration
 
-if __name__ == "__main__":
-    # parse arguments with argparse, the first is the eid, the second is the probe name
-    parser = argparse.ArgumentParser(description='Run spike sorting on a session')
-    parser.add_argument('pid', help='The probe ID')
-    args = parser.parse_args()
-    pid = args.pid
 
-    one = ONE()
+def spike_sort(one, pid, scratch_dir, staging_dir=None, timings=None):
+    timings = {} if timings is None else timings
     eid, pname = one.pid2eid(pid)
     session_path = one.eid2path(eid)
     lab = session_path.parts[-5]
-
     print(eid, pname)
     print(session_path)
-
-    session_path = one.eid2path(eid)
-    # assert session_path.exists(), f"Session path {session_path} does not exist - exiting..."
-    ssjob = SpikeSorting(session_path, one=one, pname=pname, device_collection='raw_ephys_data', location='Popeye',
-                         data_handler_class=LightningAIDataHandler, on_error='raise', scratch_folder=SCRATCH_DIR)
+    # the raw data prefetched in the staging folder is read instead of the S3 mount
+    data_handler_class = LightningAIDataHandler if staging_dir is None else LightningAIDataHandler.staged(staging_dir)
+    ssjob = SpikeSorting(
+        session_path,
+        one=one,
+        pname=pname,
+        device_collection='raw_ephys_data',
+        location='Popeye',
+        data_handler_class=data_handler_class,
+        on_error='raise',
+        scratch_folder=scratch_dir,
+    )
+    t0 = time.perf_counter()
     ssjob.run()
+    timings['sort'] = time.perf_counter() - t0
     ssjob.register_datasets(labs=lab, force=True)
+    timings['upload'] = time.perf_counter() - t0 - timings['sort']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run spike sorting on one or several probes')
+    parser.add_argument('pids', nargs='+', help='The probe IDs')
+    parser.add_argument('--scratch-dir', type=Path, default=SORT_SCRATCH_DIR, help='local scratch folder of the sorter')
+    parser.add_argument(
+        '--prefetch-dir',
+        type=Path,
+        default=SCRATCH_DIR,
+        help='local folder the raw data of the next pids is copied to, the scratch folder if not writable',
+    )
+    parser.add_argument('--prefetch', type=int, default=1, help='number of pids prefetched ahead, 0 to read from the mount')
+    parser.add_argument(
+        '--reserve-gb',
+        type=float,
+        default=DEFAULT_RESERVE / 1024**3,
+        help='free space in GB kept on the prefetch disk for the sorting',
+    )
+    parser.add_argument('--instance-type', default='L4', help='machine recorded in the run history')
+    parser.add_argument('--worker-id', type=int, help='register the machine in the HTTPS prefix list as this worker')
+    args = parser.parse_args()
+    scratch_dir = args.scratch_dir
+    scratch_dir.mkdir(parents=True, exist_ok=True)
+    prefetch_dir = args.prefetch_dir
+    if args.prefetch > 0 and not writable_dir(prefetch_dir):
+        # /mnt/s0 is the volume of the EC2 instances, it may not exist on a Lightning studio
+        _logger.warning(f'{prefetch_dir} is not writable, prefetching to {scratch_dir}')
+        prefetch_dir = scratch_dir
+
+    firewall = (
+        contextlib.nullcontext() if args.worker_id is None else FirewallLease(WORKER_DESCRIPTION.format(worker_id=args.worker_id))
+    )
+    with firewall:
+        one = ONE()
+        # the longest pids first according to the previous runs
+        history = RunHistory()
+        ordered, _ = history.order_longest_first(args.pids, args.instance_type)
+        if args.prefetch == 0:
+            pids = ((pid, None) for pid in ordered)
+        else:
+            prefetcher = Prefetcher(
+                lambda pid: raw_ephys_files(one, pid),
+                scratch_dir=prefetch_dir,
+                depth=args.prefetch,
+                reserve=int(args.reserve_gb * 1024**3),
+            )
+            pids = prefetcher.iterate(ordered)
+        failed = []
+        t0 = time.perf_counter()
+        for pid, staging_dir in pids:
+            # the wait for the prefetch of the raw data
+            timings, status = {'prepare': time.perf_counter() - t0}, 'Success'
+            try:
+                spike_sort(one, pid, scratch_dir, staging_dir, timings=timings)
+            except Exception:
+                _logger.exception(f'pid {pid}: spike sorting failed')
+                failed.append(pid)
+                status = 'Failed'
+            data_bytes, recording_seconds = recording_info(staging_dir)
+            history.record(
+                pid,
+                status,
+                instance_type=args.instance_type,
+                timings=timings,
+                data_bytes=data_bytes,
+                recording_seconds=recording_seconds,
+            )
+            # the same summary for the scheduler that sent the command, if any
+            print(report_line(**timings, data_bytes=data_bytes, recording_seconds=recording_seconds), flush=True)
+            t0 = time.perf_counter()
+        if failed:
+            raise SystemExit(f'{len(failed)}/{len(args.pids)} pids failed: {" ".join(failed)}')
@@ -0,0 +1,269 @@
+"""
+Tracking of SSM commands sent to EC2 instances.
+
+The `CommandTracker` watches many (command_id, instance_id) pairs, as returned by `InstanceManager.run_command`,
+and lists the invocations of a command on all its instances at once instead of calling `get_command_invocation` once
+per pair. Each command is polled on its own adaptive schedule and completion is delivered through futures and optional
+callbacks.
+
+    tracker = CommandTracker(im.ssm)
+    future = tracker.track(im.run_command(f'/home/ubuntu/entrypoint.sh {pid}'), im.instance_id, expected_duration=5400)
+    tracker.wait()
+    future.result()['Status']
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+_logger = logging.getLogger(__name__)
+
+# SSM command invocation statuses after which the command will not change anymore
+SSM_TERMINAL_STATUSES = ('Success', 'Cancelled', 'TimedOut', 'Failed')
+
+
+@dataclass
+class _TrackedCommand:
+    command_id: str
+    instance_id: str
+    expected_duration: Optional[float]
+    callback: Optional[Callable]
+    started: float
+    next_poll: float
+    interval: float = 0
+    status: str = 'Pending'
+    future: Future = field(default_factory=Future)
+
+
+class CommandTracker:
+    """
+    Batched, adaptive tracker of SSM command invocations.
+
+    At each poll, the commands that are due are grouped by command ID: each command is read from one paginated
+    `list_command_invocations` call covering all its instances, or restricted to its instance if it is due on a single
+    one, so that the cost of a poll only depends on the tracked commands. Without an expected duration, a command is
+    polled with an exponential backoff between `min_interval` and `max_interval`. With an expected duration, the delay
+    is half the time left until the expected completion, so that the polls get denser as the command nears completion,
+    and the backoff restarts from `min_interval` afterwards.
+
+    Parameters
+    ----------
+    ssm_client : boto3.client
+        The Boto3 SSM client of the region the instances are in.
+    min_interval : float
+        Shortest delay in seconds between two polls of a command.
+    max_interval : float
+        Longest delay in seconds between two polls of a command.
+    backoff : float
+        Growth factor of the delay between two polls of a command.
+    page_size : int
+        Number of invocations per page of `list_command_invocations`, at most 50.
+    """
+
+    def __init__(self, ssm_client, min_interval: float = 10, max_interval: float = 600, backoff: float = 2, page_size: int = 50):
+        self.ssm_client = ssm_client
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        self._commands = {}  # (command_id, instance_id) -> _TrackedCommand
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def pending(self) -> int:
+        """Number of commands that have not completed yet."""
+        return len(self._commands)
+
+    def track(
+        self, command_id: str, instance_id: str, expected_duration: Optional[float] = None, callback: Optional[Callable] = None
+    ) -> Future:
+        """
+        Start watching a command invocation.
+
+        Parameters
+        ----------
+        command_id : str
+            The command ID returned by `send_command`.
+        instance_id : str
+            The ID of the instance the command runs on.
+        expected_duration : float, optional
+            Expected run time of the command in seconds, used to schedule the polls.
+        callback : callable, optional
+            Function called with the final invocation record when the command completes.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves to the invocation record as returned by `list_command_invocations` once the status is terminal.
+        """
+        now = time.monotonic()
+        command = _TrackedCommand(
+            command_id=command_id,
+            instance_id=instance_id,
+            expected_duration=expected_duration,
+            callback=callback,
+            started=now,
+            next_poll=now,
+        )
+        self._schedule(command, now)
+        with self._lock:
+            self._commands[(command_id, instance_id)] = command
+        self._wake.set()
+        return command.future
+
+    def discard(self, command_id: str, instance_id: str, status: str = 'Cancelled') -> bool:
+        """
+        Stop watching a command, for example when its instance is reclaimed, and resolve its future.
+
+        Parameters
+        ----------
+        command_id : str
+            The command ID returned by `send_command`.
+        instance_id : str
+            The ID of the instance the command runs on.
+        status : str
+            The status of the invocation record the future resolves to.
+
+        Returns
+        -------
+        bool
+            False if the command was not tracked or already completed.
+        """
+        with self._lock:
+            command = self._commands.pop((command_id, instance_id), None)
+        if command is None:
+            return False
+        command.status = status
+        invocation = {'CommandId': command_id, 'InstanceId': instance_id, 'Status': status}
+        command.future.set_result(invocation)
+        if command.callback is not None:
+            command.callback(invocation)
+        return True
+
+    def _schedule(self, command: _TrackedCommand, now: float):
+        if command.expected_duration is not None:
+            remaining = command.started + command.expected_duration - now
+            if remaining > 2 * self.min_interval:
+                command.next_poll = now + min(self.max_interval, remaining / 2)
+                return
+        command.interval = min(self.max_interval, command.interval * self.backoff) if command.interval else self.min_interval
+        command.next_poll = now + command.interval
+
+    def next_poll_delay(self) -> float:
+        """Seconds until the next command is due for a poll, `max_interval` if there is no command to track."""
+        with self._lock:
+            if not self._commands:
+                return self.max_interval
+            return max(0.0, min(c.next_poll for c in self._commands.values()) - time.monotonic())
+
+    def _list_invocations(self, due: list) -> list:
+        instances = {}  # command_id -> due instance IDs
+        for command in due:
+            instances.setdefault(command.command_id, []).append(command.instance_id)
+        paginator = self.ssm_client.get_paginator('list_command_invocations')
+        invocations = []
+        for command_id, instance_ids in instances.items():
+            kwargs = {'CommandId': command_id}
+            if len(instance_ids) == 1:
+                kwargs['InstanceId'] = instance_ids[0]
+            for page in paginator.paginate(**kwargs, PaginationConfig={'PageSize': self.page_size}):
+                invocations.extend(page['CommandInvocations'])
+        return invocations
+
+    def poll(self, force: bool = False) -> list:
+        """
+        Look up the commands that are due and resolve the ones that completed.
+
+        Parameters
+        ----------
+        force : bool
+            Look up all the tracked commands regardless of their schedule.
+
+        Returns
+        -------
+        list of dict
+            The invocation records of the commands that completed during this poll.
+        """
+        now = time.monotonic()
+        with self._lock:
+            due = [c for c in self._commands.values() if force or c.next_poll <= now]
+        if not due:
+            return []
+        invocations = self._list_invocations(due)
+        completed = []
+        now = time.monotonic()
+        with self._lock:
+            for invocation in invocations:
+                command = self._commands.get((invocation['CommandId'], invocation['InstanceId']))
+                if command is None:
+                    continue
+                command.status = invocation['Status']
+                if invocation['Status'] in SSM_TERMINAL_STATUSES:
+                    self._commands.pop((command.command_id, command.instance_id))
+                    completed.append((command, invocation))
+            for command in due:
+                if (command.command_id, command.instance_id) in self._commands:
+                    self._schedule(command, now)
+        for command, invocation in completed:
+            _logger.info(f'Command {command.command_id} on {command.instance_id} completed with status {invocation["Status"]}')
+            command.future.set_result(invocation)
+            if command.callback is not None:
+                command.callback(invocation)
+        return [invocation for _, invocation in completed]
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Poll until all the tracked commands have completed.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Maximum time to wait in seconds.
+
+        Returns
+        -------
+        bool
+            True if all the commands completed, False if the timeout expired first.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.pending:
+            delay = self.next_poll_delay()
+            if deadline is not None and time.monotonic() + delay > deadline:
+                return False
+            time.sleep(delay)
+            self.poll()
+        return True
+
+    def start(self):
+        """Poll in a background thread, completions are then only delivered through the futures and callbacks."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='CommandTracker', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread, the commands that have not completed remain tracked."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.next_poll_delay())
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            try:
+                self.poll()
+            except Exception as e:
+                _logger.error(f'Failed to poll the SSM command invocations: {e}')
+                self._stop.wait(self.min_interval)
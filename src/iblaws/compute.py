@@ -1,7 +1,20 @@
+import functools
+import inspect
 import logging
-import requests
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import Optional
 
+import iblaws.commands
+import iblaws.history
+import iblaws.inventory
+import iblaws.metrics
+import iblaws.prefix_lists
+import iblaws.ssh
 import iblaws.utils
 
 
@@ -14,50 +27,252 @@ ALYX_SECURITY_GROUP_ID = 'sg-0ec7c3c71eba340dd'
 HTTPS_PREFIX_LIST_ID = 'pl-0be82b42e37cbc052'
 
 
+# seconds during which the public IP of this host is reused before asking api.ipify.org again
+PUBLIC_IP_TTL = 300
+_PUBLIC_IP_LOCK = threading.Lock()
+_PUBLIC_IP_CACHE = {}
+# reference counts of the prefix list entries held by this process
+_LEASES_LOCK = threading.Lock()
+_LEASES = {}
+# seconds after which the prefix list entry of a worker that did not renew it can be swept, renewed every half period
+FIREWALL_LEASE_TTL = 6 * 3600
+
+
 # run before
 def _get_public_ip():
+    import requests
+
     response = requests.get('https://api.ipify.org')
     return response.text
 
 
-def manage_firewall_access(worker=0):
+def get_public_ip(ttl: float = PUBLIC_IP_TTL) -> str:
+    """
+    Returns the public IP of this host, cached for `ttl` seconds.
+
+    Args:
+        ttl (float): Maximum age in seconds of the cached IP, 0 forces a new lookup.
+
+    Returns:
+        str: The public IP address.
+    """
+    with _PUBLIC_IP_LOCK:
+        if time.monotonic() - _PUBLIC_IP_CACHE.get('fetched_at', -float('inf')) >= ttl:
+            _PUBLIC_IP_CACHE.update(ip=_get_public_ip(), fetched_at=time.monotonic())
+        return _PUBLIC_IP_CACHE['ip']
+
+
+@dataclass
+class _LeaseState:
+    count: int = 0
+    registered: bool = False
+    timer: threading.Timer = None
+    renewal: threading.Timer = None
+    expires: float = 0
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+
+class FirewallLease:
+    """
+    Reference-counted access of this host through an entry of a managed prefix list.
+
+    All the leases of a process with the same description share a single prefix list entry: the entry is
+    added (replacing any stale entry with the same description) on the first acquire and removed on the last
+    release, optionally after a grace period so that back-to-back tasks keep the same entry. The entry carries
+    an expiry that is renewed while it is held: the entries left behind by crashed workers expire and are swept
+    by the next worker that registers on the list, in the same modification. The entry is always written to the
+    given list: spreading leases over several lists is left to `iblaws.prefix_lists.PrefixListPool`.
+
+    Args:
+        description (str): The description of the prefix list entry, e.g. 'Lightning AI Worker #07'.
+        managed_prefix_list_id (str): The ID of the managed prefix list.
+        region_name (str): The region of the prefix list.
+        linger (float): Seconds to keep the entry after the last release, in case it is acquired again.
+        ttl (float): Lifetime of the entry in seconds, None for an entry that never expires.
+
+    Example:
+        >>> with FirewallLease('Lightning AI Worker #07'):
+        ...     one = ONE()
+        >>> async with FirewallLease('Lightning AI Worker #07'):
+        ...     await run_task()
+    """
+
+    def __init__(
+        self,
+        description: str,
+        managed_prefix_list_id: str = HTTPS_PREFIX_LIST_ID,
+        region_name: str = 'eu-west-2',
+        linger: float = 0,
+        ttl: float = FIREWALL_LEASE_TTL,
+    ):
+        self.description = description
+        self.managed_prefix_list_id = managed_prefix_list_id
+        self.region_name = region_name
+        self.linger = linger
+        self.ttl = ttl
+        with _LEASES_LOCK:
+            self._state = _LEASES.setdefault((region_name, managed_prefix_list_id, description), _LeaseState())
+
+    @property
+    def writer(self) -> iblaws.prefix_lists.PrefixListWriter:
+        ec2 = iblaws.utils.get_service_client(service_name='ec2', region_name=self.region_name)
+        return iblaws.prefix_lists.get_prefix_list_writer(ec2, self.managed_prefix_list_id)
+
+    @property
+    def count(self) -> int:
+        """Number of holders of the entry in this process."""
+        return self._state.count
+
+    def acquire(self):
+        with self._state.lock, iblaws.metrics.span('firewall_lease.acquire'):
+            if self._state.timer is not None:
+                self._state.timer.cancel()
+                self._state.timer = None
+            if not self._state.registered:
+                self._register()
+                self._state.registered = True
+            self._state.count += 1
+        return self
+
+    def _register(self):
+        # called with the state lock held
+        cidr = f'{get_public_ip()}/32'
+        if self.ttl is None:
+            self.writer.replace(self.description, cidr)
+            return
+        expires = time.time() + self.ttl
+        description = iblaws.prefix_lists.lease_description(self.description, expires)
+        self.writer.submit_many([('sweep', ''), ('replace', description, cidr)])[-1].result()
+        self._state.expires = expires
+        self._schedule_renewal(self.ttl / 2)
+
+    def _schedule_renewal(self, delay: float):
+        # called with the state lock held
+        self._state.renewal = threading.Timer(delay, self._renew)
+        self._state.renewal.daemon = True
+        self._state.renewal.start()
+
+    def _renew(self):
+        with self._state.lock:
+            if not self._state.registered:
+                return
+            try:
+                self._register()
+            except Exception as e:
+                # a failed renewal must not end the chain: retry at a shrinking fraction of the remaining lifetime
+                delay = max(self.ttl / 100, (self._state.expires - time.time()) / 4)
+                _logger.warning(f'Could not renew the prefix list entry of {self.description}, retrying in {delay:.0f}s: {e}')
+                self._schedule_renewal(delay)
+
+    def release(self):
+        with self._state.lock, iblaws.metrics.span('firewall_lease.release'):
+            self._state.count -= 1
+            if self._state.count > 0 or not self._state.registered:
+                return
+            if self.linger > 0:
+                self._state.timer = threading.Timer(self.linger, self._expire)
+                self._state.timer.daemon = True
+                self._state.timer.start()
+            else:
+                self._remove()
+
+    def _expire(self):
+        with self._state.lock:
+            if self._state.count == 0 and self._state.registered:
+                self._remove()
+            self._state.timer = None
+
+    def _remove(self):
+        # called with the state lock held
+        if self._state.renewal is not None:
+            self._state.renewal.cancel()
+            self._state.renewal = None
+        self.writer.remove(self.description, ignore_errors=True)
+        self._state.registered = False
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+    async def __aenter__(self):
+        import asyncio
+
+        return await asyncio.to_thread(self.acquire)
+
+    async def __aexit__(self, *args):
+        import asyncio
+
+        await asyncio.to_thread(self.release)
+
+
+def manage_firewall_access(worker=0, linger: float = 0):
+    """
+    Decorator granting the host access to the HTTPS prefix list for the duration of the call.
+
+    Concurrent or nested calls with the same worker id share one prefix list entry, see `FirewallLease`.
+    The worker id can be overridden at call time with a `worker_id` keyword argument.
+
+    Args:
+        worker (int): The worker id, the entry is described as 'Lightning AI Worker #NN'.
+        linger (float): Seconds to keep the entry after the last call returns, to reuse it for the next task.
+    """
+
     def decorator(func):
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                worker_id = kwargs.pop('worker_id', worker)
+                async with FirewallLease(f'Lightning AI Worker #{worker_id:02}', linger=linger):
+                    with iblaws.metrics.span('manage_firewall_access.task'):
+                        return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            if 'worker_id' in kwargs:
-                worker_id = kwargs.pop('worker_id')
-            else:
-                worker_id = worker
-            # run before
-            description = f'Lightning AI Worker #{worker_id:02}'
-            ec2 = iblaws.utils.get_service_client(service_name='ec2', region_name='eu-west-2')
-            new_ip = f'{_get_public_ip()}/32'
-            try:
-                iblaws.utils.ec2_remove_managed_prefix_list_item(
-                    ec2, managed_prefix_list_id=HTTPS_PREFIX_LIST_ID, description=description
-                )
-            except ValueError:
-                pass
-            iblaws.utils.ec2_add_managed_prefix_list_item(
-                ec2, managed_prefix_list_id=HTTPS_PREFIX_LIST_ID, description=description, cidrip=new_ip
-            )
-            # Execute the decorated function
-            result = func(*args, **kwargs)
-            # run after
-            iblaws.utils.ec2_remove_managed_prefix_list_item(
-                ec2, managed_prefix_list_id=HTTPS_PREFIX_LIST_ID, description=description
-            )
-            return result
+            worker_id = kwargs.pop('worker_id', worker)
+            with FirewallLease(f'Lightning AI Worker #{worker_id:02}', linger=linger):
+                with iblaws.metrics.span('manage_firewall_access.task'):
+                    return func(*args, **kwargs)
 
         return wrapper
 
     return decorator
 
 
+def register_alyx_access(public_ips: dict, prefix_list_id: Optional[str] = None):
+    """
+    Allows instances to communicate with the Alyx database, in one batched update for all of them.
+
+    Args:
+        public_ips (dict): Instance ID to public IP, the instance ID is used as the rule description.
+        prefix_list_id (str): Also register the IPs in this managed prefix list, in a single modification.
+    """
+    ec2_london = iblaws.utils.get_service_client(service_name='ec2', region_name='eu-west-2')
+    cidrs = {instance_id: f'{public_ip}/32' for instance_id, public_ip in public_ips.items()}
+    iblaws.utils.ec2_update_security_group_rules(ec2_london, security_group_id=ALYX_SECURITY_GROUP_ID, rules=cidrs)
+    if prefix_list_id is not None:
+        writer = iblaws.prefix_lists.get_prefix_list_writer(ec2_london, prefix_list_id)
+        futures = writer.submit_many([('replace', instance_id, cidr) for instance_id, cidr in cidrs.items()])
+        for future in futures:
+            future.result()
+
+
 class InstanceManager:
-    def __init__(self, instance_id: str, instance_region: str, volume_id: str = 'AWS'):
+    def __init__(self, instance_id: str, instance_region: str, volume_id: str = 'AWS', instance_store_scratch: bool = False):
         self.instance_id = instance_id
         self.instance_region = instance_region
         self.volume_id = volume_id
+        # stripe the NVMe instance store disks as scratch, the volume is the fallback
+        self.instance_store_scratch = instance_store_scratch
+        # launched on spot capacity, EC2 may reclaim it with a two-minute notice
+        self.spot = False
+        self.public_ip = None
+        # seconds taken by the last start and preparation of the instance, recorded in the run history
+        self.prepare_seconds = None
         self._ssm = None
         self._ec2 = None
 
@@ -73,6 +288,14 @@ class InstanceManager:
             self._ssm = iblaws.utils.get_service_client(service_name='ssm', region_name=self.instance_region)
         return self._ssm
 
+    @property
+    def inventory(self) -> iblaws.inventory.InstanceInventory:
+        return iblaws.inventory.get_inventory(self.ec2)
+
+    @property
+    def instance_type(self) -> str:
+        return self.inventory.get(self.instance_id).instance_type
+
     def start_and_prepare_instance(self) -> str:
         """
         Starts an EC2 instance and prepares it for running the spikesorting pipeline.
@@ -86,45 +309,144 @@ class InstanceManager:
         Returns:
             str: The public IP address of the started instance.
         """
-        # setup the security group so ONE can communicate with the Alyx database
-        response = self.ec2.describe_instances(InstanceIds=[self.instance_id])
-        instance_state = response['Reservations'][0]['Instances'][0]['State']['Name']
-        if instance_state != 'stopped':
-            raise ValueError(f'Instance {self.instance_id} is not in stopped state but in {instance_state} state')
+        span = iblaws.metrics.span
+        t0 = time.perf_counter()
+        with span('start_and_prepare_instance'):
+            # the instance may have been started or stopped by another process since it was cached
+            instance_state = self.inventory.get(self.instance_id, max_age=0).state
+            if instance_state != 'stopped':
+                raise ValueError(f'Instance {self.instance_id} is not in stopped state but in {instance_state} state')
 
-        # starts instance and get its IP
-        iblaws.utils.ec2_start_instance(self.ec2, self.instance_id)
-        public_ip = iblaws.utils.ec2_get_public_ip(self.ec2, self.instance_id)
+            # starts instance and get its IP
+            with span('start_and_prepare_instance.start_instance'):
+                iblaws.utils.ec2_start_instance(self.ec2, self.instance_id)
+            with span('start_and_prepare_instance.get_public_ip'):
+                public_ip = iblaws.utils.ec2_get_public_ip(self.ec2, self.instance_id)
 
-        # setup the security group so ONE can communicate with the Alyx database
-        _logger.info(f'Public IP: {public_ip}, ssh command: ssh -i {PRIVATE_KEY_PATH.as_posix()} {USERNAME}@{public_ip}')
-        ec2_london = iblaws.utils.get_service_client(service_name='ec2', region_name='eu-west-2')
-        iblaws.utils.ec2_update_security_group_rule(
-            ec2_london, security_group_id=ALYX_SECURITY_GROUP_ID, description=self.instance_id, cidrip=f'{public_ip}/32'
-        )
-        # get the SSH client and mount the EBS volume
-        ssh = iblaws.utils.ec2_get_ssh_client(public_ip, PRIVATE_KEY_PATH, username=USERNAME)
-        _logger.info('Mounting EBS volume...')
-        # the device name listed in the attachment of the EBS volume doesn't match the device name in the /dev/ directory
-        # but the EBS volume_id is set as the SERIAL number in the device identification, findable using `lsblk -o +SERIAL`
-        # source: https://docs.aws.amazon.com/ebs/latest/userguide/identify-nvme-ebs-device.html
-        _, stdout, _ = ssh.exec_command(f'lsblk -o +SERIAL | grep {self.volume_id.replace("-", "")}')
-        device_name = f'/dev/{stdout.read().decode().strip().split()[0]}'
-        _logger.info(f'Device name: {device_name}')
-        if self.volume_id == 'AWS':
-            _logger.info(f'Found device name: {device_name}, now formatting to xfs')
-            _, stdout, stderr = ssh.exec_command(f'sudo mkfs -t xfs {device_name}')
-        _logger.info(f'Mount device name: {device_name} to /mnt/s0')
-        _, stdout, stderr = ssh.exec_command(f'sudo mount {device_name} /mnt/s0')
-        _, stdout, _ = ssh.exec_command('df -h /mnt/s0')
-        _logger.info(stdout.read().decode('utf8').strip())
-        _, stdout, stderr = ssh.exec_command('sudo mkdir /mnt/s0/scratch')
+            # setup the security group so ONE can communicate with the Alyx database
+            _logger.info(f'Public IP: {public_ip}, ssh command: ssh -i {PRIVATE_KEY_PATH.as_posix()} {USERNAME}@{public_ip}')
+            with span('start_and_prepare_instance.register_alyx_access'):
+                register_alyx_access({self.instance_id: public_ip})
+            with span('start_and_prepare_instance.prepare_instance'):
+                self.prepare_instance(public_ip)
+        self.prepare_seconds = time.perf_counter() - t0
         return public_ip
 
-    def run_command(self, command: str, time_out_seconds: int = 7_200, comment: str = '') -> str:
-        ssm = iblaws.utils.get_service_client(service_name='ssm', region_name=self.instance_region)
+    def prepare_instance(self, public_ip: str) -> dict:
+        """
+        Mounts the EBS volume of a running instance and creates the scratch directory.
+
+        With `instance_store_scratch`, the NVMe instance store disks are striped and mounted instead, the EBS volume
+        being mounted only if the instance has none, and the throughput of the scratch directory is measured.
+
+        Args:
+            public_ip (str): The public IP address of the instance.
+
+        Returns:
+            dict: The device and disk space of the mounted volume, see `iblaws.ssh.SSHSession.prepare_volume` and
+                `iblaws.ssh.SSHSession.prepare_scratch`.
+        """
+        self.public_ip = public_ip
+        t0 = time.perf_counter()
+        # mount the EBS volume in a single round-trip over a reusable SSH session
+        ssh = iblaws.ssh.get_ssh_session(public_ip, PRIVATE_KEY_PATH, username=USERNAME)
+        try:
+            if self.instance_store_scratch:
+                _logger.info(f'Mounting the instance store scratch on {self.instance_id}...')
+                return ssh.prepare_scratch(mount_point='/mnt/s0', fallback_volume_id=self.volume_id)
+            _logger.info(f'Mounting EBS volume on {self.instance_id}...')
+            volume = ssh.prepare_volume(volume_id=self.volume_id, mount_point='/mnt/s0')
+            _logger.info(f'Device name: {volume["device"]}, {volume["available_bytes"] / 1024**3:.0f} GiB available on /mnt/s0')
+            return volume
+        finally:
+            self.prepare_seconds = time.perf_counter() - t0
+
+    @classmethod
+    def start_fleet(
+        cls,
+        instance_region: str,
+        instance_ids: Optional[list] = None,
+        tags: Optional[dict] = None,
+        volume_id: str = 'AWS',
+        prefix_list_id: Optional[str] = None,
+        max_workers: int = 16,
+        instance_store_scratch: bool = False,
+    ) -> list:
+        """
+        Starts several stopped instances at once and prepares them for running the spikesorting pipeline.
+        - one `start_instances` call and one waiter for all the instances
+        - one batched registration of all the new IPs with the Alyx security group (and prefix list)
+        - the volumes are mounted concurrently
+
+        Args:
+            instance_region (str): The region of the instances.
+            instance_ids (list[str]): The IDs of the instances to start.
+            tags (dict): Select the stopped instances with these tags instead, e.g. {'Flottille': 'iblsorter'}.
+            volume_id (str): The volume to mount on each instance, 'AWS' for the instance store.
+            prefix_list_id (str): Also register the IPs in this managed prefix list, e.g. `HTTPS_PREFIX_LIST_ID`.
+            max_workers (int): Maximum number of instances prepared concurrently.
+            instance_store_scratch (bool): Stripe the NVMe instance store disks as scratch, see `prepare_instance`.
+
+        Returns:
+            list[InstanceManager]: The managers of the started instances, with their `public_ip` set.
+        """
+        t0 = time.perf_counter()
+        ec2 = iblaws.utils.get_service_client(service_name='ec2', region_name=instance_region)
+        public_ips = iblaws.utils.ec2_start_instances(ec2, instance_ids=instance_ids, tags=tags)
+        if not public_ips:
+            return []
+        register_alyx_access(public_ips, prefix_list_id=prefix_list_id)
+        instances = [cls(instance_id, instance_region, volume_id, instance_store_scratch) for instance_id in public_ips]
+
+        def prepare(im):
+            im.prepare_instance(public_ips[im.instance_id])
+            # the shared start counts in the preparation of each instance
+            im.prepare_seconds = time.perf_counter() - t0
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(prepare, instances))
+        return instances
+
+    @staticmethod
+    def stop_fleet(instance_region: str, instance_ids: Optional[list] = None, tags: Optional[dict] = None) -> list:
+        """
+        Stops several running instances with one API call and one waiter.
+
+        Args:
+            instance_region (str): The region of the instances.
+            instance_ids (list[str]): The IDs of the instances to stop.
+            tags (dict): Select the running instances with these tags instead, e.g. {'Flottille': 'iblsorter'}.
+
+        Returns:
+            list[str]: The IDs of the stopped instances.
+        """
+        ec2 = iblaws.utils.get_service_client(service_name='ec2', region_name=instance_region)
+        return iblaws.utils.ec2_stop_instances(ec2, instance_ids=instance_ids, tags=tags)
+
+    def run_command(self, command: str, time_out_seconds: int = 7_200, comment: str = '', log_uri: Optional[str] = None) -> str:
+        """
+        Sends a shell command to the instance.
+
+        Args:
+            command (str): The shell command.
+            time_out_seconds (int): Execution timeout of the command.
+            comment (str): The comment of the command, e.g. the pid.
+            log_uri (str): Copy the output to this 's3://bucket/key' or local path while the command runs, see
+                `iblaws.logs`. For an S3 log, the complete outputs are also saved next to it once the command completes.
+
+        Returns:
+            str: The command ID.
+        """
+        options = {}
+        if log_uri is not None:
+            import iblaws.logs
+
+            command = iblaws.logs.stream_command(command, log_uri)
+            if log_uri.startswith('s3://'):
+                bucket, key = log_uri[len('s3://') :].split('/', 1)
+                options = {'OutputS3BucketName': bucket, 'OutputS3KeyPrefix': f'{key.rpartition("/")[0]}/ssm'.lstrip('/')}
         # Send a command to the instance
-        response = ssm.send_command(
+        response = self.ssm.send_command(
             InstanceIds=[self.instance_id],  # replace with your instance ID
             DocumentName='AWS-RunShellScript',
             Parameters={
@@ -133,21 +455,52 @@ class InstanceManager:
             },
             TimeoutSeconds=time_out_seconds,  # we give the spike sorting 10 hours to complete
             Comment=comment,
+            **options,
         )
         # Get the command ID
         command_id = response['Command']['CommandId']
         return command_id
 
-    @staticmethod
-    def create_instance(self, ami_id: str, instance_type: str, instance_region: str, volume_id: str = 'AWS'):
+    def cancel_command(self, command_id: str):
+        """Cancels a command running on the instance, its status becomes 'Cancelled'."""
+        _logger.warning(f'Cancelling command {command_id} on {self.instance_id}')
+        self.ssm.cancel_command(CommandId=command_id, InstanceIds=[self.instance_id])
+
+    @classmethod
+    def create_instance(
+        cls,
+        ami_id: str,
+        instance_type: str,
+        instance_region: str,
+        volume_id: str = 'AWS',
+        tags: Optional[dict] = None,
+        hibernation: bool = False,
+        spot: bool = False,
+        availability_zone: Optional[str] = None,
+    ):
+        if spot and hibernation:
+            raise ValueError('One-time spot instances cannot be hibernated')
         ec2 = iblaws.utils.get_service_client(service_name='ec2', region_name=instance_region)
+        tags = {'Flottille': 'iblsorter', **(tags or {})}
+        options = {}
+        if hibernation:
+            # hibernation also requires an encrypted root volume large enough for the memory, set in the AMI
+            options['HibernationOptions'] = {'Configured': True}
+        if spot:
+            # a reclaimed instance is terminated, the interrupted pids are re-queued on a replacement
+            options['InstanceMarketOptions'] = {
+                'MarketType': 'spot',
+                'SpotOptions': {'SpotInstanceType': 'one-time', 'InstanceInterruptionBehavior': 'terminate'},
+            }
+        if availability_zone is not None:
+            options['Placement'] = {'AvailabilityZone': availability_zone}
         response = ec2.run_instances(
             ImageId=ami_id,
             InstanceType=instance_type,
             MinCount=1,
             MaxCount=1,
             KeyName='spikesorting_rerun',  # specify multiple key pairs here, separated by commas
-            InstanceInitiatedShutdownBehavior='stop',  # terminate
+            InstanceInitiatedShutdownBehavior='terminate' if spot else 'stop',
             # BlockDeviceMappings=[
             #     {
             #         'DeviceName': DEVICE_NAME,
@@ -165,23 +518,349 @@ class InstanceManager:
             TagSpecifications=[
                 {
                     'ResourceType': 'instance',
-                    'Tags': [
-                        {'Key': 'Flottille', 'Value': 'iblsorter'},
-                    ],
+                    'Tags': [{'Key': key, 'Value': value} for key, value in tags.items()],
                 },
             ],
+            **options,
         )
 
         instance_id = response['Instances'][0]['InstanceId']
-        _logger.info(f'Created instance with ID: {self.instance_id}')
+        _logger.info(f'Created instance with ID: {instance_id}')
+        ec2.get_waiter('instance_running').wait(InstanceIds=[instance_id])
         # bdm = next(item for item in response['Reservations'][0]['Instances'][0]['BlockDeviceMappings'] if item['DeviceName'] == '/dev/sdf')
         # volume_id = bdm['Ebs']['VolumeId']
-        public_ip = iblaws.utils.ec2_get_public_ip(self.ec2, self.instance_id)
+        public_ip = iblaws.utils.ec2_get_public_ip(ec2, instance_id)
         # setup the security group so ONE can communicate with the Alyx database
         _logger.info(f'Public IP: {public_ip}, ssh command: ssh -i {PRIVATE_KEY_PATH.as_posix()} {USERNAME}@{public_ip}')
-        ec2_london = iblaws.utils.get_service_client(service_name='ec2', region_name='eu-west-2')
-        iblaws.utils.ec2_update_security_group_rule(
-            ec2_london, security_group_id=ALYX_SECURITY_GROUP_ID, description=instance_id, ip=public_ip
+        register_alyx_access({instance_id: public_ip})
+        instance = cls(instance_id, instance_region, volume_id)
+        instance.public_ip = public_ip
+        instance.spot = spot
+        return instance
+
+
+class FleetScheduler:
+    """
+    Spreads a list of pids over a pool of instances, each instance running one pid at a time.
+
+    Whenever an instance becomes free, the next pid of the queue is sent to it with `InstanceManager.run_command`.
+    The commands of all instances are tracked together by one `iblaws.commands.CommandTracker` per SSM client and
+    failed pids are put back at the end of the queue until their retry budget is exhausted.
+
+    With a run history, every run is recorded in it and the pids are dispatched by decreasing predicted run time, so
+    that the longest ones do not end up running alone at the end of the batch.
+
+    The spot instances are watched for interruption notices with one `iblaws.spot.InterruptionWatcher` per EC2
+    client. The pid of a reclaimed instance is checkpointed if there is a checkpoint command, then put back at the
+    front of the queue without using its retry budget, and the instance is replaced in background if there is a
+    `replace` function, for example an `iblaws.spot.SpotReplacer`.
+
+    With a log URI template, the output of each command is copied to a log while it runs and tailed with byte-range
+    reads, see `iblaws.logs`: the progress of the pids is logged and, with a stall timeout, a command without output
+    for that long is cancelled and its pid re-queued with the 'Stalled' status.
+
+    Args:
+        instances (list[InstanceManager]): The instances to run the pids on, already started and prepared.
+        command_template (str): The shell command to run for a pid, formatted with `pid=pid`.
+        max_retries (int): Number of times a failed pid is re-queued before it is reported as failed.
+        time_out_seconds (int): Execution timeout of each command.
+        expected_duration (float): Expected run time of a pid in seconds, the status checks get denser around it.
+        min_poll_interval (float): Shortest delay in seconds between two status checks of a command.
+        max_poll_interval (float): Longest delay in seconds between two status checks of a command.
+        history (iblaws.history.RunHistory): Records the runs and predicts their run time. The preparation of an
+            instance is recorded with its first pid, the other phases and the data size are read from the summary
+            printed by the command, see `iblaws.logs.report_line`.
+        recording_seconds (dict): Duration of the recording of the pids, to predict the run time of new pids.
+        replace (callable): Takes a reclaimed spot instance and returns a prepared replacement instance.
+        checkpoint_template (str): Shell command sent to a reclaimed instance to save the intermediate outputs of its
+            pid within the two-minute notice, formatted with `pid=pid`. The command of the pid resumes from them.
+        interruption_poll_interval (float): Delay in seconds between two checks of the spot interruption notices.
+        log_uri_template (str): The 's3://bucket/key' or local path of the log of a command, formatted with `pid` and
+            `attempt`, e.g. 's3://my-bucket/logs/{pid}-{attempt}.log'.
+        stall_timeout (float): Seconds without output after which a command is cancelled, requires a log.
+        log_poll_interval (float): Delay in seconds between two reads of the log of a command.
+
+    Example:
+        >>> scheduler = FleetScheduler([InstanceManager(iid, 'us-east-1') for iid in instance_ids])
+        >>> results = scheduler.run(pids)
+        >>> scheduler = FleetScheduler(instances, history=iblaws.history.RunHistory())
+        >>> scheduler = FleetScheduler(spot_instances, replace=iblaws.spot.SpotReplacer(ami_id, ['g6.4xlarge', 'g5.4xlarge']))
+    """
+
+    def __init__(
+        self,
+        instances: list,
+        command_template: str = '/home/ubuntu/entrypoint.sh {pid}',
+        max_retries: int = 1,
+        time_out_seconds: int = 7_200,
+        expected_duration: Optional[float] = None,
+        min_poll_interval: float = 10,
+        max_poll_interval: float = 600,
+        history: iblaws.history.RunHistory = None,
+        recording_seconds: Optional[dict] = None,
+        replace=None,
+        checkpoint_template: Optional[str] = None,
+        interruption_poll_interval: float = 15,
+        log_uri_template: Optional[str] = None,
+        stall_timeout: Optional[float] = None,
+        log_poll_interval: float = 60,
+    ):
+        self.instances = list(instances)
+        self.command_template = command_template
+        self.max_retries = max_retries
+        self.time_out_seconds = time_out_seconds
+        self.expected_duration = expected_duration
+        self.min_poll_interval = min_poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.history = history
+        self.recording_seconds = recording_seconds or {}
+        self.replace = replace
+        self.checkpoint_template = checkpoint_template
+        self.interruption_poll_interval = interruption_poll_interval
+        self.log_uri_template = log_uri_template
+        self.stall_timeout = stall_timeout
+        self.log_poll_interval = log_poll_interval
+        self.attempts = Counter()
+        self.interruptions = Counter()
+        self.predictions = {}
+        self._trackers = {}
+        self._watchers = {}
+        self.logs = {}  # pid -> iblaws.logs.CommandLog of its last attempt
+        self._logs = {}  # command id -> iblaws.logs.CommandLog
+        self._prepared = set()  # the instances whose preparation is already recorded with a pid
+
+    def _tracker(self, instance: InstanceManager) -> iblaws.commands.CommandTracker:
+        if instance.ssm not in self._trackers:
+            self._trackers[instance.ssm] = iblaws.commands.CommandTracker(
+                instance.ssm, min_interval=self.min_poll_interval, max_interval=self.max_poll_interval
+            )
+        return self._trackers[instance.ssm]
+
+    def _watch(self, instance: InstanceManager):
+        if not getattr(instance, 'spot', False):
+            return
+        import iblaws.spot
+
+        if instance.ec2 not in self._watchers:
+            self._watchers[instance.ec2] = iblaws.spot.InterruptionWatcher(instance.ec2, interval=self.interruption_poll_interval)
+        self._watchers[instance.ec2].watch([instance.instance_id])
+
+    def _interrupt(self, instance: InstanceManager, running: dict):
+        """Checkpoints and stops tracking the pid of a reclaimed instance, its command resolves as 'Interrupted'."""
+        for pid, im, _, command_id in running.values():
+            if im is not instance:
+                continue
+            self.interruptions[pid] += 1
+            if self.checkpoint_template is not None:
+                try:
+                    instance.run_command(
+                        self.checkpoint_template.format(pid=pid), time_out_seconds=110, comment=f'checkpoint {pid}'
+                    )
+                except Exception as e:
+                    _logger.error(f'Could not checkpoint pid {pid} on {instance.instance_id}: {e}')
+            self._tracker(instance).discard(command_id, instance.instance_id, status='Interrupted')
+
+    def _dispatch(self, pid: str, instance: InstanceManager):
+        """Sends the command for a pid, returns the command id or None if the command could not be sent."""
+        import botocore.exceptions
+
+        self.attempts[pid] += 1
+        options = {}
+        if self.log_uri_template is not None:
+            options['log_uri'] = self.log_uri_template.format(pid=pid, attempt=self.attempts[pid])
+        try:
+            command_id = instance.run_command(
+                self.command_template.format(pid=pid), time_out_seconds=self.time_out_seconds, comment=pid, **options
+            )
+        except botocore.exceptions.ClientError as e:
+            _logger.error(f'Could not send the command for pid {pid} to {instance.instance_id}: {e}')
+            return None
+        _logger.info(f'Started command for pid {pid} on {instance.instance_id}, with cid {command_id}')
+        if 'log_uri' in options:
+            import iblaws.logs
+
+            self.logs[pid] = self._logs[command_id] = iblaws.logs.CommandLog(
+                iblaws.logs.log_source(options['log_uri']),
+                poll_interval=self.log_poll_interval,
+                stall_timeout=self.stall_timeout,
+                on_stall=lambda log: instance.cancel_command(command_id),
+            )
+        return command_id
+
+    def _follow(self, pid: str, log):
+        """Reads the new lines of the log of a command if due, which cancels the command if it stalled."""
+        previous = (log.step, log.progress)
+        try:
+            log.poll()
+        except Exception as e:
+            _logger.warning(f'Could not read the log of pid {pid}: {e}')
+            return
+        if log.progress is not None and (log.step, log.progress) != previous:
+            _logger.info(f'pid {pid}: {log.step or "progress"} {log.progress:.0%}')
+
+    def _report(self, pid: str, instance: InstanceManager, command_id: str, log) -> dict:
+        """Reads the summary printed by the command, see `iblaws.logs.report_line`, from its log or its SSM output."""
+        import iblaws.logs
+
+        try:
+            if log is not None:
+                # the summary is printed last, the final copy of the log is read to the end
+                log.poll(force=True, flush=True)
+                return log.report
+            invocation = instance.ssm.get_command_invocation(CommandId=command_id, InstanceId=instance.instance_id)
+            report = {}
+            for line in invocation.get('StandardOutputContent', '').splitlines():
+                report.update(iblaws.logs.parse_report(line))
+            return report
+        except Exception as e:
+            _logger.warning(f'Could not read the report of pid {pid}: {e}')
+            return {}
+
+    def _record(
+        self, pid: str, status: str, instance: InstanceManager, queued_at: float, dispatched_at: float, command_id: str, log=None
+    ):
+        if self.history is None:
+            return
+        run_seconds = time.time() - dispatched_at
+        try:
+            instance_type = instance.instance_type
+        except Exception as e:
+            _logger.warning(f'Could not get the type of {instance.instance_id}: {e}')
+            instance_type = None
+        timings = {'queue': dispatched_at - queued_at}
+        # the start and preparation of an instance is recorded with the first pid it runs
+        if getattr(instance, 'prepare_seconds', None) is not None and instance.instance_id not in self._prepared:
+            self._prepared.add(instance.instance_id)
+            timings['prepare'] = instance.prepare_seconds
+        # the phases measured by the command itself, and the size and duration of its recording
+        report = self._report(pid, instance, command_id, log)
+        for phase in iblaws.history.PHASES[1:]:
+            if phase in report:
+                timings[phase] = timings.get(phase, 0) + report[phase]
+        self.history.record(
+            pid,
+            status,
+            instance_type=instance_type,
+            timings=timings,
+            run_seconds=run_seconds,
+            data_bytes=report.get('data_bytes'),
+            recording_seconds=self.recording_seconds.get(pid, report.get('recording_seconds')),
+            started_at=dispatched_at,
         )
 
-        return InstanceManager(instance_id, instance_region, volume_id)
+    def _order(self, pids: list) -> list:
+        """Sorts the pids longest first according to the history, predicted for the type of the fleet if unique."""
+        if self.history is None:
+            return list(pids)
+        try:
+            instance_types = {instance.instance_type for instance in self.instances}
+        except Exception as e:
+            _logger.warning(f'Could not get the instance types: {e}')
+            instance_types = set()
+        instance_type = instance_types.pop() if len(instance_types) == 1 else None
+        ordered, self.predictions = self.history.order_longest_first(pids, instance_type, self.recording_seconds)
+        _logger.info(f'Predicted run time of the batch: {sum(p or 0 for p in self.predictions.values()) / 3600:.1f} hours')
+        return ordered
+
+    def _complete(self, pid: str, status: str, queue: deque, results: dict):
+        if status == 'Interrupted':
+            # the pid was not at fault: it resumes first, with the same retry budget
+            _logger.warning(f'Command for pid {pid} interrupted with its instance, re-queuing')
+            self.attempts[pid] -= 1
+            queue.appendleft(pid)
+        elif status == 'Success':
+            _logger.info(f'Command for pid {pid} completed successfully')
+            results[pid] = status
+        elif self.attempts[pid] <= self.max_retries:
+            _logger.warning(f'Command for pid {pid} status: {status}, re-queuing (attempt {self.attempts[pid]})')
+            queue.append(pid)
+        else:
+            _logger.error(f'Command for pid {pid} status: {status}, giving up after {self.attempts[pid]} attempts')
+            results[pid] = status
+
+    def run(self, pids: list) -> dict:
+        """
+        Runs all the pids and blocks until each one succeeded or exhausted its retries.
+
+        Args:
+            pids (list[str]): The probe insertion ids to process.
+
+        Returns:
+            dict: The final SSM command status for each pid, 'Success' or the status of the last failed attempt.
+        """
+        queue = deque(self._order(pids))
+        free = deque(self.instances)
+        running = {}  # future -> (pid, instance, dispatch time, command id)
+        replacing = {}  # future -> reclaimed instance
+        queued_at = dict.fromkeys(pids, time.time())
+        results = {}
+        for instance in self.instances:
+            self._watch(instance)
+        with ThreadPoolExecutor(max_workers=4, thread_name_prefix='replace') as executor:
+            while queue or running:
+                while queue and free:
+                    pid, instance = queue.popleft(), free.popleft()
+                    command_id = self._dispatch(pid, instance)
+                    if command_id is None:
+                        free.append(instance)
+                        self._complete(pid, 'Undeliverable', queue, results)
+                    else:
+                        expected_duration = self.predictions.get(pid) or self.expected_duration
+                        future = self._tracker(instance).track(command_id, instance.instance_id, expected_duration)
+                        running[future] = (pid, instance, time.time(), command_id)
+                if queue and not (free or running or replacing):
+                    _logger.error(f'No instance left to run {len(queue)} pids')
+                    results.update(dict.fromkeys(queue, 'Interrupted'))
+                    break
+                if running and not any(future.done() for future in running):
+                    delays = [tracker.next_poll_delay() for tracker in self._trackers.values()]
+                    delays += [watcher.next_poll_delay() for watcher in self._watchers.values()]
+                    delays += [self._logs[cid].next_poll_delay() for *_, cid in running.values() if cid in self._logs]
+                    time.sleep(min(delays))
+                    for tracker in self._trackers.values():
+                        tracker.poll()
+                    for pid, _, _, command_id in running.values():
+                        if command_id in self._logs:
+                            self._follow(pid, self._logs[command_id])
+                elif replacing and not running:
+                    wait(replacing, return_when=FIRST_COMPLETED)
+                for watcher in self._watchers.values():
+                    for instance_id in watcher.poll():
+                        instance = next(im for im in self.instances if im.instance_id == instance_id)
+                        self.instances.remove(instance)
+                        if instance in free:
+                            free.remove(instance)
+                        self._interrupt(instance, running)
+                        if self.replace is not None:
+                            replacing[executor.submit(self.replace, instance)] = instance
+                for future in [future for future in running if future.done()]:
+                    pid, instance, dispatched_at, command_id = running.pop(future)
+                    status = future.result()['Status']
+                    log = self._logs.pop(command_id, None)
+                    if status == 'Cancelled' and log is not None and log.stalled:
+                        status = 'Stalled'
+                    if instance in self.instances:
+                        free.append(instance)
+                    self._record(pid, status, instance, queued_at[pid], dispatched_at, command_id, log)
+                    # a re-queued pid waits from now on
+                    queued_at[pid] = time.time()
+                    self._complete(pid, status, queue, results)
+                for future in [future for future in replacing if future.done()]:
+                    if (replacement := self._adopt(future, replacing.pop(future))) is not None:
+                        free.append(replacement)
+        # the replacements that were still launching when the batch completed, for the caller to stop them
+        for future, reclaimed in replacing.items():
+            self._adopt(future, reclaimed)
+        return results
+
+    def _adopt(self, future, reclaimed: InstanceManager):
+        """Adds the replacement of a reclaimed instance to the fleet, returns None if it could not be launched."""
+        try:
+            replacement = future.result()
+        except Exception as e:
+            _logger.error(f'Could not replace the reclaimed instance {reclaimed.instance_id}: {e}')
+            return None
+        _logger.info(f'Replaced the reclaimed instance {reclaimed.instance_id} with {replacement.instance_id}')
+        self.instances.append(replacement)
+        self._watch(replacement)
+        return replacement
@@ -0,0 +1,240 @@
+"""
+Persistent history of the processing runs and runtime predictions.
+
+Each run of a pid is stored in a local SQLite database with its timings per phase (queue, prepare, sort, upload),
+the instance type it ran on, the size and duration of the recording and its outcome. The history predicts the
+runtime of a pid, which the `iblaws.compute.FleetScheduler` uses to dispatch the longest pids first.
+
+    history = RunHistory()
+    history.record('069c2674-80b0-44b4-a3d9-28337512967f', 'Success', instance_type='g6.4xlarge',
+                   timings={'queue': 12.0, 'sort': 3600.0, 'upload': 240.0}, recording_seconds=4500)
+    history.predict('069c2674-80b0-44b4-a3d9-28337512967f', instance_type='g6.4xlarge')
+"""
+
+import logging
+import os
+import sqlite3
+import statistics
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+_logger = logging.getLogger(__name__)
+
+HISTORY_PATH = Path(os.getenv('IBLAWS_HISTORY', Path.home().joinpath('.iblaws', 'history.sqlite')))
+PHASES = ('queue', 'prepare', 'sort', 'upload')
+SUCCESS = 'Success'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    pid TEXT NOT NULL,
+    status TEXT NOT NULL,
+    instance_type TEXT,
+    started_at REAL NOT NULL,
+    queue_seconds REAL,
+    prepare_seconds REAL,
+    sort_seconds REAL,
+    upload_seconds REAL,
+    run_seconds REAL,
+    data_bytes INTEGER,
+    recording_seconds REAL
+);
+CREATE INDEX IF NOT EXISTS runs_pid ON runs (pid);
+CREATE INDEX IF NOT EXISTS runs_instance_type ON runs (instance_type, status);
+"""
+
+
+@dataclass
+class RunRecord:
+    """A run of a pid, the durations are in seconds and None when unknown."""
+
+    id: int
+    pid: str
+    status: str
+    instance_type: Optional[str]
+    started_at: float
+    queue_seconds: Optional[float]
+    prepare_seconds: Optional[float]
+    sort_seconds: Optional[float]
+    upload_seconds: Optional[float]
+    run_seconds: Optional[float]  # from the dispatch to the end of the run, the queue excluded
+    data_bytes: Optional[int]
+    recording_seconds: Optional[float]
+
+
+class RunHistory:
+    """
+    SQLite store of the processing runs, safe to share between threads.
+
+    Parameters
+    ----------
+    path : str or Path
+        The database file, created if needed, ':memory:' for a transient store. Defaults to the `IBLAWS_HISTORY`
+        environment variable or ~/.iblaws/history.sqlite.
+    """
+
+    def __init__(self, path=HISTORY_PATH):
+        if str(path) != ':memory:':
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(path), check_same_thread=False)
+        with self._lock, self._connection:
+            if str(path) != ':memory:':
+                # several processes may record their runs in the same file
+                self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def record(
+        self,
+        pid: str,
+        status: str,
+        instance_type: Optional[str] = None,
+        timings: Optional[dict] = None,
+        run_seconds: Optional[float] = None,
+        data_bytes: Optional[int] = None,
+        recording_seconds: Optional[float] = None,
+        started_at: Optional[float] = None,
+    ) -> int:
+        """
+        Store a run.
+
+        Parameters
+        ----------
+        pid : str
+            The probe insertion ID.
+        status : str
+            The outcome, 'Success' or the failure status.
+        instance_type : str, optional
+            The machine the pid ran on, e.g. 'g6.4xlarge' or 'L4'.
+        timings : dict, optional
+            Seconds spent per phase, with keys among `PHASES`.
+        run_seconds : float, optional
+            Duration of the run, by default the sum of the timings of the phases but the queue.
+        data_bytes : int, optional
+            Size of the raw data.
+        recording_seconds : float, optional
+            Duration of the recording.
+        started_at : float, optional
+            Epoch time of the start of the run, now by default.
+
+        Returns
+        -------
+        int
+            The ID of the run record.
+        """
+        timings = timings or {}
+        if unknown := set(timings) - set(PHASES):
+            raise ValueError(f'Unknown phases {sorted(unknown)}, expected among {PHASES}')
+        if run_seconds is None and any(phase in timings for phase in PHASES[1:]):
+            run_seconds = sum(timings.get(phase, 0) for phase in PHASES[1:])
+        row = (
+            pid,
+            status,
+            instance_type,
+            time.time() if started_at is None else started_at,
+            *(timings.get(phase) for phase in PHASES),
+            run_seconds,
+            data_bytes,
+            recording_seconds,
+        )
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                'INSERT INTO runs (pid, status, instance_type, started_at, queue_seconds, prepare_seconds, sort_seconds, '
+                'upload_seconds, run_seconds, data_bytes, recording_seconds) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                row,
+            )
+        return cursor.lastrowid
+
+    def runs(self, pid: Optional[str] = None, instance_type: Optional[str] = None, status: Optional[str] = None) -> list:
+        """
+        Get the stored runs, oldest first, optionally filtered.
+
+        Returns
+        -------
+        list of RunRecord
+        """
+        filters = {'pid': pid, 'instance_type': instance_type, 'status': status}
+        clauses = [f'{column} = ?' for column, value in filters.items() if value is not None]
+        query = 'SELECT * FROM runs' + (f' WHERE {" AND ".join(clauses)}' if clauses else '') + ' ORDER BY id'
+        with self._lock:
+            rows = self._connection.execute(query, [value for value in filters.values() if value is not None]).fetchall()
+        return [RunRecord(*row) for row in rows]
+
+    def predict(
+        self, pid: str, instance_type: Optional[str] = None, recording_seconds: Optional[float] = None
+    ) -> Optional[float]:
+        """
+        Predict the run time of a pid from the successful runs, in order of preference:
+
+        - the median run time of the previous runs of this pid
+        - the recording duration times the median run time per recording second of the other runs
+        - the median run time of all the runs
+
+        The runs on the given instance type are used if there are some, all the runs otherwise.
+
+        Parameters
+        ----------
+        pid : str
+            The probe insertion ID.
+        instance_type : str, optional
+            The machine the pid will run on.
+        recording_seconds : float, optional
+            Duration of the recording, by default the one stored with a previous run of the pid.
+
+        Returns
+        -------
+        float or None
+            The predicted run time in seconds, None without any successful run in the history.
+        """
+        runs = [r for r in self.runs(status=SUCCESS) if r.run_seconds is not None]
+        if instance_type is not None and any(r.instance_type == instance_type for r in runs):
+            runs = [r for r in runs if r.instance_type == instance_type]
+        if not runs:
+            return None
+        if same_pid := [r.run_seconds for r in runs if r.pid == pid]:
+            return statistics.median(same_pid)
+        if recording_seconds is None:
+            recording_seconds = next((r.recording_seconds for r in reversed(self.runs(pid=pid)) if r.recording_seconds), None)
+        rates = [r.run_seconds / r.recording_seconds for r in runs if r.recording_seconds]
+        if recording_seconds and rates:
+            return statistics.median(rates) * recording_seconds
+        return statistics.median(r.run_seconds for r in runs)
+
+    def order_longest_first(
+        self, pids: list, instance_type: Optional[str] = None, recording_seconds: Optional[dict] = None
+    ) -> tuple:
+        """
+        Sort pids by decreasing predicted run time, the longest-processing-time-first heuristic.
+
+        The pids without prediction are given the median prediction of the others, and the ties keep their order.
+
+        Parameters
+        ----------
+        pids : list of str
+            The probe insertion IDs.
+        instance_type : str, optional
+            The machine the pids will run on.
+        recording_seconds : dict, optional
+            The duration of the recording of some of the pids.
+
+        Returns
+        -------
+        list of str
+            The sorted pids.
+        dict
+            The prediction of each pid, None when unknown.
+        """
+        recording_seconds = recording_seconds or {}
+        predictions = {pid: self.predict(pid, instance_type, recording_seconds.get(pid)) for pid in pids}
+        known = [p for p in predictions.values() if p is not None]
+        default = statistics.median(known) if known else 0
+        ordered = sorted(pids, key=lambda pid: default if predictions[pid] is None else predictions[pid], reverse=True)
+        return ordered, predictions
@@ -0,0 +1,230 @@
+"""
+Cached inventory of EC2 instances.
+
+The `InstanceInventory` answers questions about instances (state, IPs, type, tags, volumes) from a cache filled by
+bulk, paginated `describe_instances` calls. Records expire after a TTL and are invalidated explicitly after
+state-changing operations, see `invalidate`. One inventory is shared per EC2 client through `get_inventory`.
+
+    inventory = get_inventory(iblaws.utils.get_service_client(service_name='ec2', region_name='us-east-1'))
+    inventory.get('i-012bf17257acd3f96').state
+    inventory.select(tags={'Flottille': 'iblsorter'}, states=['running'])
+"""
+
+import datetime
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+_logger = logging.getLogger(__name__)
+
+_INVENTORIES_LOCK = threading.Lock()
+_INVENTORIES = {}
+
+
+@dataclass
+class InstanceRecord:
+    """Snapshot of an EC2 instance description."""
+
+    instance_id: str
+    state: str
+    instance_type: str
+    public_ip: Optional[str] = None
+    private_ip: Optional[str] = None
+    availability_zone: Optional[str] = None
+    launch_time: Optional[datetime.datetime] = None
+    tags: dict = field(default_factory=dict)
+    volumes: dict = field(default_factory=dict)  # device name -> volume id
+    fetched_at: float = 0.0
+    description: dict = field(default_factory=dict, repr=False)
+
+    @classmethod
+    def from_description(cls, description: dict, fetched_at: Optional[float] = None) -> 'InstanceRecord':
+        """Build a record from one instance of a `describe_instances` response."""
+        return cls(
+            instance_id=description['InstanceId'],
+            state=description['State']['Name'],
+            instance_type=description.get('InstanceType'),
+            public_ip=description.get('PublicIpAddress'),
+            private_ip=description.get('PrivateIpAddress'),
+            availability_zone=description.get('Placement', {}).get('AvailabilityZone'),
+            launch_time=description.get('LaunchTime'),
+            tags={tag['Key']: tag['Value'] for tag in description.get('Tags', [])},
+            volumes={
+                bdm['DeviceName']: bdm['Ebs']['VolumeId'] for bdm in description.get('BlockDeviceMappings', []) if 'Ebs' in bdm
+            },
+            fetched_at=time.monotonic() if fetched_at is None else fetched_at,
+            description=description,
+        )
+
+
+class InstanceInventory:
+    """
+    Thread-safe TTL cache of instance descriptions for one EC2 client.
+
+    Parameters
+    ----------
+    ec2_client : boto3.client
+        The Boto3 EC2 client used to interact with the AWS EC2 service.
+    ttl : float
+        Time in seconds after which a record is refreshed.
+    """
+
+    def __init__(self, ec2_client, ttl: float = 30):
+        self.ec2_client = ec2_client
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._records = {}  # instance_id -> InstanceRecord
+        self._queries = {}  # frozen filters -> (fetched_at, instance ids)
+
+    def _describe(self, **kwargs) -> list:
+        fetched_at = time.monotonic()
+        records = []
+        for page in self.ec2_client.get_paginator('describe_instances').paginate(**kwargs):
+            for reservation in page['Reservations']:
+                records.extend(InstanceRecord.from_description(i, fetched_at=fetched_at) for i in reservation['Instances'])
+        with self._lock:
+            self._records.update({record.instance_id: record for record in records})
+        return records
+
+    def refresh(self, instance_ids: Optional[list] = None, filters: Optional[list] = None) -> dict:
+        """
+        Describe instances and update the cache, in as many calls as there are result pages.
+
+        Parameters
+        ----------
+        instance_ids : list of str, optional
+            The IDs of the instances to describe, all the instances of the region if None.
+        filters : list of dict, optional
+            `describe_instances` filters.
+
+        Returns
+        -------
+        dict
+            Instance ID to `InstanceRecord` of the described instances.
+        """
+        kwargs = {}
+        if instance_ids is not None:
+            kwargs['InstanceIds'] = list(instance_ids)
+        if filters:
+            kwargs['Filters'] = filters
+        return {record.instance_id: record for record in self._describe(**kwargs)}
+
+    def _is_fresh(self, fetched_at: float, max_age: Optional[float]) -> bool:
+        return time.monotonic() - fetched_at < (self.ttl if max_age is None else max_age)
+
+    def get_many(self, instance_ids: list, max_age: Optional[float] = None) -> dict:
+        """
+        Get the records of several instances, the stale or missing ones are described in one bulk call.
+
+        Parameters
+        ----------
+        instance_ids : list of str
+            The IDs of the instances.
+        max_age : float, optional
+            Maximum age in seconds of the cached records, defaults to the TTL, 0 forces a refresh.
+
+        Returns
+        -------
+        dict
+            Instance ID to `InstanceRecord`.
+        """
+        with self._lock:
+            stale = [
+                i for i in instance_ids if i not in self._records or not self._is_fresh(self._records[i].fetched_at, max_age)
+            ]
+        if stale:
+            self.refresh(instance_ids=stale)
+        with self._lock:
+            return {i: self._records[i] for i in instance_ids if i in self._records}
+
+    def get(self, instance_id: str, max_age: Optional[float] = None) -> InstanceRecord:
+        """
+        Get the record of an instance, see `get_many`.
+
+        Raises
+        ------
+        KeyError
+            If the instance was not found.
+        """
+        records = self.get_many([instance_id], max_age=max_age)
+        if instance_id not in records:
+            raise KeyError(f'Instance {instance_id} not found')
+        return records[instance_id]
+
+    def select(self, tags: Optional[dict] = None, states: Optional[list] = None, max_age: Optional[float] = None) -> list:
+        """
+        List the instances with the given tags and states, the listing itself is cached for the TTL.
+
+        Parameters
+        ----------
+        tags : dict, optional
+            Tag key to value(s), for example {'Flottille': 'iblsorter'}.
+        states : list of str, optional
+            Instance states, for example ['stopped', 'running'].
+        max_age : float, optional
+            Maximum age in seconds of the cached listing, defaults to the TTL, 0 forces a refresh.
+
+        Returns
+        -------
+        list of InstanceRecord
+            The matching instances.
+        """
+        filters = []
+        for key, values in sorted((tags or {}).items()):
+            filters.append({'Name': f'tag:{key}', 'Values': [values] if isinstance(values, str) else list(values)})
+        if states:
+            filters.append({'Name': 'instance-state-name', 'Values': list(states)})
+        query = tuple((f['Name'], tuple(f['Values'])) for f in filters)
+        with self._lock:
+            cached = self._queries.get(query)
+            if cached is not None and self._is_fresh(cached[0], max_age):
+                instance_ids = cached[1]
+                if all(i in self._records for i in instance_ids):
+                    return [self._records[i] for i in instance_ids]
+        fetched_at = time.monotonic()
+        records = self._describe(Filters=filters) if filters else self._describe()
+        with self._lock:
+            self._queries[query] = (fetched_at, [record.instance_id for record in records])
+        return records
+
+    def invalidate(self, instance_ids: Optional[list] = None):
+        """Drop the cached records of the given instances, or of all instances, and all the cached listings."""
+        with self._lock:
+            if instance_ids is None:
+                self._records.clear()
+            else:
+                for instance_id in instance_ids:
+                    self._records.pop(instance_id, None)
+            self._queries.clear()
+
+
+def get_inventory(ec2_client, ttl: float = 30) -> InstanceInventory:
+    """
+    Get the inventory shared by all callers of this process for an EC2 client.
+
+    Parameters
+    ----------
+    ec2_client : boto3.client
+        The Boto3 EC2 client used to interact with the AWS EC2 service.
+    ttl : float
+        Time in seconds after which a record is refreshed, used when the inventory is first created.
+
+    Returns
+    -------
+    InstanceInventory
+        The shared inventory.
+    """
+    with _INVENTORIES_LOCK:
+        if ec2_client not in _INVENTORIES:
+            _INVENTORIES[ec2_client] = InstanceInventory(ec2_client, ttl=ttl)
+        return _INVENTORIES[ec2_client]
+
+
+def invalidate(ec2_client, instance_ids: Optional[list] = None):
+    """Invalidate instances in the shared inventory of a client after a state change, if the inventory exists."""
+    with _INVENTORIES_LOCK:
+        inventory = _INVENTORIES.get(ec2_client)
+    if inventory is not None:
+        inventory.invalidate(instance_ids)
@@ -0,0 +1,34 @@
+"""
+Deferred loading of the heavy dependencies.
+
+The iblaws modules import boto3, botocore, paramiko, pydantic, dotenv and requests inside the functions that use
+them, so that `import iblaws.compute` stays cheap for a worker that only needs the `manage_firewall_access`
+decorator. This module provides the pieces that cannot simply be moved into a function body.
+"""
+
+import functools
+import typing
+
+
+def validate_call(func):
+    """
+    Same as `pydantic.validate_call`, but pydantic is imported and the validator built on the first call.
+
+    Annotations naming pydantic types, imported under `typing.TYPE_CHECKING` in the calling module, are resolved
+    against the pydantic namespace at that point.
+    """
+    validated = None
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        nonlocal validated
+        if validated is None:
+            import pydantic
+
+            # pydantic exports its names lazily, so they are looked up one by one
+            names = [a for a in func.__annotations__.values() if isinstance(a, str) and hasattr(pydantic, a)]
+            func.__annotations__ = typing.get_type_hints(func, localns={name: getattr(pydantic, name) for name in names})
+            validated = pydantic.validate_call(func)
+        return validated(*args, **kwargs)
+
+    return wrapper
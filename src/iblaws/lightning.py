@@ -0,0 +1,233 @@
+"""
+Fan-out of spike sorting jobs over Lightning AI machines.
+
+The `JobFanOut` submits one `Studio.run_job` per pid with a cap on the number of jobs running at once. Each running
+job holds a worker id among `max_concurrency` ids, passed to its command, and registers its machine in the HTTPS
+prefix list as 'Lightning AI Worker #NN' for that id (see `iblaws.compute.FirewallLease`), so that the entries of the
+list match the running jobs. The statuses of all the jobs are checked in one loop, the failed jobs are resubmitted
+and a summary of the runs is written at the end.
+
+    from lightning_sdk import Studio
+    studio = Studio(name='muddy-emerald-fbcv 2xt1', org='IBL', teamspace='Spike Sorting')
+    fan_out = JobFanOut(studio, max_concurrency=16, summary_path='spike_sorting_summary.json')
+    results = fan_out.run(pids)
+"""
+
+import json
+import logging
+import time
+from collections import Counter, deque
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Optional
+
+import iblaws.history
+
+_logger = logging.getLogger(__name__)
+
+COMMAND_TEMPLATE = 'python spike_sort.py {pid} --worker-id {worker_id}'
+WORKER_DESCRIPTION = 'Lightning AI Worker #{worker_id:02}'
+# statuses of `lightning_sdk.Status` after which a job will not change anymore
+SUCCESS = 'Completed'
+TERMINAL_STATUSES = (SUCCESS, 'Failed', 'Stopped')
+
+
+def job_status(job) -> str:
+    """The status of a Lightning job as a string, e.g. 'Running' or 'Completed'."""
+    status = job.status
+    return getattr(status, 'name', str(status))
+
+
+@dataclass
+class JobRun:
+    """An attempt of a pid, the times are epoch seconds."""
+
+    pid: str
+    attempt: int
+    worker_id: int
+    name: str
+    status: str = 'Pending'
+    submitted_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    job: object = field(default=None, repr=False)
+
+    @property
+    def seconds(self) -> Optional[float]:
+        return None if self.finished_at is None else self.finished_at - self.submitted_at
+
+
+class JobFanOut:
+    """
+    Run a list of pids as Lightning jobs, at most `max_concurrency` at a time.
+
+    Parameters
+    ----------
+    studio : lightning_sdk.Studio
+        The studio the jobs are submitted from, anything with a `run_job(command, machine, name)` method returning a
+        job with a `status`.
+    machine : lightning_sdk.Machine, optional
+        The machine of the jobs, an L4 GPU by default.
+    command_template : str
+        The command of a job, formatted with `pid` and `worker_id`.
+    max_concurrency : int
+        Maximum number of jobs running at once, also the number of worker ids.
+    first_worker_id : int
+        The worker ids are `first_worker_id` to `first_worker_id + max_concurrency - 1`, distinct ranges keep the
+        prefix list entries of concurrent fan-outs apart.
+    max_retries : int
+        Number of times a failed pid is resubmitted before it is reported as failed.
+    poll_interval : float
+        Seconds between two checks of the job statuses.
+    history : iblaws.history.RunHistory, optional
+        Records the runs, with the machine as instance type.
+    summary_path : str or Path, optional
+        The JSON file the summary of the runs is written to at the end.
+    """
+
+    def __init__(
+        self,
+        studio,
+        machine=None,
+        command_template: str = COMMAND_TEMPLATE,
+        max_concurrency: int = 8,
+        first_worker_id: int = 1,
+        max_retries: int = 1,
+        poll_interval: float = 30,
+        history: Optional[iblaws.history.RunHistory] = None,
+        summary_path=None,
+    ):
+        self.studio = studio
+        self.machine = machine
+        self.command_template = command_template
+        self.max_concurrency = max_concurrency
+        self.first_worker_id = first_worker_id
+        self.max_retries = max_retries
+        self.poll_interval = poll_interval
+        self.history = history
+        self.summary_path = summary_path
+        self.attempts = Counter()
+        self.runs = []  # all the JobRun, in submission order
+
+    @property
+    def worker_ids(self) -> list:
+        return list(range(self.first_worker_id, self.first_worker_id + self.max_concurrency))
+
+    def _machine(self):
+        if self.machine is None:
+            from lightning_sdk import Machine
+
+            self.machine = Machine.L4
+        return self.machine
+
+    def _submit(self, pid: str, worker_id: int) -> JobRun:
+        """Submit a job for a pid, the run has the 'Undeliverable' status if the job could not be submitted."""
+        self.attempts[pid] += 1
+        run = JobRun(pid, self.attempts[pid], worker_id, name=f'{pid}-{self.attempts[pid]}')
+        self.runs.append(run)
+        try:
+            command = self.command_template.format(pid=pid, worker_id=worker_id)
+            run.job = self.studio.run_job(command=command, machine=self._machine(), name=run.name)
+        except Exception as e:
+            _logger.error(f'Could not submit the job of pid {pid}: {e}')
+            run.status, run.finished_at = 'Undeliverable', time.time()
+            return run
+        _logger.info(f'Submitted job {run.name} as {WORKER_DESCRIPTION.format(worker_id=worker_id)}')
+        return run
+
+    def _poll(self, running: dict) -> list:
+        """Update the status of the running jobs, returns the runs that completed."""
+        completed = []
+        for run in running.values():
+            try:
+                run.status = job_status(run.job)
+            except Exception as e:
+                _logger.warning(f'Could not get the status of job {run.name}: {e}')
+                continue
+            if run.status in TERMINAL_STATUSES:
+                run.finished_at = time.time()
+                completed.append(run)
+        return completed
+
+    def _complete(self, run: JobRun, queue: deque, results: dict):
+        if self.history is not None:
+            self.history.record(
+                run.pid,
+                'Success' if run.status == SUCCESS else run.status,
+                instance_type=getattr(self.machine, 'name', str(self.machine)),
+                run_seconds=run.seconds,
+                started_at=run.submitted_at,
+            )
+        if run.status == SUCCESS:
+            _logger.info(f'Job {run.name} completed')
+            results[run.pid] = run.status
+        elif self.attempts[run.pid] <= self.max_retries:
+            _logger.warning(f'Job {run.name} status: {run.status}, resubmitting')
+            queue.append(run.pid)
+        else:
+            _logger.error(f'Job {run.name} status: {run.status}, giving up after {self.attempts[run.pid]} attempts')
+            results[run.pid] = run.status
+
+    def run(self, pids: list) -> dict:
+        """
+        Run all the pids and block until each one completed or exhausted its retries.
+
+        Parameters
+        ----------
+        pids : list of str
+            The probe insertion IDs.
+
+        Returns
+        -------
+        dict
+            The final status of each pid, 'Completed' or the status of the last failed attempt.
+        """
+        queue, free = deque(pids), deque(self.worker_ids)
+        running = {}  # worker id -> JobRun
+        results = {}
+        while queue or running:
+            while queue and free:
+                run = self._submit(queue.popleft(), free.popleft())
+                if run.job is None:
+                    free.appendleft(run.worker_id)
+                    self._complete(run, queue, results)
+                else:
+                    running[run.worker_id] = run
+            if not running:
+                continue
+            time.sleep(self.poll_interval)
+            for run in self._poll(running):
+                # the next job with this worker id replaces the prefix list entry if this one left it behind
+                free.append(running.pop(run.worker_id).worker_id)
+                self._complete(run, queue, results)
+        _logger.info(f'{sum(s == SUCCESS for s in results.values())}/{len(results)} pids completed')
+        if self.summary_path is not None:
+            self.write_summary(self.summary_path)
+        return results
+
+    def summary(self) -> dict:
+        """
+        Summarize the runs.
+
+        Returns
+        -------
+        dict
+            The count of pids per final status, the total job time, and per pid the final status and the attempts
+            with their job name, worker id, status and duration.
+        """
+        pids = {}
+        for run in self.runs:
+            entry = pids.setdefault(run.pid, {'status': None, 'attempts': []})
+            entry['status'] = run.status
+            attempt = {k: v for k, v in asdict(run).items() if k not in ('pid', 'job')}
+            entry['attempts'].append({**attempt, 'seconds': run.seconds})
+        return {
+            'statuses': dict(Counter(entry['status'] for entry in pids.values())),
+            'job_seconds': sum(run.seconds or 0 for run in self.runs),
+            'pids': pids,
+        }
+
+    def write_summary(self, path) -> Path:
+        path = Path(path)
+        path.write_text(json.dumps(self.summary(), indent=2))
+        _logger.info(f'Summary written to {path}')
+        return path
@@ -0,0 +1,294 @@
+"""
+Incremental streaming of the output of the SSM commands.
+
+SSM only returns the first 24,000 characters of the output of a command, once it has completed. A command wrapped
+with `stream_command` tees its output to a log file that is copied to S3 (or to a local path) every few seconds
+while it runs. As the log only grows, the `CommandLog` reads the new bytes with a byte-range request at each poll,
+splits them in lines, parses the progress bars of the sorter and calls a function when the output stalls, for
+example to cancel the command long before its execution timeout. The command can print a summary of its run, such
+as the duration of its phases and the size of its data, with `report_line`, collected in `CommandLog.report`.
+
+    command_id = im.run_command('/home/ubuntu/entrypoint.sh {pid}', log_uri=f's3://my-bucket/logs/{pid}.log')
+    log = CommandLog(log_source(f's3://my-bucket/logs/{pid}.log'), stall_timeout=900,
+                     on_stall=lambda log: im.cancel_command(command_id))
+    for event in log.events(done=future.done):
+        print(event.step, event.progress, event.line)
+"""
+
+import logging
+import re
+import shlex
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Optional
+
+import iblaws.utils
+
+_logger = logging.getLogger(__name__)
+
+# tqdm progress bars, for example 'Extracting spikes:  45%|████▌     | 450/1000 [01:02<01:16,  7.2it/s]'
+PROGRESS_PATTERN = re.compile(r'(?P<step>[^|]*?):?\s*(?P<percent>\d{1,3}(?:\.\d+)?)%\|')
+# summary of its run printed by the command, for example 'iblaws-report sort=3600.0 upload=240.0 data_bytes=123456789'
+REPORT_PATTERN = re.compile(r'\biblaws-report((?:\s+\w+=\S+)+)')
+# tqdm redraws its bars with carriage returns
+LINE_BREAK = re.compile(rb'\r\n|\r|\n')
+UPLOAD_INTERVAL = 15
+
+_STREAM_SCRIPT = """log=$(mktemp)
+(while sleep {interval}; do {copy} "$log" {uri}; done) &
+uploader=$!
+# the local copies of the log are removed on exit, also when the command is cancelled
+trap 'kill $uploader 2>/dev/null; rm -f "$log" "$log.status"' EXIT
+trap 'exit 143' HUP INT TERM
+{{ ( {command} ) 2>&1; echo $? > "$log.status"; }} | tee "$log"
+kill $uploader 2>/dev/null
+{copy} "$log" {uri}
+exit $(cat "$log.status")"""
+
+
+def stream_command(command: str, log_uri: str, interval: float = UPLOAD_INTERVAL) -> str:
+    """
+    Wrap a shell command so that its output is copied to a log while it runs, the exit status is kept.
+
+    Parameters
+    ----------
+    command : str
+        The shell command.
+    log_uri : str
+        's3://bucket/key' of the log, or a local path on the instance.
+    interval : float
+        Seconds between two copies of the log.
+
+    Returns
+    -------
+    str
+        The wrapped command.
+    """
+    copy = 'aws s3 cp --only-show-errors' if log_uri.startswith('s3://') else 'cp'
+    return _STREAM_SCRIPT.format(interval=interval, copy=copy, uri=shlex.quote(log_uri), command=command)
+
+
+class S3LogSource:
+    """Read a log object from a byte offset, with a byte-range request."""
+
+    def __init__(self, s3_client, bucket: str, key: str):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+
+    def read(self, offset: int) -> bytes:
+        import botocore.exceptions
+
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key, Range=f'bytes={offset}-')
+        except botocore.exceptions.ClientError as e:
+            # the log is not uploaded yet, or has no new bytes
+            if e.response['Error']['Code'] in ('NoSuchKey', 'InvalidRange'):
+                return b''
+            raise
+        return response['Body'].read()
+
+
+class LocalLogSource:
+    """Read a local log file from a byte offset, the stand-in of `S3LogSource`."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def read(self, offset: int) -> bytes:
+        try:
+            with open(self.path, 'rb') as fp:
+                fp.seek(offset)
+                return fp.read()
+        except FileNotFoundError:
+            return b''
+
+
+def log_source(log_uri: str, s3_client=None):
+    """Get the source of a log from its 's3://bucket/key' URI or local path."""
+    if not log_uri.startswith('s3://'):
+        return LocalLogSource(log_uri)
+    bucket, key = log_uri[len('s3://') :].split('/', 1)
+    s3_client = s3_client or iblaws.utils.get_service_client(service_name='s3')
+    return S3LogSource(s3_client, bucket, key)
+
+
+def parse_progress(line: str, pattern: re.Pattern = PROGRESS_PATTERN) -> Optional[tuple]:
+    """
+    Parse a progress bar.
+
+    Returns
+    -------
+    (str, float) or None
+        The step, empty if the bar has no description, and its progress between 0 and 1, None if the line is not a
+        progress bar.
+    """
+    if (match := pattern.search(line)) is None:
+        return None
+    return match.group('step').strip(), float(match.group('percent')) / 100
+
+
+def report_line(**values) -> str:
+    """
+    Format the summary of a run for the command output, the values that are None are omitted.
+
+        print(report_line(sort=3600.0, upload=240.0, data_bytes=123456789), flush=True)
+    """
+    return 'iblaws-report ' + ' '.join(f'{key}={value}' for key, value in values.items() if value is not None)
+
+
+def parse_report(line: str) -> dict:
+    """
+    Parse a summary line written by `report_line`.
+
+    Returns
+    -------
+    dict
+        The numeric values of the summary, empty if the line is not a summary.
+    """
+    if (match := REPORT_PATTERN.search(line)) is None:
+        return {}
+    report = {}
+    for item in match.group(1).split():
+        key, value = item.split('=', 1)
+        try:
+            report[key] = int(value) if value.isdigit() else float(value)
+        except ValueError:
+            continue
+    return report
+
+
+@dataclass
+class LogEvent:
+    """A line of the output, with the progress it reports if it is a progress bar."""
+
+    line: str
+    time: float = field(default_factory=time.time)
+    step: Optional[str] = None
+    progress: Optional[float] = None
+
+
+class CommandLog:
+    """
+    Incremental tail of the log of a command.
+
+    Parameters
+    ----------
+    source : S3LogSource or LocalLogSource
+        The log.
+    poll_interval : float
+        Seconds between two reads of the log.
+    stall_timeout : float, optional
+        Seconds without new output after which the command is considered stalled, well above the copy interval.
+    on_stall : callable, optional
+        Called with the `CommandLog` once, when the command stalls.
+    pattern : re.Pattern
+        The progress bars, with `step` and `percent` groups.
+    max_lines : int
+        Number of last lines kept in `lines`.
+    """
+
+    def __init__(
+        self,
+        source,
+        poll_interval: float = UPLOAD_INTERVAL,
+        stall_timeout: Optional[float] = None,
+        on_stall: Optional[Callable] = None,
+        pattern: re.Pattern = PROGRESS_PATTERN,
+        max_lines: int = 100,
+    ):
+        self.source = source
+        self.poll_interval = poll_interval
+        self.stall_timeout = stall_timeout
+        self.on_stall = on_stall
+        self.pattern = pattern
+        self.offset = 0
+        self.lines = deque(maxlen=max_lines)
+        self.step = None
+        self.progress = None
+        self.stalled = False
+        self.report = {}  # the summary printed by the command, see `report_line`
+        self.last_output = time.monotonic()
+        self._next_poll = 0.0
+        self._partial = b''
+
+    def next_poll_delay(self) -> float:
+        """Seconds until the next read of the log is due."""
+        return max(0.0, self._next_poll - time.monotonic())
+
+    def _event(self, raw: bytes) -> LogEvent:
+        event = LogEvent(raw.decode(errors='replace'))
+        if (progress := parse_progress(event.line, self.pattern)) is not None:
+            event.step, event.progress = progress
+            self.step, self.progress = progress
+        self.report.update(parse_report(event.line))
+        self.lines.append(event.line)
+        return event
+
+    def poll(self, force: bool = False, flush: bool = False) -> list:
+        """
+        Read the new bytes of the log if a read is due.
+
+        Parameters
+        ----------
+        force : bool
+            Read regardless of the schedule.
+        flush : bool
+            Also return the last line if it is incomplete, once the command has completed.
+
+        Returns
+        -------
+        list of LogEvent
+            The new lines, the blank ones omitted.
+        """
+        now = time.monotonic()
+        if not force and now < self._next_poll:
+            return []
+        self._next_poll = now + self.poll_interval
+        data = self.source.read(self.offset)
+        if data:
+            self.offset += len(data)
+            self.last_output = now
+        *complete, self._partial = LINE_BREAK.split(self._partial + data)
+        if flush:
+            complete, self._partial = complete + [self._partial], b''
+        events = [self._event(raw) for raw in complete if raw.strip()]
+        if self.stall_timeout is not None and not self.stalled and now - self.last_output > self.stall_timeout:
+            self.stalled = True
+            _logger.warning(f'No output for {now - self.last_output:.0f} s, last lines: {list(self.lines)[-3:]}')
+            if self.on_stall is not None:
+                self.on_stall(self)
+        return events
+
+    def events(self, done: Callable[[], bool]):
+        """
+        Generate the lines of the log as they are copied, until the command has completed.
+
+        Parameters
+        ----------
+        done : callable
+            Returns True once the command has completed, for example the `done` method of the future returned by
+            `iblaws.commands.CommandTracker.track`.
+
+        Yields
+        ------
+        LogEvent
+        """
+        while not done():
+            yield from self.poll()
+            time.sleep(self.next_poll_delay())
+        # the final copy of the log is made before the command exits
+        yield from self.poll(force=True, flush=True)
+
+    async def aevents(self, done: Callable[[], bool]):
+        """The asynchronous version of `events`, the reads run in a thread."""
+        import asyncio
+
+        while not done():
+            for event in await asyncio.to_thread(self.poll):
+                yield event
+            await asyncio.sleep(self.next_poll_delay())
+        for event in await asyncio.to_thread(self.poll, True, True):
+            yield event
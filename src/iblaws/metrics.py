@@ -0,0 +1,276 @@
+"""
+Opt-in instrumentation of the AWS API calls and of the high-level provisioning steps.
+
+Every client created by `iblaws.utils.get_service_client` carries botocore event hooks that, once the metrics are
+enabled, record per (service, operation, region) the number of calls, errors, retries and throttling errors and a
+latency histogram, along with the throttled attempts and the waits of the client-side rate limiter, see
+`iblaws.throttle`. The `span` context manager times the higher-level steps, for example the start of an instance.
+Nothing is recorded until `enable` is called or the `IBLAWS_METRICS` environment variable is set to 1.
+
+    iblaws.metrics.enable()
+    im.start_and_prepare_instance()
+    print(iblaws.metrics.to_prometheus())
+    Path('metrics.json').write_text(iblaws.metrics.to_json())
+"""
+
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+_logger = logging.getLogger(__name__)
+
+# upper bounds in seconds of the latency histogram buckets, from a fast API call to an instance start
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, float('inf'))
+# error codes returned by the AWS APIs when a request is throttled
+THROTTLING_ERROR_CODES = (
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    'SlowDown',
+)
+
+_LOCK = threading.Lock()
+_CALLS = {}  # (service, operation, region) -> _CallStats
+_SPANS = {}  # span name -> _Histogram
+_ENABLED = os.getenv('IBLAWS_METRICS', '0') == '1'
+_START_TIME_KEY = 'iblaws_metrics_t0'
+
+
+@dataclass
+class _Histogram:
+    counts: list = field(default_factory=lambda: [0] * len(BUCKETS))
+    total: float = 0.0
+    count: int = 0
+
+    def observe(self, value: float):
+        self.counts[next(i for i, bound in enumerate(BUCKETS) if value <= bound)] += 1
+        self.total += value
+        self.count += 1
+
+    def to_dict(self) -> dict:
+        return {'count': self.count, 'sum': self.total, 'buckets': dict(zip(map(_format_bound, BUCKETS), self.counts))}
+
+
+@dataclass
+class _CallStats:
+    calls: int = 0
+    errors: int = 0
+    retries: int = 0
+    throttles: int = 0
+    throttled_attempts: int = 0
+    rate_limited: int = 0
+    rate_limit_wait_seconds: float = 0.0
+    latency: _Histogram = field(default_factory=_Histogram)
+
+
+def _format_bound(bound: float) -> str:
+    return '+Inf' if bound == float('inf') else f'{bound:g}'
+
+
+def enable():
+    """Start recording the API calls of all the instrumented clients and the spans."""
+    global _ENABLED
+    _ENABLED = True
+
+
+def disable():
+    """Stop recording, the metrics recorded so far are kept."""
+    global _ENABLED
+    _ENABLED = False
+
+
+def is_enabled() -> bool:
+    return _ENABLED
+
+
+def reset():
+    """Drop all the recorded metrics."""
+    with _LOCK:
+        _CALLS.clear()
+        _SPANS.clear()
+
+
+def _record_call(key: tuple, latency: float, retries: int = 0, error_code: Optional[str] = None):
+    with _LOCK:
+        stats = _CALLS.setdefault(key, _CallStats())
+        stats.calls += 1
+        stats.retries += retries
+        stats.latency.observe(latency)
+        if error_code is not None:
+            stats.errors += 1
+            stats.throttles += error_code in THROTTLING_ERROR_CODES
+
+
+def record_throttled_attempt(key: tuple):
+    """Count an attempt of a call throttled by AWS, whether it is retried or not."""
+    if not _ENABLED:
+        return
+    with _LOCK:
+        _CALLS.setdefault(key, _CallStats()).throttled_attempts += 1
+
+
+def record_rate_limit_wait(key: tuple, seconds: float):
+    """Count an attempt of a call delayed by the client-side rate limiter."""
+    if not _ENABLED:
+        return
+    with _LOCK:
+        stats = _CALLS.setdefault(key, _CallStats())
+        stats.rate_limited += 1
+        stats.rate_limit_wait_seconds += seconds
+
+
+def instrument(client):
+    """
+    Register the event hooks recording the API calls of a boto3 client.
+
+    The hooks are cheap no-ops while the metrics are disabled, so that they can be attached to every client.
+
+    Parameters
+    ----------
+    client : botocore.client.BaseClient
+        The client to instrument.
+
+    Returns
+    -------
+    botocore.client.BaseClient
+        The same client.
+    """
+    service = client.meta.service_model.service_name
+    region = client.meta.region_name
+
+    def before_call(context, **kwargs):
+        if _ENABLED:
+            context[_START_TIME_KEY] = time.perf_counter()
+
+    def after_call(parsed, model, context, **kwargs):
+        if _START_TIME_KEY not in context:
+            return
+        metadata = parsed.get('ResponseMetadata', {})
+        error_code = parsed.get('Error', {}).get('Code') if 'Error' in parsed else None
+        latency = time.perf_counter() - context.pop(_START_TIME_KEY)
+        _record_call((service, model.name, region), latency, metadata.get('RetryAttempts', 0), error_code)
+
+    def after_call_error(exception, context, event_name, **kwargs):
+        # raised before any response was parsed, for example on a connection error
+        if _START_TIME_KEY not in context:
+            return
+        latency = time.perf_counter() - context.pop(_START_TIME_KEY)
+        _record_call((service, event_name.split('.')[-1], region), latency, error_code=type(exception).__name__)
+
+    client.meta.events.register('before-call.*.*', before_call, unique_id='iblaws-metrics-before-call')
+    client.meta.events.register('after-call.*.*', after_call, unique_id='iblaws-metrics-after-call')
+    client.meta.events.register('after-call-error.*.*', after_call_error, unique_id='iblaws-metrics-after-call-error')
+    return client
+
+
+@contextlib.contextmanager
+def span(name: str):
+    """
+    Time a block of code, recorded in the span histogram of this name whether the block succeeds or not.
+
+        with iblaws.metrics.span('start_and_prepare_instance.prepare_instance'):
+            ...
+    """
+    if not _ENABLED:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - t0
+        with _LOCK:
+            _SPANS.setdefault(name, _Histogram()).observe(duration)
+        _logger.debug(f'{name}: {duration:.3f} s')
+
+
+def snapshot() -> dict:
+    """
+    Get a copy of the recorded metrics.
+
+    Returns
+    -------
+    dict
+        Key `calls`: list of dicts with keys `service`, `operation`, `region`, `calls`, `errors`, `retries`,
+        `throttles`, `throttled_attempts`, `rate_limited`, `rate_limit_wait_seconds` and `latency`, a histogram with
+        keys `count`, `sum` and `buckets`, the non-cumulative count per bucket upper bound.
+        Key `spans`: dict of span name to histogram.
+    """
+    with _LOCK:
+        calls = [
+            {
+                'service': service,
+                'operation': operation,
+                'region': region,
+                'calls': stats.calls,
+                'errors': stats.errors,
+                'retries': stats.retries,
+                'throttles': stats.throttles,
+                'throttled_attempts': stats.throttled_attempts,
+                'rate_limited': stats.rate_limited,
+                'rate_limit_wait_seconds': stats.rate_limit_wait_seconds,
+                'latency': stats.latency.to_dict(),
+            }
+            for (service, operation, region), stats in sorted(_CALLS.items(), key=lambda item: tuple(map(str, item[0])))
+        ]
+        spans = {name: histogram.to_dict() for name, histogram in sorted(_SPANS.items())}
+    return {'calls': calls, 'spans': spans}
+
+
+def to_json(**kwargs) -> str:
+    """Export the recorded metrics as JSON, keyword arguments are passed to `json.dumps`."""
+    return json.dumps(snapshot(), **kwargs)
+
+
+def _labels(**labels) -> str:
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in labels.values())
+    return ','.join(f'{k}="{v}"' for k, v in zip(labels, escaped))
+
+
+def _prometheus_histogram(name: str, labels: dict, histogram: dict) -> list:
+    lines, cumulative = [], 0
+    for bound, count in histogram['buckets'].items():
+        cumulative += count
+        lines.append(f'{name}_bucket{{{_labels(**labels, le=bound)}}} {cumulative}')
+    lines.append(f'{name}_sum{{{_labels(**labels)}}} {histogram["sum"]}')
+    lines.append(f'{name}_count{{{_labels(**labels)}}} {histogram["count"]}')
+    return lines
+
+
+def to_prometheus() -> str:
+    """Export the recorded metrics in the Prometheus text exposition format."""
+    metrics = snapshot()
+    lines = []
+    for counter, help_text in (
+        ('calls', 'AWS API calls'),
+        ('errors', 'AWS API calls that returned an error'),
+        ('retries', 'Retries made by botocore'),
+        ('throttles', 'AWS API calls that were throttled'),
+        ('throttled_attempts', 'Attempts of AWS API calls that were throttled, retried or not'),
+        ('rate_limited', 'Attempts of AWS API calls delayed by the client-side rate limiter'),
+        ('rate_limit_wait_seconds', 'Time spent waiting for the client-side rate limiter'),
+    ):
+        lines += [f'# HELP iblaws_aws_api_{counter}_total {help_text}', f'# TYPE iblaws_aws_api_{counter}_total counter']
+        for call in metrics['calls']:
+            labels = _labels(service=call['service'], operation=call['operation'], region=call['region'])
+            lines.append(f'iblaws_aws_api_{counter}_total{{{labels}}} {call[counter]}')
+    lines += ['# HELP iblaws_aws_api_latency_seconds AWS API call latency', '# TYPE iblaws_aws_api_latency_seconds histogram']
+    for call in metrics['calls']:
+        labels = {'service': call['service'], 'operation': call['operation'], 'region': call['region']}
+        lines += _prometheus_histogram('iblaws_aws_api_latency_seconds', labels, call['latency'])
+    lines += [
+        '# HELP iblaws_span_duration_seconds Duration of the provisioning steps',
+        '# TYPE iblaws_span_duration_seconds histogram',
+    ]
+    for name, histogram in metrics['spans'].items():
+        lines += _prometheus_histogram('iblaws_span_duration_seconds', {'span': name}, histogram)
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,508 @@
+"""
+Coalescing writer for EC2 managed prefix lists.
+
+A managed prefix list accepts a single modification per version: concurrent `modify_managed_prefix_list` calls
+race on `CurrentVersion` and all but one fail. The `PrefixListWriter` queues add / remove / replace intents from
+any number of threads, merges all pending intents into one modification with both `AddEntries` and `RemoveEntries`,
+and retries on version conflicts with a jittered backoff.
+
+    ec2 = iblaws.utils.get_service_client(service_name='ec2', region_name='eu-west-2')
+    writer = get_prefix_list_writer(ec2, 'pl-0be82b42e37cbc052')
+    writer.replace('Lightning AI Worker #07', '123.45.67.89/32')
+    writer.remove('Lightning AI Worker #07')
+
+Entries can carry a lease expiry in their description, see `lease_description`. Expired entries, for example left
+behind by a crashed worker, are removed in one modification by `PrefixListWriter.sweep`, and the `PrefixListPool`
+spreads leases over several prefix lists within a budget:
+
+    pool = PrefixListPool(ec2, ['pl-0be82b42e37cbc052', 'pl-0123456789abcdef0'], ttl=3600, budget=64)
+    pool.lease('Lightning AI Worker #07', '123.45.67.89/32')
+"""
+
+import logging
+import random
+import re
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Optional
+
+from iblaws.lazy import validate_call
+
+if TYPE_CHECKING:
+    from pydantic import IPvAnyInterface
+
+_logger = logging.getLogger(__name__)
+
+# error codes returned by modify_managed_prefix_list when another writer modified the list first
+VERSION_CONFLICT_ERROR_CODES = ('IncorrectState', 'PrefixListVersionMismatch')
+
+_WRITERS_LOCK = threading.Lock()
+_WRITERS = {}
+
+# suffix of the description of the entries that expire, with the expiry as a UNIX timestamp
+_EXPIRY_PATTERN = re.compile(r'^(?P<description>.*) \[exp=(?P<expires>\d+)\]$')
+
+
+class PrefixListCapacityError(RuntimeError):
+    """Raised when no prefix list of a pool has room for a new entry, or when the pool budget is spent."""
+
+
+def lease_description(description: str, expires: float) -> str:
+    """Append the expiry timestamp to an entry description, e.g. 'Lightning AI Worker #07 [exp=1760000000]'."""
+    return f'{description} [exp={int(expires)}]'
+
+
+def parse_description(description: str) -> tuple:
+    """
+    Split an entry description into its base description and its expiry.
+
+    Returns
+    -------
+    str
+        The description without the expiry suffix.
+    int or None
+        The expiry as a UNIX timestamp, None if the entry does not expire.
+    """
+    match = _EXPIRY_PATTERN.match(description or '')
+    if match is None:
+        return description, None
+    return match['description'], int(match['expires'])
+
+
+def _is_expired(description: str, now: float) -> bool:
+    expires = parse_description(description)[1]
+    return expires is not None and expires <= now
+
+
+@dataclass
+class _Intent:
+    action: str  # one of 'add', 'remove', 'replace', 'sweep'
+    description: str
+    cidr: Optional[str] = None
+    ignore_errors: bool = False
+    future: Future = field(default_factory=Future)
+
+
+def _plan(entries: list, intents: list, now: Optional[float] = None) -> tuple:
+    """
+    Merge a batch of intents against the current entries of a prefix list.
+
+    Descriptions are compared without their expiry suffix, so that replacing an entry renews its lease.
+
+    Parameters
+    ----------
+    entries : list of dict
+        The current entries of the list, as returned by `get_managed_prefix_list_entries`.
+    intents : list of _Intent
+        The intents to apply, in submission order.
+    now : float, optional
+        The UNIX time against which the expiry of the entries is checked by 'sweep' intents.
+
+    Returns
+    -------
+    list of dict
+        The `AddEntries` argument of the modification.
+    list of dict
+        The `RemoveEntries` argument of the modification.
+    dict
+        Intent index to exception for the intents that could not be applied, they do not contribute to the diff.
+    """
+    now = time.time() if now is None else now
+    initial = {e['Cidr']: e['Description'] for e in entries}
+    state = dict(initial)
+    errors = {}
+    for i, intent in enumerate(intents):
+        if intent.action == 'sweep':
+            for cidr in [cidr for cidr, description in state.items() if _is_expired(description, now)]:
+                state.pop(cidr)
+            continue
+        base = parse_description(intent.description)[0]
+        cidrs = [cidr for cidr, description in state.items() if parse_description(description)[0] == base]
+        if intent.action == 'add' and cidrs:
+            errors[i] = ValueError(
+                f'The description "{intent.description}" already exists. Please choose a different description.'
+            )
+            continue
+        if intent.action == 'remove' and not cidrs:
+            if not intent.ignore_errors:
+                errors[i] = ValueError(f'The description "{intent.description}" was not found in the existing entries.')
+            continue
+        if intent.action in ('add', 'replace') and parse_description(state.get(intent.cidr, intent.description))[0] != base:
+            errors[i] = ValueError(f'The CIDR {intent.cidr} is already registered as "{state[intent.cidr]}".')
+            continue
+        for cidr in cidrs:
+            state.pop(cidr)
+        if intent.action in ('add', 'replace'):
+            state[intent.cidr] = intent.description
+    # a CIDR that is kept with a new description is only added: adding an existing CIDR updates its description
+    add_entries = [{'Cidr': cidr, 'Description': d} for cidr, d in state.items() if initial.get(cidr) != d]
+    remove_entries = [{'Cidr': cidr} for cidr in initial if cidr not in state]
+    return add_entries, remove_entries, errors
+
+
+def _get_entries(ec2_client, managed_prefix_list_id: str, version: Optional[int] = None) -> list:
+    """Get all the entries of a prefix list, at a given version if specified."""
+    entries, kwargs = [], {'PrefixListId': managed_prefix_list_id}
+    if version is not None:
+        kwargs['TargetVersion'] = version
+    while True:
+        response = ec2_client.get_managed_prefix_list_entries(**kwargs)
+        entries.extend(response.get('Entries', []))
+        if not response.get('NextToken'):
+            return entries
+        kwargs['NextToken'] = response['NextToken']
+
+
+class PrefixListWriter:
+    """
+    Thread-safe writer that coalesces modifications of one managed prefix list.
+
+    There is no background thread: the first caller that finds the writer idle flushes the queue, including the
+    intents submitted by other threads while it was busy, and every caller then waits on its own future.
+
+    Parameters
+    ----------
+    ec2_client : boto3.client
+        The Boto3 EC2 client used to interact with the AWS EC2 service.
+    managed_prefix_list_id : str
+        The ID of the managed prefix list.
+    linger : float
+        Seconds to wait before flushing, to give concurrent callers a chance to join the same modification.
+    max_attempts : int
+        Number of modification attempts on version conflicts before giving up.
+    backoff : float
+        Base delay in seconds of the jittered exponential backoff between attempts.
+    max_backoff : float
+        Maximum delay in seconds between attempts.
+    poll_interval : float
+        Delay in seconds between two checks of the list state while a modification is in progress.
+    """
+
+    def __init__(
+        self,
+        ec2_client,
+        managed_prefix_list_id: str,
+        linger: float = 0.0,
+        max_attempts: int = 20,
+        backoff: float = 0.2,
+        max_backoff: float = 5.0,
+        poll_interval: float = 0.2,
+    ):
+        self.ec2_client = ec2_client
+        self.managed_prefix_list_id = managed_prefix_list_id
+        self.linger = linger
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._pending = []
+        self._flushing = False
+
+    @validate_call
+    def add(self, description: str, cidrip: 'IPvAnyInterface', wait: bool = True):
+        """Add an entry, fails with ValueError if the description already exists."""
+        return self._wait(self.submit('add', description, cidrip=str(cidrip)), wait)
+
+    @validate_call
+    def remove(self, description: str, ignore_errors: bool = False, wait: bool = True):
+        """Remove all entries with this description, fails with ValueError if there is none unless `ignore_errors`."""
+        return self._wait(self.submit('remove', description, ignore_errors=ignore_errors), wait)
+
+    @validate_call
+    def replace(self, description: str, cidrip: 'IPvAnyInterface', wait: bool = True):
+        """Remove the entries with this description if any and add the new one, in a single modification."""
+        return self._wait(self.submit('replace', description, cidrip=str(cidrip)), wait)
+
+    def sweep(self, wait: bool = True):
+        """Remove all the entries whose lease expired, in a single modification."""
+        return self._wait(self.submit('sweep', ''), wait)
+
+    @staticmethod
+    def _wait(future: Future, wait: bool):
+        return future.result() if wait else future
+
+    def submit(self, action: str, description: str, cidrip: Optional[str] = None, ignore_errors: bool = False) -> Future:
+        """
+        Queue an intent and flush the queue if no other thread is doing so.
+
+        Parameters
+        ----------
+        action : str
+            One of 'add', 'remove', 'replace' or 'sweep'.
+        description : str
+            The description of the entry.
+        cidrip : str, optional
+            The CIDR block, required for 'add' and 'replace'.
+        ignore_errors : bool
+            For 'remove', do not fail if the description does not exist.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves to the version of the prefix list that contains the change.
+        """
+        return self.submit_many([(action, description, cidrip, ignore_errors)])[0]
+
+    def submit_many(self, intents: list) -> list:
+        """
+        Queue several intents at once so that they are applied in the same modification.
+
+        Parameters
+        ----------
+        intents : list of tuple
+            (action, description, cidrip, ignore_errors) tuples, the last two items are optional.
+
+        Returns
+        -------
+        list of concurrent.futures.Future
+            One future per intent, as returned by `submit`.
+        """
+        batch = [_Intent(*intent) for intent in intents]
+        for intent in batch:
+            if intent.action not in ('add', 'remove', 'replace', 'sweep'):
+                raise ValueError(f'Unknown prefix list action "{intent.action}"')
+            if intent.action in ('add', 'replace') and intent.cidr is None:
+                raise ValueError(f'A CIDR block is required to {intent.action} "{intent.description}"')
+        with self._lock:
+            self._pending.extend(batch)
+            if self._flushing:
+                return [intent.future for intent in batch]
+            self._flushing = True
+        self._flush()
+        return [intent.future for intent in batch]
+
+    def _flush(self):
+        if self.linger > 0:
+            time.sleep(self.linger)
+        while True:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                if not batch:
+                    self._flushing = False
+                    return
+            try:
+                self._apply(batch)
+            except BaseException as e:
+                for intent in batch:
+                    if not intent.future.done():
+                        intent.future.set_exception(e)
+
+    def _read(self) -> tuple:
+        """Wait for any modification in progress to complete and return the list version and its entries."""
+        while True:
+            description = self.ec2_client.describe_managed_prefix_lists(PrefixListIds=[self.managed_prefix_list_id])
+            prefix_list = description['PrefixLists'][0]
+            if not prefix_list.get('State', '').endswith('-in-progress'):
+                break
+            time.sleep(self.poll_interval)
+        version = prefix_list['Version']
+        return version, _get_entries(self.ec2_client, self.managed_prefix_list_id, version)
+
+    def _wait_for_version(self, version: int) -> int:
+        """Block until the list has moved past `version` and the modification is complete."""
+        while True:
+            description = self.ec2_client.describe_managed_prefix_lists(PrefixListIds=[self.managed_prefix_list_id])
+            prefix_list = description['PrefixLists'][0]
+            if prefix_list['Version'] != version and not prefix_list.get('State', '').endswith('-in-progress'):
+                return prefix_list['Version']
+            time.sleep(self.poll_interval)
+
+    def _apply(self, batch: list):
+        import botocore.exceptions
+
+        version = None
+        for attempt in range(self.max_attempts):
+            try:
+                version, entries = self._read()
+                add_entries, remove_entries, errors = _plan(entries, batch)
+                if not add_entries and not remove_entries:
+                    new_version = version
+                    break
+                kwargs = {'AddEntries': add_entries} if add_entries else {}
+                if remove_entries:
+                    kwargs['RemoveEntries'] = remove_entries
+                self.ec2_client.modify_managed_prefix_list(
+                    DryRun=False, PrefixListId=self.managed_prefix_list_id, CurrentVersion=version, **kwargs
+                )
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] not in VERSION_CONFLICT_ERROR_CODES or attempt == self.max_attempts - 1:
+                    raise
+                delay = min(self.max_backoff, self.backoff * 2**attempt) * random.uniform(0.5, 1.5)
+                _logger.debug(f'{self.managed_prefix_list_id}: version {version} conflict, retrying in {delay:.2f} s')
+                time.sleep(delay)
+                continue
+            for entry in remove_entries:
+                _logger.info(f'removing: {entry["Cidr"]}')
+            for entry in add_entries:
+                _logger.info(f'added: {entry["Description"]},  {entry["Cidr"]}')
+            new_version = self._wait_for_version(version)
+            break
+        for i, intent in enumerate(batch):
+            if i in errors:
+                intent.future.set_exception(errors[i])
+            else:
+                intent.future.set_result(new_version)
+
+
+def get_prefix_list_writer(ec2_client, managed_prefix_list_id: str, **kwargs) -> PrefixListWriter:
+    """
+    Get the writer shared by all callers of this process for a given client and prefix list.
+
+    Parameters
+    ----------
+    ec2_client : boto3.client
+        The Boto3 EC2 client used to interact with the AWS EC2 service.
+    managed_prefix_list_id : str
+        The ID of the managed prefix list.
+    **kwargs
+        Options passed to the `PrefixListWriter` constructor when the writer is first created.
+
+    Returns
+    -------
+    PrefixListWriter
+        The shared writer.
+    """
+    with _WRITERS_LOCK:
+        key = (ec2_client, managed_prefix_list_id)
+        if key not in _WRITERS:
+            _WRITERS[key] = PrefixListWriter(ec2_client, managed_prefix_list_id, **kwargs)
+        return _WRITERS[key]
+
+
+class PrefixListPool:
+    """
+    Leases of prefix list entries spread over one or more managed prefix lists.
+
+    Each leased entry carries its expiry in its description and is renewed by leasing it again. When a list is
+    full, its expired entries are swept in one modification before a new entry spills over to the next list, and
+    the number of live leases of the pool is capped by `budget`. Entries that do not expire, such as the ones
+    added by hand, count against the capacity of the lists but not against the budget.
+
+    The pool is a library building block: `iblaws.compute.FirewallLease` writes to a single list. Each list of a
+    pool only grants access once it is referenced by the security group rules of the protected resource, which is
+    configured outside of this package.
+
+    Parameters
+    ----------
+    ec2_client : boto3.client
+        The Boto3 EC2 client used to interact with the AWS EC2 service.
+    managed_prefix_list_ids : list of str
+        The IDs of the managed prefix lists, filled in order.
+    ttl : float
+        Default duration of a lease in seconds.
+    budget : int, optional
+        Maximum number of live leases over all the lists, no limit other than the list sizes if None.
+    """
+
+    def __init__(self, ec2_client, managed_prefix_list_ids: list, ttl: float = 3600, budget: Optional[int] = None):
+        self.ec2_client = ec2_client
+        self.managed_prefix_list_ids = list(managed_prefix_list_ids)
+        self.ttl = ttl
+        self.budget = budget
+        self._lock = threading.Lock()
+
+    def writer(self, managed_prefix_list_id: str) -> PrefixListWriter:
+        return get_prefix_list_writer(self.ec2_client, managed_prefix_list_id)
+
+    def _describe(self) -> dict:
+        """Read the maximum size and the entries of all the lists, one describe call for the whole pool."""
+        description = self.ec2_client.describe_managed_prefix_lists(PrefixListIds=self.managed_prefix_list_ids)
+        max_entries = {pl['PrefixListId']: pl['MaxEntries'] for pl in description['PrefixLists']}
+        return {pl_id: (max_entries[pl_id], _get_entries(self.ec2_client, pl_id)) for pl_id in self.managed_prefix_list_ids}
+
+    def usage(self, now: Optional[float] = None) -> dict:
+        """
+        Count the entries of each list.
+
+        Returns
+        -------
+        dict
+            Prefix list ID to a dict with keys `max_entries`, `entries`, `leases` (live entries that expire) and
+            `expired`.
+        """
+        now = time.time() if now is None else now
+        usage = {}
+        for pl_id, (max_entries, entries) in self._describe().items():
+            expires = [parse_description(e['Description'])[1] for e in entries]
+            usage[pl_id] = {
+                'max_entries': max_entries,
+                'entries': len(entries),
+                'leases': sum(1 for exp in expires if exp is not None and exp > now),
+                'expired': sum(1 for exp in expires if exp is not None and exp <= now),
+            }
+        return usage
+
+    def lease(self, description: str, cidrip: str, ttl: Optional[float] = None) -> str:
+        """
+        Add or renew the entry of a description.
+
+        Parameters
+        ----------
+        description : str
+            The description of the entry, without expiry suffix.
+        cidrip : str
+            The CIDR block of the entry.
+        ttl : float, optional
+            Duration of the lease in seconds, defaults to the pool TTL.
+
+        Returns
+        -------
+        str
+            The ID of the prefix list holding the entry.
+
+        Raises
+        ------
+        PrefixListCapacityError
+            If the budget is spent or no list has room left after sweeping the expired entries.
+        """
+        now = time.time()
+        entry_description = lease_description(description, now + (self.ttl if ttl is None else ttl))
+        with self._lock:
+            lists = self._describe()
+            for pl_id, (_, entries) in lists.items():
+                if any(parse_description(e['Description'])[0] == description for e in entries):
+                    self.writer(pl_id).replace(entry_description, cidrip)
+                    return pl_id
+            expires = [parse_description(e['Description'])[1] for _, entries in lists.values() for e in entries]
+            leases = sum(1 for exp in expires if exp is not None and exp > now)
+            if self.budget is not None and leases >= self.budget:
+                raise PrefixListCapacityError(f'The budget of {self.budget} prefix list leases is spent')
+            for pl_id, (max_entries, entries) in lists.items():
+                expired = sum(1 for e in entries if _is_expired(e['Description'], now))
+                if len(entries) - expired >= max_entries:
+                    continue
+                if len(entries) >= max_entries:
+                    # make room and add the new entry in the same modification
+                    self.writer(pl_id).submit_many([('sweep', ''), ('replace', entry_description, cidrip)])[-1].result()
+                else:
+                    self.writer(pl_id).replace(entry_description, cidrip)
+                _logger.debug(f'{pl_id}: leased "{description}" until {entry_description}')
+                return pl_id
+        raise PrefixListCapacityError(f'All the prefix lists {self.managed_prefix_list_ids} are full')
+
+    def release(self, description: str):
+        """Remove the entry of a description from whichever list holds it, if any."""
+        for pl_id, (_, entries) in self._describe().items():
+            if any(parse_description(e['Description'])[0] == description for e in entries):
+                self.writer(pl_id).remove(description, ignore_errors=True)
+
+    def sweep(self) -> dict:
+        """
+        Remove the expired entries of all the lists, in one modification per list that has any.
+
+        Returns
+        -------
+        dict
+            Prefix list ID to number of removed entries.
+        """
+        now = time.time()
+        removed = {}
+        for pl_id, (_, entries) in self._describe().items():
+            removed[pl_id] = sum(1 for e in entries if _is_expired(e['Description'], now))
+            if removed[pl_id]:
+                self.writer(pl_id).sweep()
+                _logger.info(f'{pl_id}: swept {removed[pl_id]} expired entries')
+        return removed
@@ -0,0 +1,166 @@
+"""
+Concurrent, streamed uploads of large files to S3.
+
+The `MultipartUploader` reads each file once, sequentially: every part read is added to the file MD5 checksum and
+handed to a thread pool that uploads the parts concurrently. Only a bounded number of parts are held in memory, so
+that the read of a file is throttled by its upload. Several files may be uploaded at once from different threads,
+the parts of all of them sharing the same pool.
+
+    uploader = MultipartUploader(iblaws.utils.get_service_client('s3'), max_concurrency=16)
+    md5 = uploader.upload('/mnt/scratch/spikes.times.npy', 'my-bucket', 'patcher/spikes.times.npy')
+    uploader.progress()
+"""
+
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+_logger = logging.getLogger(__name__)
+
+# S3 accepts parts of 5 MiB to 5 GiB, up to 10000 parts per upload
+MIN_PART_SIZE = 5 * 1024**2
+MAX_PARTS = 10_000
+DEFAULT_PART_SIZE = 64 * 1024**2
+
+
+class MultipartUploader:
+    """
+    Upload files to S3 in parts, concurrently, computing their MD5 checksum while they stream.
+
+    Parameters
+    ----------
+    s3_client : botocore.client.S3
+        The S3 client, shared by the upload threads.
+    max_concurrency : int
+        Number of parts uploaded at the same time, across all the files.
+    part_size : int
+        Size of the parts in bytes, raised for the files that would need more than `MAX_PARTS` parts. The files
+        up to this size are uploaded in a single request.
+    max_parts_in_memory : int, optional
+        Number of parts read and not yet uploaded, twice the concurrency by default.
+    """
+
+    def __init__(
+        self, s3_client, max_concurrency: int = 8, part_size: int = DEFAULT_PART_SIZE, max_parts_in_memory: Optional[int] = None
+    ):
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f'The part size must be at least {MIN_PART_SIZE} bytes, got {part_size}')
+        self.s3_client = s3_client
+        self.part_size = part_size
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='s3-part')
+        self._slots = threading.BoundedSemaphore(max_parts_in_memory or 2 * max_concurrency)
+        self._lock = threading.Lock()
+        self._t0 = time.monotonic()
+        self.bytes_total = self.bytes_uploaded = self.files_total = self.files_uploaded = 0
+
+    def progress(self) -> dict:
+        """
+        Get the progress of the uploads since the uploader was created.
+
+        Returns
+        -------
+        dict
+            Keys `files_total` and `bytes_total`, submitted so far, `files_uploaded`, `bytes_uploaded` and the
+            average `throughput` in bytes per second.
+        """
+        with self._lock:
+            return {
+                'files_total': self.files_total,
+                'files_uploaded': self.files_uploaded,
+                'bytes_total': self.bytes_total,
+                'bytes_uploaded': self.bytes_uploaded,
+                'throughput': self.bytes_uploaded / max(time.monotonic() - self._t0, 1e-9),
+            }
+
+    def _count(self, n_bytes: int = 0, n_files: int = 0):
+        with self._lock:
+            self.bytes_uploaded += n_bytes
+            self.files_uploaded += n_files
+
+    def _submit(self, func, data: bytes, failed: Optional[threading.Event] = None, **kwargs):
+        def upload():
+            try:
+                response = func(Body=data, **kwargs)
+            except BaseException:
+                if failed is not None:
+                    failed.set()
+                raise
+            self._count(len(data))
+            return response
+
+        # blocks while too many parts are in memory, the slot is released once the part is uploaded or cancelled
+        self._slots.acquire()
+        future = self._executor.submit(upload)
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def upload(self, file_path, bucket: str, key: str, **kwargs) -> str:
+        """
+        Upload a file, blocking until all its parts are uploaded.
+
+        Parameters
+        ----------
+        file_path : str or Path
+            The local file.
+        bucket : str
+            The bucket name.
+        key : str
+            The object key.
+        **kwargs
+            Passed to `put_object` and `create_multipart_upload`, for example ContentType.
+
+        Returns
+        -------
+        str
+            The hexadecimal MD5 checksum of the file.
+        """
+        file_path = Path(file_path)
+        size = file_path.stat().st_size
+        part_size = max(self.part_size, -(-size // MAX_PARTS))
+        with self._lock:
+            self.files_total += 1
+            self.bytes_total += size
+        md5 = hashlib.md5()
+        t0 = time.perf_counter()
+        with open(file_path, 'rb') as fp:
+            if size <= part_size:
+                data = fp.read()
+                md5.update(data)
+                self._submit(self.s3_client.put_object, data, Bucket=bucket, Key=key, **kwargs).result()
+            else:
+                self._upload_parts(fp, md5, part_size, bucket, key, **kwargs)
+        self._count(n_files=1)
+        _logger.debug(
+            f'Uploaded {file_path} to s3://{bucket}/{key}: {size / 1024**2:.1f} MiB in {time.perf_counter() - t0:.1f} s'
+        )
+        return md5.hexdigest()
+
+    def _upload_parts(self, fp, md5, part_size: int, bucket: str, key: str, **kwargs):
+        upload_id = self.s3_client.create_multipart_upload(Bucket=bucket, Key=key, **kwargs)['UploadId']
+        futures, failed = [], threading.Event()
+        try:
+            # stop reading as soon as a part failed, its error is raised below
+            while not failed.is_set() and (data := fp.read(part_size)):
+                md5.update(data)
+                part = {'Bucket': bucket, 'Key': key, 'UploadId': upload_id, 'PartNumber': len(futures) + 1}
+                futures.append(self._submit(self.s3_client.upload_part, data, failed=failed, **part))
+            parts = [{'ETag': f.result()['ETag'], 'PartNumber': i + 1} for i, f in enumerate(futures)]
+            self.s3_client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            self.s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            raise
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
@@ -0,0 +1,207 @@
+"""
+Spot capacity: interruption notices and replacement of the reclaimed instances.
+
+EC2 gives a spot instance a two-minute notice before reclaiming it. The notice is published in the instance
+metadata (`spot/instance-action`), only readable from the instance itself, and at the same time the spot request of
+the instance moves to a `marked-for-*` status. The `InterruptionWatcher` reads the spot requests of all the watched
+instances in one `describe_spot_instance_requests` call, so that the `iblaws.compute.FleetScheduler` learns about
+the notices without an SSM command per instance.
+
+    watcher = InterruptionWatcher(ec2)
+    watcher.watch(['i-012bf17257acd3f96'])
+    watcher.poll()  # {'i-012bf17257acd3f96': 'marked-for-termination'} once the notice is given
+"""
+
+import itertools
+import logging
+import threading
+import time
+from typing import Optional
+
+import iblaws.compute
+import iblaws.inventory
+
+_logger = logging.getLogger(__name__)
+
+# spot request statuses of an instance being or having been reclaimed by EC2
+INTERRUPTION_STATUS_PREFIXES = ('marked-for-', 'instance-terminated-', 'instance-stopped-')
+# statuses of the instances stopped or terminated by their owner
+USER_STATUSES = ('instance-terminated-by-user', 'instance-stopped-by-user')
+# errors of `run_instances` when there is no spot capacity for an instance type in an availability zone
+CAPACITY_ERRORS = (
+    'InsufficientInstanceCapacity',
+    'SpotMaxPriceTooLow',
+    'MaxSpotInstanceCountExceeded',
+    'Unsupported',
+)
+
+
+class SpotCapacityError(RuntimeError):
+    pass
+
+
+def is_interruption(status_code: str) -> bool:
+    """Whether a spot request status code is an interruption notice or the interruption itself."""
+    return status_code.startswith(INTERRUPTION_STATUS_PREFIXES) and status_code not in USER_STATUSES
+
+
+class InterruptionWatcher:
+    """
+    Poll the spot requests of the watched instances for interruption notices.
+
+    Parameters
+    ----------
+    ec2_client : boto3.client
+        The Boto3 EC2 client of the region the instances are in.
+    interval : float
+        Seconds between two polls, well below the two minutes of the notice.
+    """
+
+    def __init__(self, ec2_client, interval: float = 15):
+        self.ec2_client = ec2_client
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._watched = set()
+        self._next_poll = 0.0
+
+    def watch(self, instance_ids: list):
+        with self._lock:
+            self._watched.update(instance_ids)
+
+    def unwatch(self, instance_ids: list):
+        with self._lock:
+            self._watched.difference_update(instance_ids)
+
+    def next_poll_delay(self) -> float:
+        """Seconds until the next poll is due."""
+        return max(0.0, self._next_poll - time.monotonic())
+
+    def poll(self, force: bool = False) -> dict:
+        """
+        Look up the spot requests of the watched instances if a poll is due.
+
+        The interrupted instances are no longer watched afterwards.
+
+        Parameters
+        ----------
+        force : bool
+            Poll regardless of the schedule.
+
+        Returns
+        -------
+        dict
+            Instance ID to spot request status code of the newly interrupted instances.
+        """
+        now = time.monotonic()
+        with self._lock:
+            watched = sorted(self._watched)
+            if not watched or (not force and now < self._next_poll):
+                return {}
+            self._next_poll = now + self.interval
+        interrupted = {}
+        paginator = self.ec2_client.get_paginator('describe_spot_instance_requests')
+        for page in paginator.paginate(Filters=[{'Name': 'instance-id', 'Values': watched}]):
+            for request in page['SpotInstanceRequests']:
+                code = request.get('Status', {}).get('Code', '')
+                if request.get('InstanceId') in watched and is_interruption(code):
+                    interrupted[request['InstanceId']] = code
+        if interrupted:
+            _logger.warning(f'Spot interruption of {", ".join(f"{i} ({c})" for i, c in interrupted.items())}')
+            self.unwatch(list(interrupted))
+            iblaws.inventory.invalidate(self.ec2_client, list(interrupted))
+        return interrupted
+
+
+class SpotReplacer:
+    """
+    Launch and prepare the replacement of a reclaimed spot instance, in another capacity pool.
+
+    The (instance type, availability zone) pairs are tried in order, skipping the ones where an instance was reclaimed
+    or where the capacity was missing during the last `cooldown` seconds. Called with the reclaimed
+    `iblaws.compute.InstanceManager`, for the `replace` argument of `iblaws.compute.FleetScheduler`.
+
+    Parameters
+    ----------
+    ami_id : str
+        The image of the new instances.
+    instance_types : list of str
+        The acceptable instance types, in order of preference.
+    availability_zones : list of str, optional
+        The acceptable availability zones, in order of preference, any by default.
+    volume_id : str
+        The volume mounted on each instance, 'AWS' for the instance store.
+    instance_store_scratch : bool
+        Stripe the NVMe instance store disks as scratch, see `iblaws.compute.InstanceManager.prepare_instance`.
+    cooldown : float
+        Seconds a capacity pool is skipped after an interruption or a capacity error, the spot capacity comes back.
+    """
+
+    def __init__(
+        self,
+        ami_id: str,
+        instance_types: list,
+        availability_zones: Optional[list] = None,
+        volume_id: str = 'AWS',
+        instance_store_scratch: bool = False,
+        cooldown: float = 1800,
+    ):
+        self.ami_id = ami_id
+        self.instance_types = list(instance_types)
+        self.availability_zones = list(availability_zones or [None])
+        self.volume_id = volume_id
+        self.instance_store_scratch = instance_store_scratch
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._excluded = {}  # (instance type, availability zone) -> monotonic time of the exclusion
+
+    @property
+    def excluded(self) -> set:
+        """The (instance type, availability zone) pairs currently skipped."""
+        now = time.monotonic()
+        with self._lock:
+            return {pool for pool, excluded_at in self._excluded.items() if now - excluded_at < self.cooldown}
+
+    def exclude(self, pools):
+        """Skip capacity pools for the next `cooldown` seconds."""
+        now = time.monotonic()
+        with self._lock:
+            self._excluded.update(dict.fromkeys(pools, now))
+
+    def launch(self, instance_region: str) -> iblaws.compute.InstanceManager:
+        """Launch a spot instance in the first capacity pool that has room, the capacity errors exclude the pool."""
+        import botocore.exceptions
+
+        excluded = self.excluded
+        for pool in itertools.product(self.instance_types, self.availability_zones):
+            if pool in excluded:
+                continue
+            instance_type, availability_zone = pool
+            try:
+                return iblaws.compute.InstanceManager.create_instance(
+                    self.ami_id,
+                    instance_type,
+                    instance_region,
+                    volume_id=self.volume_id,
+                    spot=True,
+                    availability_zone=availability_zone,
+                )
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] not in CAPACITY_ERRORS:
+                    raise
+                _logger.warning(f'No spot capacity for {instance_type} in {availability_zone or "any zone"}: {e}')
+                self.exclude([pool])
+        raise SpotCapacityError(f'No spot capacity left for {", ".join(self.instance_types)} in {instance_region}')
+
+    def __call__(self, instance: iblaws.compute.InstanceManager) -> iblaws.compute.InstanceManager:
+        try:
+            record = instance.inventory.get(instance.instance_id)
+            reclaimed = (record.instance_type, record.availability_zone)
+        except Exception as e:
+            _logger.warning(f'Could not get the capacity pool of {instance.instance_id}: {e}')
+        else:
+            # the zone may be unconstrained, then only the type is avoided
+            self.exclude([reclaimed, *((reclaimed[0], zone) for zone in self.availability_zones if zone is None)])
+        replacement = self.launch(instance.instance_region)
+        replacement.instance_store_scratch = self.instance_store_scratch
+        replacement.prepare_instance(replacement.public_ip)
+        return replacement
@@ -0,0 +1,457 @@
+"""
+Persistent SSH sessions to EC2 instances.
+
+An `SSHSession` waits for the instance to accept connections with an exponential backoff, keeps the connection
+alive and reconnects transparently, and runs multi-step shell scripts in a single round-trip with their exit status
+checked. Sessions are shared per (host, username, key) through `get_ssh_session`.
+
+    session = get_ssh_session(public_ip, PRIVATE_KEY_PATH, username='ubuntu')
+    session.prepare_volume(volume_id='AWS', mount_point='/mnt/s0')
+    session.prepare_scratch(mount_point='/mnt/s0', fallback_volume_id='vol-0a30864212c68a728')
+    session.run('nvidia-smi')
+"""
+
+import logging
+import shlex
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    import paramiko
+
+_logger = logging.getLogger(__name__)
+
+_SESSIONS_LOCK = threading.Lock()
+_SESSIONS = {}
+# size of the reads on a channel and delay between two checks of a channel without new data
+RECV_BYTES = 32768
+POLL_INTERVAL = 0.01
+
+
+PREPARE_VOLUME_SCRIPT = """
+set -euo pipefail
+mount_point={mount_point}
+serial={serial}
+formatted=0
+mounted=0
+if mountpoint -q "$mount_point"; then
+    device=$(findmnt -n -o SOURCE "$mount_point")
+else
+    # the EBS volume_id is set as the SERIAL number of the NVMe device, instance stores have an AWS serial
+    # source: https://docs.aws.amazon.com/ebs/latest/userguide/identify-nvme-ebs-device.html
+    device=$(lsblk -d -n -o NAME,SERIAL | awk -v serial="$serial" 'index($2, serial) {{print "/dev/" $1; exit}}')
+    if [ -z "$device" ]; then
+        echo "no block device with serial $serial" >&2
+        exit 3
+    fi
+    if [ {format} -eq 1 ] && [ -z "$(sudo blkid -o value -s TYPE "$device" || true)" ]; then
+        sudo mkfs -t xfs "$device" >&2
+        formatted=1
+    fi
+    sudo mkdir -p "$mount_point"
+    sudo mount "$device" "$mount_point"
+    mounted=1
+fi
+sudo mkdir -p "$mount_point"/{scratch}
+echo "device=$device"
+echo "formatted=$formatted"
+echo "mounted=$mounted"
+df -B1 --output=size,avail "$mount_point" | tail -1 | awk '{{print "size_bytes=" $1; print "available_bytes=" $2}}'
+"""
+
+
+PREPARE_SCRATCH_SCRIPT = """
+set -euo pipefail
+mount_point={mount_point}
+md_device=/dev/md/{md_name}
+formatted=0
+mounted=0
+# the NVMe instance store disks not mounted elsewhere, the EBS volumes have another model
+devices=$(lsblk -d -n -p -o NAME,MODEL | awk '/Amazon EC2 NVMe Instance Storage/ {{print $1}}' \\
+    | while read -r d; do findmnt -n -S "$d" > /dev/null || echo "$d"; done)
+n_devices=$(echo -n "$devices" | grep -c . || true)
+echo "devices=$n_devices"
+if mountpoint -q "$mount_point"; then
+    device=$(findmnt -n -o SOURCE "$mount_point")
+elif [ "$n_devices" -eq 0 ] && [ ! -e "$md_device" ]; then
+    exit 0
+else
+    if [ -e "$md_device" ]; then
+        # assembled by a previous run
+        device=$(readlink -f "$md_device")
+    elif [ "$n_devices" -eq 1 ]; then
+        device=$devices
+    else
+        command -v mdadm > /dev/null || sudo DEBIAN_FRONTEND=noninteractive apt-get install -y -q mdadm >&2
+        # the word splitting of the device list is intended
+        sudo mdadm --create "$md_device" --level=0 --raid-devices="$n_devices" --run $devices >&2
+        device=$(readlink -f "$md_device")
+    fi
+    if [ -z "$(sudo blkid -o value -s TYPE "$device" || true)" ]; then
+        sudo mkfs -t xfs "$device" >&2
+        formatted=1
+    fi
+    sudo mkdir -p "$mount_point"
+    sudo mount -o noatime "$device" "$mount_point"
+    mounted=1
+fi
+sudo mkdir -p "$mount_point"/{scratch}
+echo "device=$device"
+echo "formatted=$formatted"
+echo "mounted=$mounted"
+df -B1 --output=size,avail "$mount_point" | tail -1 | awk '{{print "size_bytes=" $1; print "available_bytes=" $2}}'
+"""
+
+PROBE_THROUGHPUT_SCRIPT = """
+set -euo pipefail
+probe={directory}/.throughput_probe
+# bytes per second from the summary line of dd: "<bytes> bytes (...) copied, <seconds> s, <rate>"
+rate() {{ LC_ALL=C "$@" 2>&1 | awk '/copied/ {{for (i = 2; i <= NF; i++) if ($i == "s,") printf "%.0f\\n", $1 / $(i - 1)}}'; }}
+echo "write_bytes_per_second=$(rate sudo dd if=/dev/zero of="$probe" bs=1M count={size_mib} oflag=direct conv=fsync)"
+echo "read_bytes_per_second=$(rate sudo dd if="$probe" of=/dev/null bs=1M iflag=direct)"
+sudo rm -f "$probe"
+"""
+
+
+@dataclass
+class RemoteResult:
+    """Outcome of a command run over SSH."""
+
+    command: str
+    exit_status: int
+    stdout: str
+    stderr: str
+    duration: float
+
+    @property
+    def ok(self) -> bool:
+        return self.exit_status == 0
+
+    def parse(self) -> dict:
+        """Parse the `key=value` lines of the standard output, integer values are converted."""
+        values = {}
+        for line in self.stdout.splitlines():
+            key, sep, value = line.partition('=')
+            if sep:
+                values[key.strip()] = int(value) if value.strip().lstrip('-').isdigit() else value.strip()
+        return values
+
+
+class RemoteCommandError(RuntimeError):
+    """Raised when a command run over SSH exits with a non-zero status."""
+
+    def __init__(self, host: str, result: RemoteResult):
+        self.host = host
+        self.result = result
+        super().__init__(f'{host}: command exited with status {result.exit_status}: {result.stderr.strip()[-2000:]}')
+
+
+class SSHSession:
+    """
+    Reusable SSH connection to an instance.
+
+    Parameters
+    ----------
+    host_ip : str
+        The public IP of the instance.
+    key_pair_path : str or Path
+        The path to the private key of the instance key pair.
+    username : str
+        The login user, 'ubuntu' on our AMIs.
+    max_wait : float
+        Maximum time in seconds to wait for the instance to accept the connection.
+    initial_delay : float
+        Delay in seconds after the first failed connection attempt, doubled after each attempt.
+    max_delay : float
+        Maximum delay in seconds between two connection attempts.
+    connect_timeout : float
+        Timeout in seconds of a single connection attempt.
+    keepalive : int
+        Interval in seconds of the keep-alive packets, 0 to disable.
+    """
+
+    def __init__(
+        self,
+        host_ip: str,
+        key_pair_path,
+        username: str = 'ubuntu',
+        max_wait: float = 300,
+        initial_delay: float = 1,
+        max_delay: float = 15,
+        connect_timeout: float = 10,
+        keepalive: int = 30,
+    ):
+        self.host_ip = host_ip
+        self.key_pair_path = Path(key_pair_path)
+        self.username = username
+        self.max_wait = max_wait
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.connect_timeout = connect_timeout
+        self.keepalive = keepalive
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def connected(self) -> bool:
+        transport = self._client.get_transport() if self._client is not None else None
+        return transport is not None and transport.is_active()
+
+    @property
+    def client(self) -> 'paramiko.SSHClient':
+        """The underlying paramiko client, (re)connected if needed."""
+        with self._lock:
+            if not self.connected:
+                self._client = self._connect()
+            return self._client
+
+    def _connect(self) -> 'paramiko.SSHClient':
+        import paramiko
+
+        # errors raised while an instance is booting: port closed, banner not sent yet, key not installed yet
+        not_ready_errors = (paramiko.ssh_exception.NoValidConnectionsError, paramiko.ssh_exception.SSHException, OSError)
+        deadline = time.monotonic() + self.max_wait
+        delay = self.initial_delay
+        attempt = 0
+        while True:
+            attempt += 1
+            ssh = paramiko.SSHClient()
+            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            try:
+                ssh.connect(
+                    self.host_ip,
+                    username=self.username,
+                    key_filename=str(self.key_pair_path),
+                    timeout=self.connect_timeout,
+                    banner_timeout=self.connect_timeout,
+                    auth_timeout=self.connect_timeout,
+                )
+            except not_ready_errors as e:
+                ssh.close()
+                if time.monotonic() + delay > deadline:
+                    raise TimeoutError(f'{self.host_ip}: SSH not available after {attempt} attempts: {e}') from e
+                _logger.debug(f'{self.host_ip}: SSH not ready ({e}), retrying in {delay:.0f} s')
+                time.sleep(delay)
+                delay = min(self.max_delay, delay * 2)
+                continue
+            if self.keepalive:
+                ssh.get_transport().set_keepalive(self.keepalive)
+            _logger.info(f'{self.host_ip}: SSH connected after {attempt} attempt(s)')
+            return ssh
+
+    def run(self, command: str, check: bool = True, timeout: Optional[float] = None, stdin: Optional[str] = None) -> RemoteResult:
+        """
+        Run a command and wait for its exit status.
+
+        Parameters
+        ----------
+        command : str
+            The shell command.
+        check : bool
+            Raise a `RemoteCommandError` if the command exits with a non-zero status.
+        timeout : float, optional
+            Timeout in seconds of the command, a `TimeoutError` is raised if it has not exited by then.
+        stdin : str, optional
+            Data written to the standard input of the command.
+
+        Returns
+        -------
+        RemoteResult
+            The exit status and outputs of the command.
+        """
+        t0 = time.monotonic()
+        channel_stdin, stdout, stderr = self.client.exec_command(command, timeout=timeout)
+        if stdin is not None:
+            channel_stdin.write(stdin)
+            channel_stdin.channel.shutdown_write()
+        out, err = self._drain(stdout.channel, None if timeout is None else t0 + timeout)
+        result = RemoteResult(command, stdout.channel.recv_exit_status(), out, err, time.monotonic() - t0)
+        _logger.debug(f'{self.host_ip}: "{command}" exited with {result.exit_status} in {result.duration:.1f} s')
+        if check and not result.ok:
+            raise RemoteCommandError(self.host_ip, result)
+        return result
+
+    @staticmethod
+    def _drain(channel: 'paramiko.Channel', deadline: Optional[float] = None) -> tuple:
+        """
+        Read the standard output and error of a command until it exits.
+
+        Both streams are read as data arrives: a command writing a lot to one of them would otherwise block once
+        the window of the channel is full, while the other one is being read to the end.
+        """
+        out, err = [], []
+        while True:
+            received = False
+            if channel.recv_ready():
+                out.append(channel.recv(RECV_BYTES))
+                received = True
+            if channel.recv_stderr_ready():
+                err.append(channel.recv_stderr(RECV_BYTES))
+                received = True
+            if received:
+                continue
+            if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                return b''.join(out).decode('utf8'), b''.join(err).decode('utf8')
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError('the command did not exit before the timeout')
+            time.sleep(POLL_INTERVAL)
+
+    def run_script(self, script: str, check: bool = True, timeout: Optional[float] = None) -> RemoteResult:
+        """Run a bash script in a single round-trip by streaming it to `bash -s`."""
+        return self.run('bash -s', check=check, timeout=timeout, stdin=script)
+
+    def prepare_volume(
+        self, volume_id: str = 'AWS', mount_point: str = '/mnt/s0', scratch: str = 'scratch', format_volume: Optional[bool] = None
+    ) -> dict:
+        """
+        Find the block device of a volume, format it if needed, mount it and create the scratch directory.
+
+        The script is idempotent: a mounted volume is left as is and a device that already holds a filesystem
+        is never formatted.
+
+        Parameters
+        ----------
+        volume_id : str
+            The EBS volume ID, or 'AWS' for the instance store.
+        mount_point : str
+            Where to mount the volume.
+        scratch : str
+            Name of the scratch directory created in the mount point.
+        format_volume : bool, optional
+            Create an xfs filesystem if the device has none, defaults to True for the instance store only.
+
+        Returns
+        -------
+        dict
+            Keys `device`, `formatted`, `mounted`, `size_bytes` and `available_bytes`.
+        """
+        format_volume = volume_id == 'AWS' if format_volume is None else format_volume
+        script = PREPARE_VOLUME_SCRIPT.format(
+            mount_point=shlex.quote(mount_point),
+            serial=shlex.quote(volume_id.replace('-', '')),
+            format=int(format_volume),
+            scratch=shlex.quote(scratch),
+        )
+        result = self.run_script(script).parse()
+        _logger.info(
+            f'{self.host_ip}: {result["device"]} mounted on {mount_point}, formatted: {bool(result["formatted"])}, '
+            f'available: {result["available_bytes"] / 1024**3:.0f} GiB'
+        )
+        return result
+
+    def prepare_scratch(
+        self,
+        mount_point: str = '/mnt/s0',
+        scratch: str = 'scratch',
+        fallback_volume_id: Optional[str] = None,
+        probe_mib: int = 1024,
+    ) -> dict:
+        """
+        Mount the NVMe instance store disks as the scratch volume, striped in RAID0 when there are several.
+
+        The instance store disks of the GPU instances (g4dn, g6...) are faster than EBS but blank after each start:
+        the array is assembled with mdadm, formatted as xfs and mounted. Without instance store disk, the EBS volume
+        is mounted instead with `prepare_volume`. The sequential read and write throughputs of the scratch directory
+        are then measured with direct I/O.
+
+        Parameters
+        ----------
+        mount_point : str
+            Where to mount the scratch volume.
+        scratch : str
+            Name of the scratch directory created in the mount point.
+        fallback_volume_id : str, optional
+            The EBS volume ID to mount when the instance has no instance store disk.
+        probe_mib : int
+            Size in MiB of the file written and read back to measure the throughput, 0 to skip the measure.
+
+        Returns
+        -------
+        dict
+            Keys `mode`, 'instance-store' or 'volume', `devices` the number of instance store disks, `device`,
+            `formatted`, `mounted`, `size_bytes`, `available_bytes` and with the probe `write_bytes_per_second` and
+            `read_bytes_per_second`.
+        """
+        script = PREPARE_SCRATCH_SCRIPT.format(
+            mount_point=shlex.quote(mount_point), md_name='scratch', scratch=shlex.quote(scratch)
+        )
+        result = {'mode': 'instance-store', **self.run_script(script).parse()}
+        if 'device' not in result:
+            if fallback_volume_id is None:
+                raise RuntimeError(f'{self.host_ip}: no instance store disk and no EBS volume to fall back to')
+            _logger.info(f'{self.host_ip}: no instance store disk, mounting the EBS volume {fallback_volume_id}')
+            result = {'mode': 'volume', 'devices': 0, **self.prepare_volume(fallback_volume_id, mount_point, scratch)}
+        else:
+            _logger.info(
+                f'{self.host_ip}: {result["device"]} striped over {result["devices"]} instance store disk(s) mounted on '
+                f'{mount_point}, available: {result["available_bytes"] / 1024**3:.0f} GiB'
+            )
+        if probe_mib:
+            result.update(self.probe_throughput(f'{mount_point}/{scratch}', size_mib=probe_mib))
+        return result
+
+    def probe_throughput(self, directory: str, size_mib: int = 1024) -> dict:
+        """
+        Measure the sequential write then read throughput of a directory with dd and direct I/O.
+
+        Parameters
+        ----------
+        directory : str
+            The remote directory, the probe file is deleted afterwards.
+        size_mib : int
+            Size in MiB of the probe file.
+
+        Returns
+        -------
+        dict
+            Keys `write_bytes_per_second` and `read_bytes_per_second`.
+        """
+        script = PROBE_THROUGHPUT_SCRIPT.format(directory=shlex.quote(directory), size_mib=int(size_mib))
+        result = self.run_script(script).parse()
+        _logger.info(
+            f'{self.host_ip}: {directory} write {result["write_bytes_per_second"] / 1024**2:.0f} MiB/s, '
+            f'read {result["read_bytes_per_second"] / 1024**2:.0f} MiB/s'
+        )
+        return result
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def get_ssh_session(host_ip: str, key_pair_path, username: str = 'ubuntu', **kwargs) -> SSHSession:
+    """
+    Get the SSH session shared by all callers of this process for a host, user and key.
+
+    Parameters
+    ----------
+    host_ip : str
+        The public IP of the instance.
+    key_pair_path : str or Path
+        The path to the private key of the instance key pair.
+    username : str
+        The login user.
+    **kwargs
+        Options passed to the `SSHSession` constructor when the session is first created.
+
+    Returns
+    -------
+    SSHSession
+        The shared session, it connects on first use.
+    """
+    with _SESSIONS_LOCK:
+        key = (host_ip, username, str(key_pair_path))
+        if key not in _SESSIONS:
+            _SESSIONS[key] = SSHSession(host_ip, key_pair_path, username=username, **kwargs)
+        return _SESSIONS[key]
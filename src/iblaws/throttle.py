@@ -0,0 +1,175 @@
+"""
+Client-side rate limiting of the AWS API calls, shared per (service, region).
+
+Every client created by `iblaws.utils.get_service_client` takes a token from the `RateLimiter` of its service and
+region before each HTTP attempt, retries included, so that all the threads of the process share one request budget
+instead of each one pushing until the account is throttled. The rate adapts to the throttling errors: it is halved
+on a throttling error and grows back by a fraction of a request per second with each successful call (additive
+increase, multiplicative decrease), so that it settles just under the limit of the account. The retries themselves
+use the botocore standard retry mode, an exponential backoff with full jitter.
+
+The calls delayed by the limiter and the throttled attempts are recorded by `iblaws.metrics` when it is enabled.
+
+    limiter = get_rate_limiter('ec2', 'us-east-1')
+    limiter.rate  # the current rate, in requests per second
+"""
+
+import logging
+import threading
+import time
+from typing import Optional
+
+import iblaws.metrics
+
+_logger = logging.getLogger(__name__)
+
+# initial rate in requests per second and burst of the limiters, below the EC2 and SSM API request rate limits
+RATES = {'ec2': (20.0, 50), 'ssm': (10.0, 20)}
+DEFAULT_RATE = (20.0, 40)
+# maximum number of attempts of a call, the first one included, for the botocore retry config
+MAX_ATTEMPTS = 8
+
+_LOCK = threading.Lock()
+_LIMITERS = {}  # (service, region) -> RateLimiter
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket whose refill rate adapts to the throttling errors.
+
+    Parameters
+    ----------
+    rate : float
+        Initial refill rate in requests per second.
+    burst : int
+        Capacity of the bucket, the number of requests that can be made at once after a quiet period.
+    min_rate : float
+        Lowest rate after throttling errors.
+    max_rate : float, optional
+        Highest rate reached with the successful calls, twice the initial rate by default.
+    decrease : float
+        Factor applied to the rate on a throttling error.
+    increase : float
+        Requests per second added to the rate for each second of successful calls at the current rate.
+    cooldown : float
+        Seconds after a decrease during which the other throttling errors, from requests sent before it, are ignored.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: int,
+        min_rate: float = 0.5,
+        max_rate: Optional[float] = None,
+        decrease: float = 0.5,
+        increase: float = 1.0,
+        cooldown: float = 1.0,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = 2 * rate if max_rate is None else max_rate
+        self.decrease = decrease
+        self.increase = increase
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._decreased_at = -float('inf')
+
+    def _refill(self, now: float):
+        # called with the lock held
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def acquire(self) -> float:
+        """
+        Take a token, waiting for it if the bucket is empty.
+
+        The token is reserved before waiting, so that the waiting threads are served in order.
+
+        Returns
+        -------
+        float
+            The seconds waited.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def on_throttle(self):
+        """Cut the rate after a throttling error, once per cooldown."""
+        with self._lock:
+            now = time.monotonic()
+            if now - self._decreased_at < self.cooldown:
+                return
+            self._refill(now)
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            # the requests already reserved wait for the new rate
+            self._tokens = min(self._tokens, 0.0)
+            self._decreased_at = now
+        _logger.warning(f'AWS API throttling, client-side rate lowered to {self.rate:.2f} requests/s')
+
+    def on_success(self):
+        """Grow the rate after a successful call."""
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+
+def get_rate_limiter(service_name: str, region_name: Optional[str]) -> RateLimiter:
+    """Get the limiter shared by all the clients of this process for a service and region."""
+    with _LOCK:
+        key = (service_name, region_name)
+        if key not in _LIMITERS:
+            rate, burst = RATES.get(service_name, DEFAULT_RATE)
+            _LIMITERS[key] = RateLimiter(rate, burst)
+        return _LIMITERS[key]
+
+
+def reset():
+    """Drop the limiters, the new ones start again from the initial rates."""
+    with _LOCK:
+        _LIMITERS.clear()
+
+
+def limit(client):
+    """
+    Register the event hooks that rate limit the HTTP requests of a boto3 client.
+
+    Parameters
+    ----------
+    client : botocore.client.BaseClient
+        The client to rate limit.
+
+    Returns
+    -------
+    botocore.client.BaseClient
+        The same client.
+    """
+    service = client.meta.service_model.service_name
+    region = client.meta.region_name
+    limiter = get_rate_limiter(service, region)
+
+    def before_send(event_name, **kwargs):
+        # sent once per attempt, a non-None return value would replace the response
+        if (waited := limiter.acquire()) > 0:
+            iblaws.metrics.record_rate_limit_wait((service, event_name.split('.')[-1], region), waited)
+
+    def needs_retry(response, operation, caught_exception=None, **kwargs):
+        if response is None:
+            return
+        if response[1].get('Error', {}).get('Code') in iblaws.metrics.THROTTLING_ERROR_CODES:
+            limiter.on_throttle()
+            iblaws.metrics.record_throttled_attempt((service, operation.name, region))
+        elif caught_exception is None and response[0].status_code < 500:
+            limiter.on_success()
+
+    client.meta.events.register('before-send.*.*', before_send, unique_id='iblaws-throttle-before-send')
+    client.meta.events.register('needs-retry.*.*', needs_retry, unique_id='iblaws-throttle-needs-retry')
+    return client
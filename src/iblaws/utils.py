@@ -1,32 +1,248 @@
+import functools
 import logging
 import os
+import random
 from pathlib import Path
+import threading
 import time
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
 from difflib import get_close_matches
 
-from pydantic import validate_call, IPvAnyInterface
-
-import boto3
-import dotenv
 import iblaws
-import paramiko
+import iblaws.inventory
+import iblaws.metrics
+import iblaws.prefix_lists
+import iblaws.ssh
+import iblaws.throttle
+from iblaws.lazy import validate_call
+
+# boto3, botocore, dotenv and paramiko are imported on first use, see `iblaws.lazy`
+if TYPE_CHECKING:
+    import boto3
+    import paramiko
+    from pydantic import IPvAnyInterface
 
 
 _logger = logging.getLogger(__name__)
 
+# size of the urllib3 connection pool of each client, the botocore default is 10
+MAX_POOL_CONNECTIONS = 50
+
+# process-wide registry of clients and sessions, boto3 clients are thread-safe once created but
+# sessions are not, so the creation of both is serialized with a single lock
+_CLIENT_LOCK = threading.Lock()
+_CLIENTS = {}
+_SESSIONS = {}
+_CREDENTIALS_LOCK = threading.Lock()
+
+
+def get_credentials() -> dict:
+    """
+    Read the AWS credentials from the `.env` file at the root of the repository and the environment.
+
+    The file is read only once per process, use `clear_client_cache` to force a reload.
+
+    Returns
+    -------
+    dict
+        Dictionary with keys `aws_access_key_id`, `aws_secret_access_key` and `region_name`.
+    """
+    # the cache is filled under the lock, so that concurrent first calls read the file once
+    with _CREDENTIALS_LOCK:
+        return _load_credentials()
+
+
+@functools.lru_cache(maxsize=1)
+def _load_credentials() -> dict:
+    import dotenv
 
-def get_service_client(service_name: str = 'ec2', region_name: Optional[str] = None):
     dotenv.load_dotenv(dotenv_path=Path(iblaws.__file__).parents[2].joinpath('.env'))  # Load environment variables from .env file
-    AWS_ACCESS_KEY = os.getenv('AWS_ACCESS_KEY')  # Ensure AWS credentials are loaded
-    AWS_SECRET_KEY = os.getenv('AWS_SECRET_KEY')  # Ensure AWS credentials are loaded
-    AWS_REGION = os.getenv('AWS_REGION')  # Change this to your desired region
-    return boto3.client(
-        service_name=service_name,
-        aws_access_key_id=AWS_ACCESS_KEY,
-        aws_secret_access_key=AWS_SECRET_KEY,
-        region_name=AWS_REGION if region_name is None else region_name,
+    return {
+        'aws_access_key_id': os.getenv('AWS_ACCESS_KEY'),
+        'aws_secret_access_key': os.getenv('AWS_SECRET_KEY'),
+        'region_name': os.getenv('AWS_REGION'),
+    }
+
+
+def _get_session(aws_access_key_id: Optional[str], aws_secret_access_key: Optional[str]) -> 'boto3.Session':
+    # needs to be called with _CLIENT_LOCK held
+    import boto3
+
+    key = (aws_access_key_id, aws_secret_access_key)
+    if key not in _SESSIONS:
+        _SESSIONS[key] = boto3.Session(aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key)
+    return _SESSIONS[key]
+
+
+def get_service_client(service_name: str = 'ec2', region_name: Optional[str] = None, max_pool_connections: Optional[int] = None):
+    """
+    Get a boto3 client for the given service and region from the process-wide registry.
+
+    Clients are created once per (service, region, credentials, pool size) and shared between callers
+    and threads, so credential resolution, endpoint loading and the HTTP connection pool are paid once.
+    Their requests share the rate limiter of their service and region and the throttled calls are retried with
+    a jittered exponential backoff, see `iblaws.throttle`. Their API calls are recorded when the metrics are
+    enabled, see `iblaws.metrics`.
+
+    Parameters
+    ----------
+    service_name : str
+        The AWS service name, for example 'ec2' or 'ssm'.
+    region_name : str, optional
+        The AWS region, defaults to the `AWS_REGION` environment variable.
+    max_pool_connections : int, optional
+        Maximum number of connections kept in the client's pool, defaults to `MAX_POOL_CONNECTIONS`.
+
+    Returns
+    -------
+    botocore.client.BaseClient
+        The shared client.
+    """
+    credentials = get_credentials()
+    region_name = credentials['region_name'] if region_name is None else region_name
+    max_pool_connections = max_pool_connections or MAX_POOL_CONNECTIONS
+    key = (
+        service_name,
+        region_name,
+        credentials['aws_access_key_id'],
+        credentials['aws_secret_access_key'],
+        max_pool_connections,
     )
+    client = _CLIENTS.get(key)
+    if client is not None:
+        return client
+    with _CLIENT_LOCK:
+        if key not in _CLIENTS:
+            import botocore.config
+
+            session = _get_session(credentials['aws_access_key_id'], credentials['aws_secret_access_key'])
+            client = session.client(
+                service_name=service_name,
+                region_name=region_name,
+                config=botocore.config.Config(
+                    max_pool_connections=max_pool_connections,
+                    retries={'mode': 'standard', 'total_max_attempts': iblaws.throttle.MAX_ATTEMPTS},
+                ),
+            )
+            _CLIENTS[key] = iblaws.metrics.instrument(iblaws.throttle.limit(client))
+        return _CLIENTS[key]
+
+
+def clear_client_cache():
+    """Drop all the shared clients and sessions and force the credentials to be read again on next use."""
+    with _CLIENT_LOCK:
+        _CLIENTS.clear()
+        _SESSIONS.clear()
+        _load_credentials.cache_clear()
+
+
+def _permission_key(permission: dict) -> tuple:
+    # describe_security_groups returns '-1' for the rules authorized with the 'all' protocol
+    protocol = '-1' if permission.get('IpProtocol') == 'all' else permission.get('IpProtocol')
+    return protocol, permission.get('FromPort'), permission.get('ToPort')
+
+
+def ec2_reconcile_security_group_rules(ec2_client, security_group_id: str, desired: dict, dry_run: bool = False) -> dict:
+    """
+    Brings the ingress rules of a security group to the desired description to CIDR mapping with a minimal diff.
+
+    The group is described once. A rule already matching the desired CIDR is kept, the other rules with the same
+    description are revoked and the missing ones authorized, keeping the protocol and ports of the existing rule
+    ('all' protocol for a new description). A rule of another description holding a desired CIDR on the same
+    protocol and ports is revoked too, as the address now belongs to the new description. The changes are applied
+    in at most one revoke and one authorize call, and no call is made when the group is already up to date.
+    Rules whose description is not in `desired` are left untouched. When several descriptions want the same CIDR on
+    the same protocol and ports, the rule already in place, or else the first description, wins and the others are
+    skipped with a warning.
+
+    Parameters
+    ----------
+    ec2_client : boto3.client
+        The Boto3 EC2 client used to interact with the AWS EC2 service.
+    security_group_id : str
+        The ID of the security group.
+    desired : dict
+        Rule description to CIDR block, for example {'i-012bf17257acd3f96': '122.13.123.23/32'}.
+    dry_run : bool
+        Only compute the diff, do not modify the group.
+
+    Returns
+    -------
+    dict
+        The diff: 'revoke' and 'authorize' lists of IpPermissions as passed to the EC2 API, and the 'unchanged'
+        list of descriptions that were already up to date.
+    """
+    response = ec2_client.describe_security_groups(GroupIds=[security_group_id])
+    sg = response['SecurityGroups'][0]
+    existing = []  # (permission without ranges, ip range)
+    for pip in sg['IpPermissions']:
+        permission = {k: v for k, v in pip.items() if k in ('IpProtocol', 'FromPort', 'ToPort')}
+        existing.extend((permission, ir) for ir in pip.get('IpRanges', []))
+    diff = {'revoke': [], 'authorize': [], 'unchanged': []}
+    # first pass: the rules already matching the desired CIDR are kept and may not be revoked by another description
+    rules, keep, kept = {}, {}, set()  # kept: (permission key, cidr)
+    for description, cidrip in desired.items():
+        rules[description] = [(permission, ir) for permission, ir in existing if ir.get('Description') == description]
+        keep[description] = next((i for i, (_, ir) in enumerate(rules[description]) if ir['CidrIp'] == cidrip), None)
+        if keep[description] is not None:
+            kept.add((_permission_key(rules[description][keep[description]][0]), cidrip))
+    revoked, authorized = set(), set()  # (permission key, cidr)
+    for description, cidrip in desired.items():
+        for i, (permission, ir) in enumerate(rules[description]):
+            if i != keep[description]:
+                # only the matching IP range, not the other ranges, prefix lists or groups of the permission
+                diff['revoke'].append({**permission, 'IpRanges': [ir]})
+                revoked.add((_permission_key(permission), ir['CidrIp']))
+        if keep[description] is not None:
+            diff['unchanged'].append(description)
+            continue
+        template = rules[description][0][0] if rules[description] else {'IpProtocol': 'all'}
+        target = (_permission_key(template), cidrip)
+        if target in kept or target in authorized:
+            # a security group holds a single rule per protocol, ports and CIDR: the first description wins
+            _logger.warning(f'{description}: {cidrip} is already granted to another description, skipping')
+            continue
+        for permission, ir in existing:
+            key = (_permission_key(permission), ir['CidrIp'])
+            if key == target and key not in revoked:
+                diff['revoke'].append({**permission, 'IpRanges': [ir]})
+                revoked.add(key)
+        diff['authorize'].append({**template, 'IpRanges': [{'CidrIp': cidrip, 'Description': description}]})
+        authorized.add(target)
+    for permission in diff['revoke']:
+        _logger.info(f'revoking: {permission["IpRanges"][0].get("Description")},  {permission["IpRanges"][0]["CidrIp"]}')
+    if dry_run:
+        return diff
+    if diff['revoke']:
+        ec2_client.revoke_security_group_ingress(GroupId=security_group_id, IpPermissions=diff['revoke'])
+    if diff['authorize']:
+        ec2_client.authorize_security_group_ingress(GroupId=security_group_id, IpPermissions=diff['authorize'])
+    for permission in diff['authorize']:
+        _logger.info(f'updated: {permission["IpRanges"][0]["Description"]},  {permission["IpRanges"][0]["CidrIp"]}')
+    return diff
+
+
+def ec2_update_security_group_rules(ec2_client, security_group_id: str, rules: dict) -> dict:
+    """
+    Updates or creates several ingress rules of a security group, see `ec2_reconcile_security_group_rules`.
+
+    An existing rule with the same description is replaced, keeping its protocol and ports.
+
+    Parameters
+    ----------
+    ec2_client : boto3.client
+        The Boto3 EC2 client used to interact with the AWS EC2 service.
+    security_group_id : str
+        The ID of the security group.
+    rules : dict
+        Rule description to CIDR block, for example {'i-012bf17257acd3f96': '122.13.123.23/32'}.
+
+    Returns
+    -------
+    dict
+        The applied diff.
+    """
+    return ec2_reconcile_security_group_rules(ec2_client, security_group_id, rules)
 
 
 def ec2_update_security_group_rule(ec2_client, security_group_id: str, description: str, cidrip: str):
@@ -37,40 +253,9 @@ def ec2_update_security_group_rule(ec2_client, security_group_id: str, descripti
     :param security_group_id:
     :param description:
     :param cidr: 122.13.123.23/32
-    :return:
+    :return: the diff applied, see `ec2_reconcile_security_group_rules`
     """
-    response = ec2_client.describe_security_groups(GroupIds=[security_group_id])
-    sg = response['SecurityGroups'][0]
-    revoke_pip = None
-
-    for pip in sg['IpPermissions']:
-        for ir in pip['IpRanges']:
-            if ir['Description'] == description:
-                _logger.info(f'revoking: {ir["Description"]},  {ir["CidrIp"]}')
-                revoke_pip = pip.copy()
-                revoke_pip['IpRanges'] = [ir]
-                ec2_client.revoke_security_group_ingress(GroupId=security_group_id, IpPermissions=[revoke_pip])
-                revoke_pip['IpRanges'][0]['CidrIp'] = cidrip
-
-    ec2_client.authorize_security_group_ingress(
-        GroupId=security_group_id,
-        IpPermissions=[
-            (
-                revoke_pip
-                or {
-                    'IpProtocol': 'all',
-                    'IpRanges': [{'CidrIp': cidrip, 'Description': description}],
-                }
-            )
-        ],
-    )
-
-    response = ec2_client.describe_security_groups(GroupIds=[security_group_id])
-    sg = response['SecurityGroups'][0]
-    for pip in sg['IpPermissions']:
-        for ir in pip['IpRanges']:
-            if ir['Description'] == description:
-                _logger.info(f'updated: {ir["Description"]},  {ir["CidrIp"]}')
+    return ec2_update_security_group_rules(ec2_client, security_group_id, {description: cidrip})
 
 
 def ec2_get_managed_prefix_list_version(ec2_client, managed_prefix_list_id: str) -> int:
@@ -94,8 +279,16 @@ def ec2_get_managed_prefix_list_version(ec2_client, managed_prefix_list_id: str)
     return list_description.get('Version')
 
 
+def _wait_for_prefix_list_version(ec2_client, managed_prefix_list_id: str, list_version: int, max_delay: float = 5):
+    # polls until the modification is applied, with a jittered backoff so that concurrent waiters spread their calls
+    delay = 0.2
+    while list_version == ec2_get_managed_prefix_list_version(ec2_client, managed_prefix_list_id):
+        time.sleep(random.uniform(delay / 2, delay))
+        delay = min(max_delay, delay * 2)
+
+
 @validate_call
-def ec2_add_managed_prefix_list_item(ec2_client, managed_prefix_list_id: str, description: str, cidrip: IPvAnyInterface):
+def ec2_add_managed_prefix_list_item(ec2_client, managed_prefix_list_id: str, description: str, cidrip: 'IPvAnyInterface'):
     """
     Add a new entry to a managed prefix list in AWS EC2.
 
@@ -115,10 +308,11 @@ def ec2_add_managed_prefix_list_item(ec2_client, managed_prefix_list_id: str, de
     """
     list_version = ec2_get_managed_prefix_list_version(ec2_client, managed_prefix_list_id)
     existing_entries = ec2_client.get_managed_prefix_list_entries(PrefixListId=managed_prefix_list_id).get('Entries')
-    existing_descriptions = [x['Description'] for x in existing_entries]
+    # descriptions are compared without their lease expiry suffix, see `iblaws.prefix_lists.lease_description`
+    existing_descriptions = [iblaws.prefix_lists.parse_description(x['Description'])[0] for x in existing_entries]
 
     # check if the entry already exists
-    if description in existing_descriptions:
+    if iblaws.prefix_lists.parse_description(description)[0] in existing_descriptions:
         raise ValueError(f'The description "{description}" already exists. Please choose a different description.')
 
     # add entry
@@ -129,9 +323,7 @@ def ec2_add_managed_prefix_list_item(ec2_client, managed_prefix_list_id: str, de
         AddEntries=[{'Cidr': str(cidrip), 'Description': description}],
     )
 
-    # wait for list version to be updated
-    while list_version == ec2_get_managed_prefix_list_version(ec2_client, managed_prefix_list_id):
-        time.sleep(0.2)
+    _wait_for_prefix_list_version(ec2_client, managed_prefix_list_id, list_version)
     _logger.info(f'added: {description},  {cidrip}')
 
 
@@ -153,7 +345,9 @@ def ec2_remove_managed_prefix_list_item(ec2_client, managed_prefix_list_id: str,
     """
     list_version = list_version = ec2_get_managed_prefix_list_version(ec2_client, managed_prefix_list_id)
     existing_entries = ec2_client.get_managed_prefix_list_entries(PrefixListId=managed_prefix_list_id).get('Entries')
-    existing_descriptions = [x['Description'] for x in existing_entries]
+    # descriptions are compared without their lease expiry suffix, see `iblaws.prefix_lists.lease_description`
+    existing_descriptions = [iblaws.prefix_lists.parse_description(x['Description'])[0] for x in existing_entries]
+    description = iblaws.prefix_lists.parse_description(description)[0]
 
     if description not in existing_descriptions:
         if ignore_errors:
@@ -169,7 +363,7 @@ def ec2_remove_managed_prefix_list_item(ec2_client, managed_prefix_list_id: str,
 
         raise ValueError(f'The description "{description}" was not found in the existing entries.' + suggestion)
 
-    remove_entries = [x for x in existing_entries if x['Description'] == description]
+    remove_entries = [x for x in existing_entries if iblaws.prefix_lists.parse_description(x['Description'])[0] == description]
     if len(remove_entries) > 0:
         for entry in remove_entries:
             _logger.info(f'removing: {entry["Description"]},  {entry["Cidr"]}')
@@ -180,14 +374,12 @@ def ec2_remove_managed_prefix_list_item(ec2_client, managed_prefix_list_id: str,
             RemoveEntries=[{'Cidr': rm['Cidr']} for rm in remove_entries],
         )
 
-    # wait for list version to be updated
-    while list_version == ec2_get_managed_prefix_list_version(ec2_client, managed_prefix_list_id):
-        time.sleep(0.2)
+    _wait_for_prefix_list_version(ec2_client, managed_prefix_list_id, list_version)
     _logger.info(f'removed: {description}')
 
 
 @validate_call
-def ec2_update_managed_prefix_list_item(ec2_client, managed_prefix_list_id: str, description: str, cidrip: IPvAnyInterface):
+def ec2_update_managed_prefix_list_item(ec2_client, managed_prefix_list_id: str, description: str, cidrip: 'IPvAnyInterface'):
     """
     Update a managed prefix list in AWS EC2 by removing existing entries that match a given description
     and adding a new entry.
@@ -210,23 +402,126 @@ def ec2_update_managed_prefix_list_item(ec2_client, managed_prefix_list_id: str,
     ec2_add_managed_prefix_list_item(ec2_client, managed_prefix_list_id, description, cidrip)
 
 
-def ec2_get_ssh_client(host_ip, key_pair_path, username='ubuntu') -> paramiko.SSHClient:
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+def ec2_get_ssh_client(host_ip, key_pair_path, username='ubuntu') -> 'paramiko.SSHClient':
+    """
+    Get a connected SSH client to an instance, waiting with a backoff for the instance to accept connections.
+
+    The connection is shared with the other callers through `iblaws.ssh.get_ssh_session`.
+    """
+    return iblaws.ssh.get_ssh_session(host_ip, key_pair_path, username=username).client
+
+
+def ec2_get_public_ip(ec2_client, instance_id, max_age: Optional[float] = 0):
+    """
+    Get the public IP of an instance, by default described afresh as it changes with each start.
+
+    Parameters
+    ----------
+    ec2_client : boto3.client
+        The Boto3 EC2 client used to interact with the AWS EC2 service.
+    instance_id : str
+        The ID of the instance.
+    max_age : float, optional
+        Maximum age in seconds of the inventory record, None for the TTL of the inventory.
+
+    Returns
+    -------
+    str or None
+        The public IP, None if the instance has none.
+    """
+    return iblaws.inventory.get_inventory(ec2_client).get(instance_id, max_age=max_age).public_ip
+
+
+def ec2_get_public_ips(ec2_client, instance_ids: list) -> dict:
+    """
+    Get the public IPs of several instances from the shared inventory, refreshed with one bulk call if needed.
+
+    Parameters
+    ----------
+    ec2_client : boto3.client
+        The Boto3 EC2 client used to interact with the AWS EC2 service.
+    instance_ids : list of str
+        The IDs of the instances.
+
+    Returns
+    -------
+    dict
+        Instance ID to public IP, None for the instances without public IP.
+    """
+    records = iblaws.inventory.get_inventory(ec2_client).get_many(list(instance_ids))
+    return {instance_id: record.public_ip for instance_id, record in records.items()}
+
+
+def _resolve_instance_ids(ec2_client, instance_ids: Optional[list], tags: Optional[dict], state: str) -> list:
+    """Instance IDs given explicitly, or selected by tags among the instances in the given state."""
+    if instance_ids is not None:
+        return [instance_ids] if isinstance(instance_ids, str) else list(instance_ids)
+    if tags is None:
+        raise ValueError('Either instance_ids or tags must be provided')
+    return ec2_list_instance_ids(ec2_client, tags=tags, filters=[{'Name': 'instance-state-name', 'Values': [state]}])
+
+
+def ec2_stop_instances(
+    ec2_client, instance_ids: Optional[list] = None, tags: Optional[dict] = None, hibernate: bool = False
+) -> list:
+    """
+    Stop several instances with a single API call and wait for all of them together.
 
-    # Wait for SSH to be available
-    for i in range(3):  # Try for 5 minutes
-        try:
-            ssh.connect(host_ip, username=username, key_filename=str(key_pair_path))
-            break
-        except paramiko.ssh_exception.NoValidConnectionsError:
-            time.sleep(5)
-    return ssh
+    Parameters
+    ----------
+    ec2_client : boto3.client
+        The Boto3 EC2 client used to interact with the AWS EC2 service.
+    instance_ids : list of str, optional
+        The IDs of the instances.
+    tags : dict, optional
+        Select the running instances with these tags instead, for example {'Flottille': 'iblsorter'}.
+    hibernate : bool
+        Hibernate the instances, their memory is saved to the root volume and restored on start. The instances must
+        have been launched with hibernation configured.
+
+    Returns
+    -------
+    list of str
+        The IDs of the stopped instances.
+    """
+    instance_ids = _resolve_instance_ids(ec2_client, instance_ids, tags, state='running')
+    if not instance_ids:
+        return []
+    _logger.info(f'{"Hibernating" if hibernate else "Stopping"} EC2 instances {", ".join(instance_ids)}...')
+    ec2_client.stop_instances(InstanceIds=instance_ids, **({'Hibernate': True} if hibernate else {}))
+    ec2_client.get_waiter('instance_stopped').wait(InstanceIds=instance_ids)
+    iblaws.inventory.invalidate(ec2_client, instance_ids)
+    _logger.info(f'EC2 instances {", ".join(instance_ids)} are now stopped')
+    return instance_ids
+
+
+def ec2_start_instances(ec2_client, instance_ids: Optional[list] = None, tags: Optional[dict] = None) -> dict:
+    """
+    Start several instances with a single API call, wait for all of them together and get their public IPs.
 
+    Parameters
+    ----------
+    ec2_client : boto3.client
+        The Boto3 EC2 client used to interact with the AWS EC2 service.
+    instance_ids : list of str, optional
+        The IDs of the instances.
+    tags : dict, optional
+        Select the stopped instances with these tags instead, for example {'Flottille': 'iblsorter'}.
 
-def ec2_get_public_ip(ec2_client, instance_id):
-    response = ec2_client.describe_instances(InstanceIds=[instance_id])
-    return response['Reservations'][0]['Instances'][0]['PublicIpAddress']
+    Returns
+    -------
+    dict
+        Instance ID to public IP of the started instances.
+    """
+    instance_ids = _resolve_instance_ids(ec2_client, instance_ids, tags, state='stopped')
+    if not instance_ids:
+        return {}
+    _logger.info(f'Starting EC2 instances {", ".join(instance_ids)}...')
+    ec2_client.start_instances(InstanceIds=instance_ids)
+    ec2_client.get_waiter('instance_running').wait(InstanceIds=instance_ids)
+    iblaws.inventory.invalidate(ec2_client, instance_ids)
+    _logger.info(f'EC2 instances {", ".join(instance_ids)} are now running')
+    return ec2_get_public_ips(ec2_client, instance_ids)
 
 
 def ec2_stop_instance(ec2_client, instance_id):
@@ -235,6 +530,7 @@ def ec2_stop_instance(ec2_client, instance_id):
     ec2_client.stop_instances(InstanceIds=[instance_id])
     waiter = ec2_client.get_waiter('instance_stopped')
     waiter.wait(InstanceIds=[instance_id])
+    iblaws.inventory.invalidate(ec2_client, [instance_id])
     _logger.info(f'EC2 instance {instance_id} is now stopped')
 
 
@@ -244,28 +540,101 @@ def ec2_start_instance(ec2_client, instance_id):
     ec2_client.start_instances(InstanceIds=[instance_id])
     waiter = ec2_client.get_waiter('instance_running')
     waiter.wait(InstanceIds=[instance_id])
+    iblaws.inventory.invalidate(ec2_client, [instance_id])
     _logger.info(f'EC2 instance {instance_id} is now running')
 
 
-def ssm_list_running_commands(instance_id: str, region_name: str = 'us-west-2') -> list:
+def ec2_list_instance_ids(ec2_client, tags: Optional[dict] = None, filters: Optional[list] = None) -> list:
     """
-    List the commands currently running on an EC2 instance.
-    :param instance_id: The ID of the EC2 instance.
-    :param region_name: The AWS region where the instance is located (default is 'us-west-2').
-    :return: A list of command IDs that are currently running.
+    List the IDs of the instances matching tags and filters, in as many calls as there are result pages.
+
+    Parameters
+    ----------
+    ec2_client : boto3.client
+        The Boto3 EC2 client used to interact with the AWS EC2 service.
+    tags : dict, optional
+        Tag key to value(s) the instances must have, for example {'Flottille': 'iblsorter'}.
+    filters : list of dict, optional
+        Additional `describe_instances` filters, for example [{'Name': 'instance-state-name', 'Values': ['running']}].
+
+    Returns
+    -------
+    list of str
+        The instance IDs.
     """
-    ssm = boto3.client('ssm', region_name=region_name)
+    filters = list(filters or [])
+    for key, values in (tags or {}).items():
+        filters.append({'Name': f'tag:{key}', 'Values': [values] if isinstance(values, str) else list(values)})
+    instance_ids = []
+    for page in ec2_client.get_paginator('describe_instances').paginate(Filters=filters):
+        for reservation in page['Reservations']:
+            instance_ids.extend(instance['InstanceId'] for instance in reservation['Instances'])
+    return instance_ids
+
+
+def ssm_list_running_commands(
+    instance_id: Optional[str | list] = None,
+    region_name: str = 'us-west-2',
+    tags: Optional[dict] = None,
+    ssm_client=None,
+    ec2_client=None,
+) -> list:
+    """
+    List the commands currently running on one, several or all the EC2 instances of a region.
 
-    # Get a list of commands sent to the instance
-    commands = ssm.list_commands(InstanceId=instance_id)['Commands']
+    The status is filtered server-side and the results are paginated, so that the number of calls depends on the
+    number of running commands and not on the command history of the instances.
 
-    running_commands = []
-    for command in commands:
-        # Get the status of each command
-        status = ssm.list_command_invocations(CommandId=command['CommandId'], InstanceId=instance_id)['CommandInvocations'][0][
-            'Status'
-        ]
-        if status == 'InProgress':
-            running_commands.append(command['CommandId'])
+    Parameters
+    ----------
+    instance_id : str or list of str, optional
+        The ID(s) of the EC2 instance(s), all the instances of the region if None.
+    region_name : str
+        The AWS region where the instances are located (default is 'us-west-2').
+    tags : dict, optional
+        Only consider the instances with these tags, for example {'Flottille': 'iblsorter'}.
+    ssm_client : boto3.client, optional
+        The SSM client to use, defaults to the shared client of the region.
+    ec2_client : boto3.client, optional
+        The EC2 client used to resolve the tags, defaults to the shared client of the region.
 
+    Returns
+    -------
+    list of dict
+        One record per running invocation with keys `CommandId`, `InstanceId`, `Status`, `StatusDetails`,
+        `Comment`, `DocumentName` and `RequestedDateTime`.
+    """
+    ssm_client = ssm_client or get_service_client(service_name='ssm', region_name=region_name)
+    instance_ids = None
+    if instance_id is not None:
+        instance_ids = {instance_id} if isinstance(instance_id, str) else set(instance_id)
+    if tags is not None:
+        ec2_client = ec2_client or get_service_client(service_name='ec2', region_name=region_name)
+        tagged = set(ec2_list_instance_ids(ec2_client, tags=tags))
+        instance_ids = tagged if instance_ids is None else instance_ids & tagged
+    if instance_ids is not None and len(instance_ids) == 0:
+        return []
+
+    kwargs = {'Filters': [{'key': 'Status', 'value': 'InProgress'}]}
+    if instance_ids is not None and len(instance_ids) == 1:
+        kwargs['InstanceId'] = next(iter(instance_ids))
+    running_commands = []
+    for page in ssm_client.get_paginator('list_command_invocations').paginate(**kwargs):
+        for invocation in page['CommandInvocations']:
+            if instance_ids is not None and invocation['InstanceId'] not in instance_ids:
+                continue
+            running_commands.append(
+                {
+                    k: invocation.get(k)
+                    for k in (
+                        'CommandId',
+                        'InstanceId',
+                        'Status',
+                        'StatusDetails',
+                        'Comment',
+                        'DocumentName',
+                        'RequestedDateTime',
+                    )
+                }
+            )
     return running_commands
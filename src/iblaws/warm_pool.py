@@ -0,0 +1,393 @@
+"""
+Warm pool of sorting instances, provisioned ahead of the batches and parked in hibernated or stopped state.
+
+A parked instance has booted the AMI, mounted its scratch volume and registered its SSM agent once. Handing it out
+is a single start: a hibernated instance resumes with its memory and mounts, a stopped one only mounts its volume
+again. The instances of the pool carry the `Flottille=iblsorter` tag and their pool state in the `POOL_TAG` tag, so
+that several processes share the same pool. As EC2 tags cannot be written conditionally, a process claims parked
+instances by tagging them with a token of its own and reading the tags back once the concurrent claims have landed,
+only the instances still carrying its token are handed out. The pool is refilled in background after each acquisition.
+
+    pool = WarmPool('us-east-1', ami_id='ami-0c1234567890abcde', instance_type='g6.4xlarge', size=4)
+    pool.refill(wait=True)  # ahead of the campaign
+    instances = pool.acquire(4)
+    results = iblaws.compute.FleetScheduler(instances).run(pids)
+    pool.release(instances)
+"""
+
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import iblaws.compute
+import iblaws.inventory
+import iblaws.utils
+
+_logger = logging.getLogger(__name__)
+
+POOL_TAG = 'iblaws:warm-pool'
+PROVISIONING = 'provisioning'
+HIBERNATED = 'hibernated'
+STOPPED = 'stopped'
+IN_USE = 'in-use'
+# token of the last process claiming a parked instance, and the seconds waited for the concurrent claims to land
+CLAIM_TAG = 'iblaws:warm-pool-claim'
+CLAIM_SETTLE = 2
+CLAIM_ATTEMPTS = 3
+FLEET_TAGS = {'Flottille': 'iblsorter'}
+SSM_POLL_INTERVAL = 5
+
+
+class WarmPoolError(RuntimeError):
+    pass
+
+
+class WarmPool:
+    """
+    Keep `size` prepared instances parked and hand them out on demand.
+
+    Parameters
+    ----------
+    instance_region : str
+        The region of the instances.
+    ami_id : str
+        The image of the new instances.
+    instance_type : str
+        The type of the new instances, only the parked instances of this type are handed out.
+    size : int
+        Number of instances kept parked.
+    volume_id : str
+        The volume mounted on each instance, 'AWS' for the instance store.
+    instance_store_scratch : bool
+        Stripe the NVMe instance store disks as scratch, see `iblaws.compute.InstanceManager.prepare_instance`. The
+        instance store is wiped by any stop, the scratch is then prepared again on acquisition.
+    hibernate : bool
+        Hibernate the parked instances, they are stopped if the hibernation fails.
+    prefix_list_id : str, optional
+        Also register the IPs of the acquired instances in this managed prefix list.
+    ssm_timeout : float
+        Seconds to wait for the SSM agent of an instance to be online.
+    max_workers : int
+        Maximum number of instances provisioned or prepared concurrently.
+    """
+
+    def __init__(
+        self,
+        instance_region: str,
+        ami_id: str,
+        instance_type: str,
+        size: int = 2,
+        volume_id: str = 'AWS',
+        instance_store_scratch: bool = False,
+        hibernate: bool = True,
+        prefix_list_id: Optional[str] = None,
+        ssm_timeout: float = 600,
+        max_workers: int = 8,
+    ):
+        self.instance_region = instance_region
+        self.ami_id = ami_id
+        self.instance_type = instance_type
+        self.size = size
+        self.volume_id = volume_id
+        self.instance_store_scratch = instance_store_scratch
+        self.hibernate = hibernate
+        self.prefix_list_id = prefix_list_id
+        self.ssm_timeout = ssm_timeout
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._refill_thread = None
+
+    @property
+    def ec2(self):
+        return iblaws.utils.get_service_client(service_name='ec2', region_name=self.instance_region)
+
+    @property
+    def ssm(self):
+        return iblaws.utils.get_service_client(service_name='ssm', region_name=self.instance_region)
+
+    def _select(self, pool_states: list, states: list, max_age: Optional[float] = None) -> list:
+        records = iblaws.inventory.get_inventory(self.ec2).select(
+            tags={**FLEET_TAGS, POOL_TAG: pool_states}, states=states, max_age=max_age
+        )
+        return [r for r in records if r.instance_type == self.instance_type]
+
+    def parked(self, max_age: Optional[float] = None) -> list:
+        """
+        List the parked instances, the hibernated ones first then the oldest first.
+
+        Returns
+        -------
+        list of iblaws.inventory.InstanceRecord
+        """
+        records = self._select([HIBERNATED, STOPPED], states=['stopped'], max_age=max_age)
+        return sorted(records, key=lambda r: (r.tags[POOL_TAG] != HIBERNATED, r.launch_time or 0))
+
+    def provisioning(self, max_age: Optional[float] = None) -> list:
+        """List the instances being provisioned for the pool, by this process or another one."""
+        return self._select([PROVISIONING], states=['pending', 'running', 'stopping'], max_age=max_age)
+
+    def _tag(self, instance_ids: list, pool_state: str):
+        self.ec2.create_tags(Resources=instance_ids, Tags=[{'Key': POOL_TAG, 'Value': pool_state}])
+        iblaws.inventory.invalidate(self.ec2, instance_ids)
+
+    def _wait_for_ssm(self, instance_ids: list):
+        """Wait until the SSM agents of the instances are online, so that they accept commands."""
+        pending, deadline = set(instance_ids), time.monotonic() + self.ssm_timeout
+        while True:
+            paginator = self.ssm.get_paginator('describe_instance_information')
+            for page in paginator.paginate(Filters=[{'Key': 'InstanceIds', 'Values': sorted(pending)}]):
+                pending -= {i['InstanceId'] for i in page['InstanceInformationList'] if i['PingStatus'] == 'Online'}
+            if not pending:
+                return
+            if time.monotonic() > deadline:
+                raise WarmPoolError(f'SSM agent of {", ".join(sorted(pending))} not online after {self.ssm_timeout} s')
+            time.sleep(SSM_POLL_INTERVAL)
+
+    def _park(self, instance_ids: list) -> str:
+        """Hibernate or stop running instances and mark them as available, returns their pool state."""
+        import botocore.exceptions
+
+        pool_state = STOPPED
+        if self.hibernate:
+            try:
+                iblaws.utils.ec2_stop_instances(self.ec2, instance_ids=instance_ids, hibernate=True)
+                pool_state = HIBERNATED
+            except (botocore.exceptions.ClientError, botocore.exceptions.WaiterError) as e:
+                # the hibernation agent may not be ready yet, or the image does not support it
+                _logger.warning(f'Could not hibernate {", ".join(instance_ids)}, stopping them instead: {e}')
+        if pool_state == STOPPED:
+            iblaws.utils.ec2_stop_instances(self.ec2, instance_ids=instance_ids)
+        self._tag(instance_ids, pool_state)
+        return pool_state
+
+    def _claim(self, records: list) -> list:
+        """
+        Claim parked instances against the other processes sharing the pool and mark them as in use.
+
+        Returns
+        -------
+        list of iblaws.inventory.InstanceRecord
+            The records of the instances won, the others were claimed or started by another process.
+        """
+        token = uuid.uuid4().hex
+        instance_ids = [r.instance_id for r in records]
+        self.ec2.create_tags(Resources=instance_ids, Tags=[{'Key': CLAIM_TAG, 'Value': token}])
+        # the last claim written wins, the tags are read back once the concurrent ones are visible
+        time.sleep(CLAIM_SETTLE)
+        current = iblaws.inventory.get_inventory(self.ec2).get_many(instance_ids, max_age=0)
+        won = [
+            r
+            for r in records
+            if r.instance_id in current
+            and current[r.instance_id].state == 'stopped'
+            and current[r.instance_id].tags.get(CLAIM_TAG) == token
+            and current[r.instance_id].tags.get(POOL_TAG) in (HIBERNATED, STOPPED)
+        ]
+        if lost := sorted(set(instance_ids) - {r.instance_id for r in won}):
+            _logger.info(f'{", ".join(lost)} claimed by another process')
+        if won:
+            self._tag([r.instance_id for r in won], IN_USE)
+        return won
+
+    def _create(self, pool_state: str) -> iblaws.compute.InstanceManager:
+        """Launch and prepare a new instance, terminated if it could not be prepared."""
+        instance = iblaws.compute.InstanceManager.create_instance(
+            self.ami_id,
+            self.instance_type,
+            self.instance_region,
+            volume_id=self.volume_id,
+            tags={POOL_TAG: pool_state},
+            hibernation=self.hibernate,
+        )
+        instance.instance_store_scratch = self.instance_store_scratch
+        try:
+            instance.prepare_instance(instance.public_ip)
+            self._wait_for_ssm([instance.instance_id])
+        except Exception:
+            self.terminate([instance.instance_id])
+            raise
+        return instance
+
+    def _provision_one(self) -> str:
+        instance = self._create(PROVISIONING)
+        try:
+            self._park([instance.instance_id])
+        except Exception:
+            self.terminate([instance.instance_id])
+            raise
+        return instance.instance_id
+
+    def provision(self, n: int = 1) -> list:
+        """
+        Launch, prepare and park new instances concurrently.
+
+        Parameters
+        ----------
+        n : int
+            Number of instances.
+
+        Returns
+        -------
+        list of str
+            The IDs of the parked instances, the failures are logged and omitted.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self._provision_one) for _ in range(n)]
+        instance_ids = []
+        for future in futures:
+            try:
+                instance_ids.append(future.result())
+            except Exception:
+                _logger.exception('Could not provision a warm pool instance')
+        _logger.info(f'Parked {len(instance_ids)}/{n} new instances in the warm pool')
+        return instance_ids
+
+    def _start(self, records: list) -> list:
+        """
+        Start claimed instances and resume them.
+
+        On failure, the instances that could not be resumed are terminated and the others are parked back, so that
+        none of them stays tagged in use.
+        """
+        instance_ids = [r.instance_id for r in records]
+        hibernated = {r.instance_id for r in records if r.tags[POOL_TAG] == HIBERNATED}
+        failed = []
+        try:
+            public_ips = iblaws.utils.ec2_start_instances(self.ec2, instance_ids=instance_ids)
+            iblaws.compute.register_alyx_access(public_ips, prefix_list_id=self.prefix_list_id)
+            instances = [
+                iblaws.compute.InstanceManager(instance_id, self.instance_region, self.volume_id, self.instance_store_scratch)
+                for instance_id in public_ips
+            ]
+
+            def resume(instance):
+                instance.public_ip = public_ips[instance.instance_id]
+                # a hibernated instance resumes with its mounts, the instance store is wiped by any stop
+                if instance.instance_id not in hibernated or self.instance_store_scratch:
+                    instance.prepare_instance(instance.public_ip)
+
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {instance.instance_id: executor.submit(resume, instance) for instance in instances}
+            if failed := [instance_id for instance_id, future in futures.items() if future.exception() is not None]:
+                raise futures[failed[0]].exception()
+            self._wait_for_ssm(instance_ids)
+        except Exception:
+            _logger.error(f'Could not start {", ".join(instance_ids)}, giving them back to the pool')
+            if failed:
+                self.terminate(failed)
+            if parked := [instance_id for instance_id in instance_ids if instance_id not in failed]:
+                self._park(parked)
+            raise
+        return instances
+
+    def acquire(self, n: int = 1, refill: bool = True) -> list:
+        """
+        Start parked instances, the instances missing from the pool are launched and prepared cold.
+
+        Parameters
+        ----------
+        n : int
+            Number of instances.
+        refill : bool
+            Refill the pool in background afterwards.
+
+        Returns
+        -------
+        list of iblaws.compute.InstanceManager
+            The running instances, ready to receive commands, with their `public_ip` set.
+        """
+        records, tried = [], set()
+        with self._lock:
+            # claimed before the start, so that no other caller hands them out
+            for _ in range(CLAIM_ATTEMPTS):
+                candidates = [r for r in self.parked(max_age=0) if r.instance_id not in tried][: n - len(records)]
+                if not candidates:
+                    break
+                tried.update(r.instance_id for r in candidates)
+                records.extend(self._claim(candidates))
+                if len(records) == n:
+                    break
+        instances = self._start(records) if records else []
+        if missing := n - len(instances):
+            _logger.warning(f'The warm pool is short of {missing} instances, launching them cold')
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [executor.submit(self._create, IN_USE) for _ in range(missing)]
+            # the instances that could not be prepared are terminated by `_create`, the others are given back
+            if errors := [f.exception() for f in futures if f.exception() is not None]:
+                self.release(instances + [f.result() for f in futures if f.exception() is None])
+                raise errors[0]
+            instances.extend(f.result() for f in futures)
+        _logger.info(f'Acquired {len(instances)} instances, {len(instances) - missing} from the warm pool')
+        if refill:
+            self.refill()
+        return instances
+
+    def release(self, instances: list) -> dict:
+        """
+        Park instances handed out by `acquire` back in the pool, the ones beyond its size are terminated.
+
+        Returns
+        -------
+        dict
+            Instance ID to pool state, or 'terminated'.
+        """
+        instance_ids = [instance.instance_id for instance in instances]
+        with self._lock:
+            room = max(self.size - len(self.parked(max_age=0)) - len(self.provisioning(max_age=0)), 0)
+        keep, extra = instance_ids[:room], instance_ids[room:]
+        states = {}
+        if keep:
+            pool_state = self._park(keep)
+            states.update({instance_id: pool_state for instance_id in keep})
+        if extra:
+            self.terminate(extra)
+            states.update({instance_id: 'terminated' for instance_id in extra})
+        return states
+
+    def terminate(self, instance_ids: list):
+        _logger.info(f'Terminating EC2 instances {", ".join(instance_ids)}...')
+        self.ec2.terminate_instances(InstanceIds=instance_ids)
+        iblaws.inventory.invalidate(self.ec2, instance_ids)
+
+    def refill(self, wait: bool = False) -> Optional[threading.Thread]:
+        """
+        Provision the instances missing from the pool in a background thread, unless a refill is running already.
+
+        Parameters
+        ----------
+        wait : bool
+            Wait for the pool to be refilled.
+
+        Returns
+        -------
+        threading.Thread or None
+            The refill thread, None if the pool is full.
+        """
+        with self._lock:
+            thread = self._refill_thread
+            if thread is None or not thread.is_alive():
+                missing = self.size - len(self.parked(max_age=0)) - len(self.provisioning(max_age=0))
+                if missing <= 0:
+                    return None
+                _logger.info(f'Refilling the warm pool with {missing} instances')
+                thread = threading.Thread(target=self.provision, args=(missing,), name='warm-pool-refill', daemon=True)
+                self._refill_thread = thread
+                thread.start()
+        if wait:
+            thread.join()
+        return thread
+
+    def close(self):
+        """Wait for the running refill, an interrupted provisioning leaves a running instance behind."""
+        thread = self._refill_thread
+        if thread is not None:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
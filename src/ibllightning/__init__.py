@@ -0,0 +1,34 @@
+"""
+ONE and data handler flavours for the Lightning AI studios, where the data is read from a mounted S3 bucket.
+
+The classes are loaded on first access so that importing the package, for example for the paths below, does not
+import ONE and ibllib.
+"""
+
+from pathlib import Path
+
+S3_MOUNT_DATA_PATH = Path('/teamspace/s3_connections/ibl-brain-wide-map-private/data')
+CACHE_REST = Path('/teamspace/studios/this_studio/Downloads/ONE/s3mount')
+LIGHTNING_AI_PATCH_PATH = Path('/teamspace/studios/this_studio/data')
+
+# public name -> submodule defining it
+_LAZY_ATTRIBUTES = {
+    'OneLightningAI': 'one',
+    'LightningAIDataHandler': 'data_handlers',
+}
+
+__all__ = ['S3_MOUNT_DATA_PATH', 'CACHE_REST', 'LIGHTNING_AI_PATCH_PATH', 'OneLightningAI', 'LightningAIDataHandler']
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        import importlib
+
+        value = getattr(importlib.import_module(f'{__name__}.{_LAZY_ATTRIBUTES[name]}'), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(__all__)
@@ -0,0 +1,166 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+
+from ibllib.oneibl.data_handlers import SDSCDataHandler
+from ibllib.oneibl.patcher import FLATIRON_MOUNT, S3Patcher
+from one.alf.path import add_uuid_string
+
+import iblaws.metrics
+from iblaws.s3 import DEFAULT_PART_SIZE, MultipartUploader
+from ibllightning import S3_MOUNT_DATA_PATH, LIGHTNING_AI_PATCH_PATH
+
+_logger = logging.getLogger(__name__)
+
+# parts uploaded at the same time across all datasets, and datasets read at the same time
+UPLOAD_CONCURRENCY = 16
+UPLOAD_DATASETS = 4
+
+
+class DatasetUploadError(RuntimeError):
+    """Raised when a registered dataset could not be uploaded."""
+
+
+class ParallelS3Patcher(S3Patcher):
+    """
+    S3 patcher pipelining the registration, the upload and the checksum of the datasets.
+
+    The datasets are registered on Alyx one by one, so that the upload of a dataset starts as soon as it is
+    registered while the next ones are. Each file is read once: its parts are uploaded concurrently while its MD5 is
+    computed, and the hash is then set on the dataset record, instead of reading the file a first time at registration.
+    All the Alyx requests are sent from a single thread, the upload threads only send S3 requests.
+    """
+
+    def __init__(self, one=None, max_concurrency=UPLOAD_CONCURRENCY, max_datasets=UPLOAD_DATASETS, part_size=DEFAULT_PART_SIZE):
+        super().__init__(one=one)
+        self.max_datasets = max_datasets
+        # `S3Patcher` holds the S3 resource and the bucket name
+        self.uploader = MultipartUploader(iblaws.metrics.instrument(self.s3.meta.client), max_concurrency, part_size)
+        self._local = threading.local()
+
+    def _scp(self, local_path, remote_path, dry=True):
+        key = PurePosixPath(self.s3_path).joinpath(PurePosixPath(remote_path).relative_to(FLATIRON_MOUNT))
+        _logger.info(f'Transferring file {local_path} to {key}')
+        if not dry:
+            self._local.md5 = self.uploader.upload(local_path, self.bucket, key.as_posix())
+        return 0, ''
+
+    def _register(self, file, **kwargs):
+        """Register a dataset and get the flatiron path it is uploaded to, as `Patcher._patch_dataset` does."""
+        with iblaws.metrics.span('upload_data.register'):
+            record = self.register_dataset([file], **kwargs)
+            record = record[0] if isinstance(record, list) else record
+            dset = self.one.alyx.rest('datasets', 'read', id=record['id'])
+        fr = next(fr for fr in dset['file_records'] if 'flatiron' in fr['data_repository'])
+        remote_path = add_uuid_string(Path(fr['data_repository_path']).joinpath(fr['relative_path']), record['id']).as_posix()
+        if remote_path.startswith('/'):
+            return record, PurePosixPath(FLATIRON_MOUNT + remote_path)
+        return record, PurePosixPath(FLATIRON_MOUNT, remote_path)
+
+    def _update_records(self, record, md5):
+        with iblaws.metrics.span('upload_data.set_hash'):
+            self.one.alyx.rest('datasets', 'partial_update', id=record['id'], data={'hash': md5})
+        record['hash'] = md5
+        # the registration flags the file as existing on flatiron, where it is not copied, see `S3Patcher.patch_dataset`
+        fr_server = next(filter(lambda fr: 'flatiron' in fr['data_repository'], record['file_records']))
+        self.one.alyx.rest('files', 'partial_update', id=fr_server['id'], data={'exists': False})
+
+    def _upload(self, file, registration, alyx):
+        record, remote_path = registration.result()
+        # the registration client moves the file into its revision folder
+        path = Path(file)
+        if record['revision'] and f'#{record["revision"]}' not in str(path):
+            path = path.parent.joinpath(f'#{record["revision"]}#', path.name)
+        try:
+            with iblaws.metrics.span('upload_data.upload'):
+                self._scp(path, remote_path, dry=False)
+        except Exception as e:
+            raise DatasetUploadError(f'Error uploading file {file}') from e
+        progress = self.uploader.progress()
+        _logger.info(
+            f'Uploaded {progress["files_uploaded"]}/{progress["files_total"]} datasets, '
+            f'{progress["bytes_uploaded"] / 1024**3:.2f} GiB at {progress["throughput"] / 1024**2:.1f} MiB/s'
+        )
+        return record, alyx.submit(self._update_records, record, self._local.md5)
+
+    def patch_dataset(self, file_list, dry=False, ftp=False, force=False, **kwargs):
+        file_list = [Path(f) for f in (file_list if isinstance(file_list, list) else [file_list])]
+        if dry:
+            return super().patch_dataset(file_list, dry=dry, force=force, **kwargs)
+        exists = self.check_datasets(file_list)
+        if len(exists) > 0 and not force:
+            _logger.error(f'Files: {", ".join([f.name for f in exists])} already exist, to force set force=True')
+            return
+        # the hashes are computed while the files are uploaded rather than at registration
+        kwargs = {'repository': self.s3_repo, 'max_md5_size': 0, **kwargs}
+        # the versions are given per file
+        versions = kwargs.pop('versions', None)
+        versions = versions if isinstance(versions, list) else [versions] * len(file_list)
+        # a single thread keeps the Alyx requests in order: each registration, then the hash and file record updates
+        with (
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix='alyx') as alyx,
+            ThreadPoolExecutor(max_workers=self.max_datasets, thread_name_prefix='upload') as datasets,
+        ):
+            registrations = [alyx.submit(self._register, f, versions=v, **kwargs) for f, v in zip(file_list, versions)]
+            uploads = [datasets.submit(self._upload, f, r, alyx) for f, r in zip(file_list, registrations)]
+            try:
+                results = [upload.result() for upload in uploads]
+                for _, updates in results:
+                    updates.result()
+            except BaseException:
+                for future in registrations + uploads:
+                    future.cancel()
+                raise
+        return [record for record, _ in results]
+
+
+class LightningAIDataHandler(SDSCDataHandler):
+    # local folder mirroring the S3 mount layout, holding copies of some of the input files
+    staging_path = None
+
+    def __init__(self, session_path, signatures, one=None):
+        super().__init__(session_path, signatures, one=one)
+        self.patch_path = Path(LIGHTNING_AI_PATCH_PATH)
+        self.root_path = Path(S3_MOUNT_DATA_PATH)
+
+    @classmethod
+    def staged(cls, staging_path):
+        """
+        Get a data handler class linking the input files to their copies in a staging folder when there are some.
+
+        :param staging_path: local folder with the layout of the S3 mount, as filled by `ibllightning.prefetch`
+        :return: a subclass of this data handler, to pass as the `data_handler_class` of a task
+        """
+        return type(cls.__name__, (cls,), {'staging_path': Path(staging_path)})
+
+    def setUp(self, task, **kwargs):
+        """Symlinks the input files of the task from the S3 mount, or from the staging folder."""
+        output = super().setUp(task, **kwargs)
+        if self.staging_path is not None:
+            for link in Path(task.session_path).rglob('*'):
+                if not link.is_symlink() or not link.readlink().is_relative_to(self.root_path):
+                    continue
+                staged = self.staging_path.joinpath(link.readlink().relative_to(self.root_path))
+                if staged.exists():
+                    link.unlink()
+                    link.symlink_to(staged)
+        return output
+
+    def cleanUp(self, **_):
+        """Symlinks are preserved until registration."""
+        pass
+
+    def uploadData(self, outputs, version, max_concurrency=UPLOAD_CONCURRENCY, max_datasets=UPLOAD_DATASETS, **kwargs):
+        """
+        Function to upload and register data of completed task via S3 patcher
+        :param outputs: output files from task to register
+        :param version: ibllib version
+        :param max_concurrency: number of file parts uploaded at the same time
+        :param max_datasets: number of datasets uploaded at the same time
+        :return: output info of registered datasets
+        """
+        versions = super().uploadData(outputs, version)
+        s3_patcher = ParallelS3Patcher(one=self.one, max_concurrency=max_concurrency, max_datasets=max_datasets)
+        with s3_patcher.uploader:
+            return s3_patcher.patch_dataset(outputs, created_by=self.one.alyx.user, versions=versions, **kwargs)
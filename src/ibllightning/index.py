@@ -0,0 +1,251 @@
+"""
+Persistent index of the dataset objects on the S3 mount.
+
+On the mount every path resolution is an S3 LIST or HEAD request. The `DatasetIndex` maps each dataset of the ONE
+cache tables to its UUID-suffixed object path relative to the mount root, so that the files are resolved without
+touching the mount. The index is a set of numpy arrays, memory-mapped on load and searched by bisection:
+
+- `ids.npy`: sorted dataset UUIDs as 32 hexadecimal characters, one row per dataset
+- `offsets.npy`, `paths.npy`: the object path of each row, UTF-8 encoded and concatenated
+- `keys.npy`, `key_rows.npy`: sorted 16 bytes digests of (eid, relative path) and the row of each
+
+Each update writes a new version directory and then switches the `CURRENT` pointer, so that readers always see a
+complete index. Updates are incremental: only the datasets added to the tables get their path computed.
+
+    index = DatasetIndex('/teamspace/studios/this_studio/Downloads/ONE/dataset_index')
+    index.update(one._cache['sessions'], one._cache['datasets'], stamp=str(one._cache['_meta']['created_time']))
+    index.path(eid, 'alf/probe00/pykilosort/spikes.times.npy')
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+_logger = logging.getLogger(__name__)
+
+_CURRENT = 'CURRENT'
+
+
+def _hex_ids(ids) -> np.ndarray:
+    """UUIDs, as strings or `uuid.UUID`, to an array of 32 hexadecimal characters."""
+    return pd.Index(ids).astype(str).str.replace('-', '').str.lower().to_numpy().astype('S32')
+
+
+def _digest(eid: str, rel_path: str) -> bytes:
+    return hashlib.blake2b(f'{str(eid).replace("-", "").lower()}/{rel_path}'.encode(), digest_size=16).digest()
+
+
+def _with_uuid(rel_path: str, dataset_id: str) -> str:
+    # same as one.alf.path.ALFPath.with_uuid: the UUID goes before the extension
+    head, _, extension = rel_path.rpartition('.')
+    return f'{head}.{dataset_id}.{extension}'
+
+
+def _gather(blob: np.ndarray, offsets: np.ndarray, rows: np.ndarray) -> tuple:
+    """Extract the concatenated byte strings of the given rows, returns the new blob and offsets."""
+    starts = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+    new_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    positions = np.repeat(starts - new_offsets[:-1], lengths) + np.arange(new_offsets[-1], dtype=np.int64)
+    return blob[positions], new_offsets
+
+
+class DatasetIndex:
+    """
+    On-disk, memory-mapped index of dataset object paths.
+
+    Parameters
+    ----------
+    index_dir : str or Path
+        Directory holding the index versions, created on the first update.
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = Path(index_dir)
+        self.reload()
+
+    def reload(self):
+        """Memory-map the current version of the index, an empty index if there is none."""
+        self.ids = np.array([], dtype='S32')
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.paths = np.array([], dtype=np.uint8)
+        self.keys = np.array([], dtype='S16')
+        self.key_rows = np.array([], dtype=np.int64)
+        self.meta = {}
+        pointer = self.index_dir.joinpath(_CURRENT)
+        if not pointer.exists():
+            return
+        version_dir = self.index_dir.joinpath(pointer.read_text().strip())
+        for name in ('ids', 'offsets', 'paths', 'keys', 'key_rows'):
+            setattr(self, name, np.load(version_dir.joinpath(f'{name}.npy'), mmap_mode='r'))
+        self.meta = json.loads(version_dir.joinpath('meta.json').read_text())
+
+    @property
+    def stamp(self) -> Optional[str]:
+        """The stamp of the tables the index was last updated from."""
+        return self.meta.get('stamp')
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _path(self, row: int) -> str:
+        return bytes(self.paths[self.offsets[row] : self.offsets[row + 1]]).decode()
+
+    def path(self, eid, rel_path: str) -> Optional[str]:
+        """
+        Get the object path of a dataset.
+
+        Parameters
+        ----------
+        eid : str or uuid.UUID
+            The session ID.
+        rel_path : str
+            The path of the dataset relative to the session, collection and revision included, e.g.
+            'alf/probe00/pykilosort/#2024-05-06#/spikes.times.npy'.
+
+        Returns
+        -------
+        str or None
+            The UUID-suffixed path relative to the mount root, None if the dataset is not in the index.
+        """
+        key = np.array(_digest(eid, rel_path), dtype='S16')
+        i = int(np.searchsorted(self.keys, key))
+        if i == len(self.keys) or self.keys[i] != key:
+            return None
+        return self._path(int(self.key_rows[i]))
+
+    def paths_from_ids(self, dataset_ids) -> list:
+        """
+        Get the object paths of datasets by ID, in a single vectorized search.
+
+        Parameters
+        ----------
+        dataset_ids : list of str or uuid.UUID
+            The dataset IDs.
+
+        Returns
+        -------
+        list of str or None
+            The UUID-suffixed paths relative to the mount root, None for the datasets not in the index.
+        """
+        hex_ids = _hex_ids(dataset_ids)
+        rows = np.searchsorted(self.ids, hex_ids)
+        found = rows < len(self.ids)
+        found[found] = self.ids[rows[found]] == hex_ids[found]
+        return [self._path(int(row)) if ok else None for row, ok in zip(rows, found)]
+
+    def session_paths_from_ids(self, dataset_ids, rel_paths) -> list:
+        """
+        Get the session paths of datasets by ID, the object paths without the UUID-suffixed relative paths.
+
+        Parameters
+        ----------
+        dataset_ids : list of str
+            The dataset IDs.
+        rel_paths : list of str
+            The paths of the datasets relative to their session.
+
+        Returns
+        -------
+        list of str or None
+            The session paths relative to the mount root, None for the datasets not in the index or indexed with
+            another relative path.
+        """
+        session_paths = []
+        for path, dataset_id, rel_path in zip(self.paths_from_ids(dataset_ids), dataset_ids, rel_paths):
+            suffix = f'/{_with_uuid(rel_path, str(dataset_id))}'
+            session_paths.append(path[: -len(suffix)] if path is not None and path.endswith(suffix) else None)
+        return session_paths
+
+    def update(self, sessions: pd.DataFrame, datasets: pd.DataFrame, stamp: Optional[str] = None) -> dict:
+        """
+        Bring the index up to date with the ONE cache tables.
+
+        The paths of the datasets already indexed are kept as is, only the new datasets are resolved, and the
+        datasets removed from the tables are dropped.
+
+        Parameters
+        ----------
+        sessions : pandas.DataFrame
+            The sessions table, indexed by eid, with columns lab, subject, date and number.
+        datasets : pandas.DataFrame
+            The datasets table, indexed by (eid, id), with column rel_path and optionally session_path.
+        stamp : str, optional
+            Identifies the version of the tables, the update is skipped if the index was built from the same stamp.
+
+        Returns
+        -------
+        dict
+            The number of datasets `added` and `removed`.
+        """
+        if stamp is not None and stamp == self.stamp:
+            return {'added': 0, 'removed': 0}
+        t0 = time.perf_counter()
+        new_ids = _hex_ids(datasets.index.get_level_values('id'))
+        keep = np.isin(self.ids, new_ids)
+        added = ~np.isin(new_ids, self.ids) if len(self.ids) else np.ones(len(new_ids), dtype=bool)
+        # resolve the paths of the new datasets only
+        new = datasets[added]
+        eids = new.index.get_level_values('eid')
+        if 'session_path' in new.columns:
+            session_paths = new['session_path'].astype(str).to_numpy()
+        else:
+            from one.converters import session_record2path
+
+            unique_eids = eids.unique().intersection(sessions.index)
+            session_path = {eid: session_record2path(sessions.loc[eid]).as_posix() for eid in unique_eids}
+            session_paths = np.array([session_path.get(eid) for eid in eids], dtype=object)
+        resolved = np.array([p is not None for p in session_paths], dtype=bool)
+        if not resolved.all():
+            _logger.warning(f'{np.sum(~resolved)} datasets without session record are not indexed')
+        new_paths, new_digests = [], []
+        for eid, dataset_id, rel_path, session_path in zip(
+            eids[resolved], new.index.get_level_values('id')[resolved], new['rel_path'][resolved], session_paths[resolved]
+        ):
+            new_paths.append(f'{session_path}/{_with_uuid(rel_path, str(dataset_id))}'.encode())
+            new_digests.append(_digest(eid, rel_path))
+        # merge the kept rows with the new ones and sort by dataset ID
+        kept_rows = np.flatnonzero(keep)
+        kept_paths, kept_offsets = _gather(np.asarray(self.paths), np.asarray(self.offsets), kept_rows)
+        digests = np.empty(len(self.ids), dtype='S16')
+        digests[np.asarray(self.key_rows)] = self.keys
+        lengths = np.fromiter(map(len, new_paths), dtype=np.int64, count=len(new_paths))
+        ids = np.concatenate([np.asarray(self.ids)[kept_rows], new_ids[added][resolved]])
+        digests = np.concatenate([digests[kept_rows], np.array(new_digests, dtype='S16')])
+        offsets = np.concatenate([kept_offsets, kept_offsets[-1] + np.cumsum(lengths)])
+        paths = np.concatenate([kept_paths, np.frombuffer(b''.join(new_paths), dtype=np.uint8)])
+        order = np.argsort(ids, kind='stable')
+        paths, offsets = _gather(paths, offsets, order)
+        ids, digests = ids[order], digests[order]
+        key_rows = np.argsort(digests, kind='stable')
+        counts = {'added': int(resolved.sum()), 'removed': int(len(self.ids) - len(kept_rows))}
+        self._write(ids, offsets, paths, digests[key_rows], key_rows, {'stamp': stamp, **counts})
+        _logger.info(f'Dataset index updated in {time.perf_counter() - t0:.1f} s: {counts}, {len(self)} datasets')
+        return counts
+
+    def _write(self, ids, offsets, paths, keys, key_rows, meta):
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        version = f'v{time.time_ns()}-{uuid.uuid4().hex[:8]}'
+        version_dir = self.index_dir.joinpath(version)
+        version_dir.mkdir()
+        for name, array in zip(('ids', 'offsets', 'paths', 'keys', 'key_rows'), (ids, offsets, paths, keys, key_rows)):
+            np.save(version_dir.joinpath(f'{name}.npy'), array)
+        version_dir.joinpath('meta.json').write_text(json.dumps(meta))
+        # the readers that memory-mapped a previous version keep their open files
+        pointer = self.index_dir.joinpath(f'{_CURRENT}.{version}')
+        pointer.write_text(version)
+        os.replace(pointer, self.index_dir.joinpath(_CURRENT))
+        for previous in self.index_dir.glob('v*'):
+            if previous.name != version:
+                shutil.rmtree(previous, ignore_errors=True)
+        self.reload()
@@ -0,0 +1,184 @@
+import functools
+import logging
+import re
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from one.alf.path import ALFPath
+from one.api import OneAlyx
+import one.params as oneparams
+
+from ibllightning import S3_MOUNT_DATA_PATH, CACHE_REST
+from ibllightning.index import DatasetIndex
+
+_logger = logging.getLogger(__name__)
+
+# the dataset UUID as an extra part of an attribute name, e.g. 'times.<uuid>', 'intervals_bpod.<uuid>metadata'
+_UUID_PART = re.compile(r'\.[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}(?![0-9a-fA-F-])')
+
+
+@functools.lru_cache(maxsize=2**16)
+def strip_uuid(key: str) -> str:
+    """
+    Remove the dataset UUID from an attribute name, 'times.<uuid>' -> 'times'.
+
+    The attribute names contain the UUID of their dataset, so the cache holds one entry per dataset loaded.
+    """
+    return _UUID_PART.sub('', key) if '-' in key else key
+
+
+def strip_uuid_keys(obj):
+    """
+    Rename in place the attributes of a loaded object to their names without dataset UUID.
+
+    The object keeps its identity and the arrays are not copied, only the keys are replaced.
+
+    Parameters
+    ----------
+    obj : dict
+        The object, an `one.alf.io.AlfBunch` as returned by `alfio.load_object`.
+
+    Returns
+    -------
+    dict
+        The same object.
+    """
+    keys = [strip_uuid(k) for k in obj]
+    if keys != list(obj):
+        values = list(obj.values())
+        obj.clear()
+        obj.update(zip(keys, values))
+    return obj
+
+
+class OneLightningAI(OneAlyx):
+    # set while a load is retried with the file checks of ONE, see `_load_checked`
+    _check_files = False
+
+    def __init__(self, *args, cache_dir=S3_MOUNT_DATA_PATH, cache_rest=CACHE_REST, index_dir=None, **kwargs):
+        if not kwargs.get('tables_dir'):
+            # Ensure parquet tables downloaded to separate location to the dataset repo
+            kwargs['tables_dir'] = oneparams.get_cache_dir()  # by default this is user downloads
+        # the dataset index lives next to the tables, it is updated each time the tables are loaded
+        self.dataset_index = DatasetIndex(index_dir or Path(kwargs['tables_dir']).joinpath('dataset_index'))
+        super().__init__(*args, cache_dir=cache_dir, cache_rest=str(cache_rest), **kwargs)
+        # assign property here as it is set by the parent OneAlyx class at init
+        self.uuid_filenames = True
+        self._update_dataset_index()
+
+    def load_cache(self, *args, **kwargs):
+        loaded_time = super().load_cache(*args, **kwargs)
+        self._update_dataset_index()
+        return loaded_time
+
+    def _update_dataset_index(self):
+        """Add the new datasets of the cache tables to the dataset index, a no-op if the tables did not change."""
+        datasets = self._cache['datasets']
+        if not datasets.empty:
+            stamp = f'{self._cache["_meta"].get("created_time")}/{len(datasets)}'
+            self.dataset_index.update(self._cache['sessions'], datasets, stamp=stamp)
+
+    def _check_filesystem(self, datasets, offline=None, update_exists=True, check_hash=True):
+        """
+        Resolve the dataset files from the dataset index, without any request to the S3 mount.
+
+        The datasets of the index flagged as existing in the cache tables are returned as is: the objects of the
+        mount are immutable and named after their UUID, so their size and hash are not checked, and a load that
+        fails to read them is retried with the checks of ONE, see `_load_checked`. The other datasets, missing from
+        the index or flagged as missing, are checked by ONE, which updates their `exists` column. The session paths
+        of the latter are also read from the index when it has them all.
+        """
+        if self._check_files or not self.uuid_filenames or len(self.dataset_index) == 0:
+            return super()._check_filesystem(datasets, offline=offline, update_exists=update_exists, check_hash=check_hash)
+        if isinstance(datasets, pd.Series):
+            # same conversion as ONE, the index has the dataset ID as last level
+            datasets = pd.DataFrame([datasets])
+            datasets.index.set_names(['eid', 'id'] if datasets.index.nlevels == 2 else ['id'], inplace=True)
+        if not isinstance(datasets, pd.DataFrame) or datasets.empty or 'exists' not in datasets.columns:
+            return super()._check_filesystem(datasets, offline=offline, update_exists=update_exists, check_hash=check_hash)
+        ids = datasets.index.get_level_values('id')
+        paths = self.dataset_index.paths_from_ids(ids)
+        indexed = np.array([path is not None for path in paths]) & datasets['exists'].fillna(False).to_numpy(dtype=bool)
+        files = [ALFPath(self.cache_dir, path) if ok else None for path, ok in zip(paths, indexed)]
+        if not indexed.all():
+            unchecked = datasets[~indexed]
+            if 'session_path' not in unchecked.columns:
+                # ONE otherwise derives the session paths of all the datasets from the sessions table
+                session_paths = self.dataset_index.session_paths_from_ids(ids[~indexed], unchecked['rel_path'])
+                if None not in session_paths:
+                    unchecked = unchecked.assign(session_path=session_paths)
+            checked = super()._check_filesystem(unchecked, offline=offline, update_exists=update_exists, check_hash=check_hash)
+            for i, file in zip(np.flatnonzero(~indexed), checked):
+                files[i] = file
+        if self.record_loaded and indexed.any():
+            # same record as ONE, which records the datasets it checked itself
+            loaded_ids = ids[indexed].to_numpy()
+            if '_loaded_datasets' in self._cache:
+                loaded_ids = np.hstack([self._cache['_loaded_datasets'], loaded_ids])
+            self._cache['_loaded_datasets'] = np.unique(loaded_ids)
+        return files
+
+    def _load_checked(self, load, *args, **kwargs):
+        """Call a load method, again with the file checks of ONE if the files resolved from the index fail to read."""
+        try:
+            return load(*args, **kwargs)
+        except (OSError, EOFError, ValueError) as e:
+            if self._check_files or len(self.dataset_index) == 0:
+                raise
+            _logger.warning(f'Could not read the datasets resolved from the index, checking the files: {e}')
+            self._check_files = True
+            try:
+                return load(*args, **kwargs)
+            finally:
+                self._check_files = False
+
+    def load_dataset(self, *args, **kwargs):
+        return self._load_checked(super().load_dataset, *args, **kwargs)
+
+    def load_datasets(self, *args, **kwargs):
+        return self._load_checked(super().load_datasets, *args, **kwargs)
+
+    def load_object(self, *args, **kwargs):
+        # call superclass method
+        obj = self._load_checked(super().load_object, *args, **kwargs)
+        if isinstance(obj, list) or not self.uuid_filenames:
+            return obj
+        return strip_uuid_keys(obj)
+
+    def load_collection(self, *args, **kwargs):
+        collection = self._load_checked(super().load_collection, *args, **kwargs)
+        if isinstance(collection, list) or not self.uuid_filenames:
+            return collection
+        for obj in collection.values():
+            strip_uuid_keys(obj)
+        return collection
+
+    def _download_datasets(self, dset, **kwargs):
+        """Simply return list of None."""
+        urls = self._dset2url(dset, update_cache=False)  # normalizes input to list
+        return [None] * len(urls)
+
+
+def _test_one_sdsc():
+    """
+    I have put the tests here
+    :return:
+    """
+    from brainbox.io.one import SpikeSortingLoader, SessionLoader
+
+    one = OneLightningAI()
+    pid = '069c2674-80b0-44b4-a3d9-28337512967f'
+    eid, _ = one.pid2eid(pid)
+    dsets = one.list_datasets(eid=eid)
+    assert len(dsets) > 0
+    # checks that this is indeed the short key version when using load object
+    trials = one.load_object(eid, obj='trials')
+    assert 'intervals' in trials
+    # checks that this is indeed the short key version when using the session loader and spike sorting loader
+    sl = SessionLoader(eid=eid, one=one)  # noqa
+    sl.load_wheel()
+    assert 'position' in sl.wheel.columns
+    ssl = SpikeSortingLoader(pid=pid, one=one)
+    channels = ssl.load_channels()
+    assert channels['x'].size == 384
@@ -0,0 +1,201 @@
+"""
+Background staging of the raw data of the next items of a processing loop into local scratch.
+
+While an item is processed, the `Prefetcher` copies the files of the next ones from the S3 mount to the scratch
+disk, so that the processing reads local files and the network transfer overlaps with the GPU work. At most `depth`
+items are staged ahead, and an item is only staged if the disk keeps `reserve` free bytes for the processing
+itself, waiting for the staged copies of the previous items to be removed. An item that cannot be staged is
+processed from the mount as before.
+
+    prefetcher = Prefetcher(lambda pid: raw_ephys_files(one, pid))
+    for pid, staging_dir in prefetcher.iterate(pids):
+        run_spike_sorting(pid, staging_dir)
+"""
+
+import logging
+import os
+import shutil
+import threading
+from pathlib import Path
+from queue import Queue
+from typing import Callable, Iterable, Optional
+
+_logger = logging.getLogger(__name__)
+
+SCRATCH_DIR = Path(os.getenv('SCRATCH_DIR', '/mnt/s0/scratch'))
+RAW_EPHYS_EXTENSIONS = ('.cbin', '.ch', '.meta')
+# free space left on the scratch disk for the processing, the spike sorting decompresses the raw data there
+DEFAULT_RESERVE = 200 * 1024**3
+
+
+def raw_ephys_files(one, pid: str) -> list:
+    """
+    Get the raw ephys files of a probe on the S3 mount, as (source, relative destination) pairs.
+
+    The destinations keep the layout of the mount, so that a staging folder can stand in for the mount root.
+
+    Parameters
+    ----------
+    one : ibllightning.OneLightningAI
+        The ONE instance, its dataset index resolves the object paths.
+    pid : str
+        The probe insertion ID.
+
+    Returns
+    -------
+    list of (Path, str)
+        The files, the missing ones omitted.
+    """
+    eid, pname = one.pid2eid(pid)
+    datasets = one.list_datasets(eid, collection=f'raw_ephys_data/{pname}', details=True)
+    datasets = datasets[datasets['rel_path'].str.endswith(RAW_EPHYS_EXTENSIONS)]
+    paths = one.dataset_index.paths_from_ids(datasets.index.get_level_values('id'))
+    return [(Path(one.cache_dir, p), p) for p in paths if p is not None]
+
+
+class Prefetcher:
+    """
+    Stage the files of the next items of a loop in background, with disk space guardrails.
+
+    Parameters
+    ----------
+    resolve : callable
+        Takes an item and returns its files as (source, relative destination) pairs.
+    scratch_dir : str or Path
+        The local scratch folder, the items are staged in its `prefetch` subfolder.
+    depth : int
+        Number of items staged ahead of the one processed.
+    reserve : int
+        Free bytes the scratch disk must keep once an item is staged.
+    timeout : float
+        Seconds to wait for space to be freed on the disk before giving up staging an item.
+    """
+
+    def __init__(
+        self,
+        resolve: Callable[[object], list],
+        scratch_dir=SCRATCH_DIR,
+        depth: int = 1,
+        reserve: int = DEFAULT_RESERVE,
+        timeout: float = 3600,
+    ):
+        self.resolve = resolve
+        self.staging_root = Path(scratch_dir).joinpath('prefetch')
+        self.depth = depth
+        self.reserve = reserve
+        self.timeout = timeout
+        self._freed = threading.Condition()
+        self._cancelled = threading.Event()
+
+    def _free_space(self) -> int:
+        self.staging_root.mkdir(parents=True, exist_ok=True)
+        return shutil.disk_usage(self.staging_root).free
+
+    def _wait_for_space(self, size: int, staged: int) -> bool:
+        """Wait until the disk can take `size` bytes, while other items are `staged` and may be removed."""
+        with self._freed:
+            while self._free_space() - size < self.reserve:
+                if staged == 0 or self._cancelled.is_set() or not self._freed.wait(timeout=self.timeout):
+                    return False
+                staged -= 1
+        return True
+
+    def stage(self, item, staged: int = 0) -> Optional[Path]:
+        """
+        Copy the files of an item to its staging folder.
+
+        Parameters
+        ----------
+        item : object
+            The item, its string representation names the staging folder.
+        staged : int
+            Number of items currently staged, whose removal may free space for this one.
+
+        Returns
+        -------
+        Path or None
+            The staging folder, None if the item could not be staged.
+        """
+        try:
+            files = self.resolve(item)
+            size = sum(Path(source).stat().st_size for source, _ in files)
+        except Exception:
+            _logger.exception(f'{item}: cannot resolve the files to prefetch')
+            return None
+        if not self._wait_for_space(size, staged):
+            _logger.warning(f'{item}: not enough space on {self.staging_root} to prefetch {size / 1024**3:.1f} GiB')
+            return None
+        staging_dir = self.staging_root.joinpath(str(item))
+        try:
+            for source, destination in files:
+                destination = staging_dir.joinpath(destination)
+                if destination.exists() and destination.stat().st_size == Path(source).stat().st_size:
+                    continue
+                destination.parent.mkdir(parents=True, exist_ok=True)
+                # an interrupted copy never leaves a file that looks complete
+                partial = destination.with_name(f'{destination.name}.part')
+                shutil.copyfile(source, partial)
+                os.replace(partial, destination)
+                if self._cancelled.is_set():
+                    raise InterruptedError('prefetch cancelled')
+        except Exception:
+            _logger.exception(f'{item}: prefetch failed')
+            self.remove(item)
+            return None
+        _logger.info(f'{item}: prefetched {len(files)} files, {size / 1024**3:.1f} GiB')
+        return staging_dir
+
+    def remove(self, item):
+        """Delete the staging folder of an item and wake up the stage waiting for space."""
+        shutil.rmtree(self.staging_root.joinpath(str(item)), ignore_errors=True)
+        with self._freed:
+            self._freed.notify_all()
+
+    def iterate(self, items: Iterable):
+        """
+        Iterate over the items while the next ones are staged in a background thread.
+
+        The staging folder of an item is removed when the next item is requested, or when the loop exits.
+
+        Yields
+        ------
+        object
+            The item.
+        Path or None
+            Its staging folder, None if it could not be staged and should be read from the mount.
+        """
+        items = list(items)
+        queue, slots = Queue(), threading.Semaphore(max(self.depth, 1))
+        self._cancelled.clear()
+
+        def run():
+            for i, item in enumerate(items):
+                # a slot is taken until the item is handed over to the loop
+                slots.acquire()
+                if self._cancelled.is_set():
+                    break
+                # the items that may be removed to make space: the one processed and the ones staged ahead
+                queue.put((item, self.stage(item, staged=queue.qsize() + (i > 0))))
+            queue.put(None)
+
+        thread = threading.Thread(target=run, name='prefetch', daemon=True)
+        thread.start()
+        finished = False
+        try:
+            while (entry := queue.get()) is not None:
+                slots.release()
+                try:
+                    yield entry
+                finally:
+                    self.remove(entry[0])
+            finished = True
+        finally:
+            if not finished:
+                # stop staging and remove what was staged ahead, the thread always ends with the sentinel
+                self._cancelled.set()
+                slots.release()
+                with self._freed:
+                    self._freed.notify_all()
+                while (entry := queue.get()) is not None:
+                    self.remove(entry[0])
+            thread.join()
@@ -0,0 +1,89 @@
+import iblaws.commands
+
+
+def _mock_ssm(mocker, statuses):
+    """An SSM client whose listings return the successive statuses of each command on instances i-0 and i-1."""
+    ssm = mocker.Mock()
+    polls = {(command_id, i): iter(s) for command_id, s in statuses.items() for i in ('i-0', 'i-1')}
+    last = {}
+
+    def status(key):
+        last[key] = next(polls[key], last.get(key))
+        return last[key]
+
+    def paginate(CommandId, InstanceId=None, PaginationConfig=None):
+        instance_ids = [InstanceId] if InstanceId else ['i-0', 'i-1']
+        invocations = [{'CommandId': CommandId, 'InstanceId': i, 'Status': status((CommandId, i))} for i in instance_ids]
+        # one page per invocation to exercise the pagination
+        return [{'CommandInvocations': [invocation]} for invocation in invocations]
+
+    ssm.get_paginator.return_value.paginate.side_effect = paginate
+    return ssm
+
+
+def test_command_tracker_batches_lookups(mocker):
+    ssm = _mock_ssm(mocker, {'cmd0': ['InProgress', 'Success'], 'cmd1': ['InProgress', 'Failed'], 'cmd2': ['Success']})
+    tracker = iblaws.commands.CommandTracker(ssm, min_interval=0)
+    callback = mocker.Mock()
+    futures = [tracker.track(f'cmd{i}', 'i-0', callback=callback) for i in range(3)]
+    assert tracker.wait(timeout=5)
+    assert [f.result()['Status'] for f in futures] == ['Success', 'Failed', 'Success']
+    assert callback.call_count == 3
+    # one listing per due command: three in the first poll, two in the second
+    paginate = ssm.get_paginator.return_value.paginate
+    assert paginate.call_count == 5
+    assert all('Filters' not in c.kwargs for c in paginate.call_args_list)
+
+
+def test_command_tracker_groups_instances_by_command(mocker):
+    ssm = _mock_ssm(mocker, {'cmd0': ['InProgress', 'Success']})
+    tracker = iblaws.commands.CommandTracker(ssm, min_interval=0)
+    futures = [tracker.track('cmd0', instance_id) for instance_id in ('i-0', 'i-1')]
+    assert tracker.wait(timeout=5)
+    assert [f.result()['InstanceId'] for f in futures] == ['i-0', 'i-1']
+    # the invocations of a command on its instances are read from one listing, not restricted to an instance
+    paginate = ssm.get_paginator.return_value.paginate
+    assert paginate.call_count == 2
+    paginate.assert_called_with(CommandId='cmd0', PaginationConfig={'PageSize': 50})
+
+
+def test_command_tracker_adaptive_schedule(mocker):
+    monotonic = mocker.patch('iblaws.commands.time.monotonic', return_value=0.0)
+    ssm = _mock_ssm(mocker, {'cmd0': ['InProgress'] * 12})
+    tracker = iblaws.commands.CommandTracker(ssm, min_interval=10, max_interval=600)
+    tracker.track('cmd0', 'i-0', expected_duration=3_600)
+    delays = []
+    for _ in range(12):
+        delays.append(tracker.next_poll_delay())
+        monotonic.return_value += delays[-1]
+        tracker.poll()
+    # halves the time left until the expected completion, then backs off exponentially from min_interval
+    assert delays == [600, 600, 600, 600, 600, 300, 150, 75, 37.5, 18.75, 10, 20]
+    ssm.get_paginator.return_value.paginate.assert_called_with(
+        CommandId='cmd0', InstanceId='i-0', PaginationConfig={'PageSize': 50}
+    )
+
+
+def test_command_tracker_background_thread(mocker):
+    ssm = _mock_ssm(mocker, {'cmd0': ['InProgress', 'Success']})
+    tracker = iblaws.commands.CommandTracker(ssm, min_interval=0.01)
+    tracker.start()
+    try:
+        assert tracker.track('cmd0', 'i-0').result(timeout=5)['Status'] == 'Success'
+    finally:
+        tracker.stop()
+    assert tracker.pending == 0
+
+
+def test_command_tracker_discard(mocker):
+    ssm = _mock_ssm(mocker, {'cmd0': ['InProgress']})
+    tracker = iblaws.commands.CommandTracker(ssm, min_interval=0)
+    callback = mocker.Mock()
+    future = tracker.track('cmd0', 'i-0', callback=callback)
+    tracker.poll()
+    assert tracker.discard('cmd0', 'i-0', status='Interrupted')
+    assert future.result() == {'CommandId': 'cmd0', 'InstanceId': 'i-0', 'Status': 'Interrupted'}
+    callback.assert_called_once_with(future.result())
+    # the command is no longer looked up
+    assert tracker.pending == 0 and tracker.poll(force=True) == []
+    assert not tracker.discard('cmd0', 'i-0')
@@ -1,4 +1,28 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
 import iblaws.compute
+import iblaws.history
+import iblaws.prefix_lists
+
+
+@pytest.fixture(autouse=True)
+def clear_firewall_state():
+    iblaws.compute._PUBLIC_IP_CACHE.clear()
+    iblaws.compute._LEASES.clear()
+
+
+def _registered(mock_writer):
+    """Return the (description, cidr, expiry) of the entries registered through the writer."""
+    registered = []
+    for call in mock_writer.submit_many.call_args_list:
+        (sweep, (action, description, cidr)) = call.args[0]
+        assert sweep == ('sweep', '') and action == 'replace'
+        registered.append((*iblaws.prefix_lists.parse_description(description), cidr))
+    return registered
 
 
 def test_manage_firewall_access_removes_ip_after_execution(mocker):
@@ -10,9 +34,9 @@ def test_manage_firewall_access_removes_ip_after_execution(mocker):
     mock_public_ip = '123.45.67.89'
     mocker.patch('iblaws.compute._get_public_ip', return_value=mock_public_ip)
 
-    # Mock the EC2 utility functions
-    mock_remove = mocker.patch('iblaws.utils.ec2_remove_managed_prefix_list_item')
-    mock_add = mocker.patch('iblaws.utils.ec2_add_managed_prefix_list_item')
+    # Mock the prefix list writer
+    mock_get_writer = mocker.patch('iblaws.prefix_lists.get_prefix_list_writer')
+    mock_writer = mock_get_writer.return_value
 
     # Create a test function to decorate
     @iblaws.compute.manage_firewall_access(worker=42)
@@ -26,31 +50,24 @@ def test_manage_firewall_access_removes_ip_after_execution(mocker):
     assert result == 'result'
 
     # Verify AWS client was initialized properly
-    mock_get_service_client.assert_called_once_with(service_name='ec2', region_name='eu-west-2')
-
-    # Check that the IP was added before execution
-    mock_add.assert_called_once_with(
-        mock_ec2,
-        managed_prefix_list_id=iblaws.compute.HTTPS_PREFIX_LIST_ID,
-        description='Lightning AI Worker #42',
-        cidrip=f'{mock_public_ip}/32',
-    )
+    mock_get_service_client.assert_called_with(service_name='ec2', region_name='eu-west-2')
+    mock_get_writer.assert_called_with(mock_ec2, iblaws.compute.HTTPS_PREFIX_LIST_ID)
+
+    # Check that the IP was added before execution, replacing any stale entry and sweeping the expired entries
+    # of other workers in a single modification
+    [(description, expires, cidr)] = _registered(mock_writer)
+    assert (description, cidr) == ('Lightning AI Worker #42', f'{mock_public_ip}/32')
+    assert expires > time.time() + iblaws.compute.FIREWALL_LEASE_TTL - 60
 
     # Verify the IP was removed after execution (which is the main purpose of this test)
-    assert mock_remove.call_count == 2  # Called once before (try block) and once after execution
-    mock_remove.assert_called_with(
-        mock_ec2, managed_prefix_list_id=iblaws.compute.HTTPS_PREFIX_LIST_ID, description='Lightning AI Worker #42'
-    )
+    mock_writer.remove.assert_called_once_with('Lightning AI Worker #42', ignore_errors=True)
 
 
 def test_manage_firewall_access_adds_ip_to_prefix_list(mocker):
     # Mock dependencies
     mock_get_public_ip = mocker.patch('iblaws.compute._get_public_ip', return_value='192.168.1.1')
-    mock_get_service_client = mocker.patch('iblaws.utils.get_service_client')
-    mock_ec2 = mocker.MagicMock()
-    mock_get_service_client.return_value = mock_ec2
-    mock_remove_prefix_item = mocker.patch('iblaws.utils.ec2_remove_managed_prefix_list_item')
-    mock_add_prefix_item = mocker.patch('iblaws.utils.ec2_add_managed_prefix_list_item')
+    mocker.patch('iblaws.utils.get_service_client')
+    mock_writer = mocker.patch('iblaws.prefix_lists.get_prefix_list_writer').return_value
 
     # Create a test function and apply the decorator
     @iblaws.compute.manage_firewall_access()
@@ -62,13 +79,235 @@ def test_manage_firewall_access_adds_ip_to_prefix_list(mocker):
 
     # Verify the decorator behavior
     mock_get_public_ip.assert_called_once()
-    mock_get_service_client.assert_called_once_with(service_name='ec2', region_name='eu-west-2')
-    mock_remove_prefix_item.assert_called()
-    mock_add_prefix_item.assert_called_once_with(
-        mock_ec2,
-        managed_prefix_list_id=iblaws.compute.HTTPS_PREFIX_LIST_ID,
-        description='Lightning AI Worker #42',
-        cidrip='192.168.1.1/32',
-    )
+    assert [(d, cidr) for d, _, cidr in _registered(mock_writer)] == [('Lightning AI Worker #42', '192.168.1.1/32')]
+    mock_writer.remove.assert_called_once()
     assert result == 'test result'
-    assert mock_remove_prefix_item.call_count == 2  # Called before and after
+
+    # the public IP is cached for the next task
+    test_function(worker_id=42)
+    mock_get_public_ip.assert_called_once()
+    assert mock_writer.submit_many.call_count == 2
+
+
+def test_manage_firewall_access_shares_entry_between_overlapping_tasks(mocker):
+    mocker.patch('iblaws.compute._get_public_ip', return_value='192.168.1.1')
+    mocker.patch('iblaws.utils.get_service_client')
+    mock_writer = mocker.patch('iblaws.prefix_lists.get_prefix_list_writer').return_value
+    started, finish = threading.Barrier(3), threading.Event()
+
+    @iblaws.compute.manage_firewall_access(worker=7)
+    def task():
+        started.wait()
+        finish.wait()
+
+    threads = [threading.Thread(target=task) for _ in range(2)]
+    for t in threads:
+        t.start()
+    started.wait()
+    # both tasks are running: one entry, still registered
+    assert iblaws.compute.FirewallLease('Lightning AI Worker #07').count == 2
+    mock_writer.submit_many.assert_called_once()
+    mock_writer.remove.assert_not_called()
+    finish.set()
+    for t in threads:
+        t.join()
+    mock_writer.remove.assert_called_once_with('Lightning AI Worker #07', ignore_errors=True)
+
+
+def test_firewall_lease_linger_and_async(mocker):
+    mocker.patch('iblaws.compute._get_public_ip', return_value='192.168.1.1')
+    mocker.patch('iblaws.utils.get_service_client')
+    mock_writer = mocker.patch('iblaws.prefix_lists.get_prefix_list_writer').return_value
+
+    @iblaws.compute.manage_firewall_access(worker=8, linger=60)
+    async def task():
+        return 'done'
+
+    assert asyncio.run(task()) == 'done'
+    assert asyncio.run(task()) == 'done'
+    # back-to-back tasks reuse the entry during the grace period
+    mock_writer.submit_many.assert_called_once()
+    mock_writer.remove.assert_not_called()
+    lease = iblaws.compute.FirewallLease('Lightning AI Worker #08')
+    lease._state.timer.cancel()
+    lease._expire()
+    mock_writer.remove.assert_called_once_with('Lightning AI Worker #08', ignore_errors=True)
+
+
+def test_firewall_lease_renewal(mocker):
+    mocker.patch('iblaws.compute._get_public_ip', return_value='192.168.1.1')
+    mocker.patch('iblaws.utils.get_service_client')
+    mock_writer = mocker.patch('iblaws.prefix_lists.get_prefix_list_writer').return_value
+    with iblaws.compute.FirewallLease('Lightning AI Worker #09', ttl=1) as lease:
+        time.sleep(0.7)
+        assert mock_writer.submit_many.call_count == 2  # renewed after half the lifetime
+    assert lease._state.renewal is None
+    mock_writer.remove.assert_called_once_with('Lightning AI Worker #09', ignore_errors=True)
+    # an entry without expiry
+    with iblaws.compute.FirewallLease('Lightning AI Worker #10', ttl=None):
+        mock_writer.replace.assert_called_once_with('Lightning AI Worker #10', '192.168.1.1/32')
+
+
+def test_firewall_lease_renewal_retries_after_a_failure(mocker):
+    mocker.patch('iblaws.compute._get_public_ip', return_value='192.168.1.1')
+    mocker.patch('iblaws.utils.get_service_client')
+    mock_writer = mocker.patch('iblaws.prefix_lists.get_prefix_list_writer').return_value
+    mock_writer.submit_many.side_effect = [mocker.MagicMock(), RuntimeError('Throttling'), mocker.MagicMock()]
+    with iblaws.compute.FirewallLease('Lightning AI Worker #11', ttl=1) as lease:
+        time.sleep(0.5)
+        # the first renewal fails after half the lifetime and is retried a quarter of the remaining lifetime later
+        assert lease._state.renewal is not None and lease._state.renewal.is_alive()
+        time.sleep(0.3)
+        assert mock_writer.submit_many.call_count == 3
+        assert lease._state.expires > time.time() + 0.5
+    assert lease._state.renewal is None
+
+
+def _mock_instance(mocker, instance_id, statuses):
+    """An InstanceManager whose successive commands go through the given lists of statuses, one per poll."""
+    instance = mocker.Mock(spec=iblaws.compute.InstanceManager)
+    instance.instance_id = instance_id
+    instance.run_command.side_effect = [f'{instance_id}-cmd{i}' for i in range(len(statuses))]
+    polls = {f'{instance_id}-cmd{i}': iter(s) for i, s in enumerate(statuses)}
+
+    def paginate(CommandId, InstanceId, **kwargs):
+        # each instance runs a single command at a time, that the tracker looks up by id
+        return [{'CommandInvocations': [{'CommandId': CommandId, 'InstanceId': InstanceId, 'Status': next(polls[CommandId])}]}]
+
+    instance.ssm.get_paginator.return_value.paginate.side_effect = paginate
+    return instance
+
+
+def test_fleet_scheduler_spreads_pids_over_instances(mocker):
+    mocker.patch('iblaws.compute.time.sleep')
+    instances = [_mock_instance(mocker, f'i-{i}', [['InProgress', 'Success']] * 2) for i in range(3)]
+    scheduler = iblaws.compute.FleetScheduler(instances, min_poll_interval=0)
+    pids = [f'pid{i}' for i in range(6)]
+    results = scheduler.run(pids)
+    assert results == {pid: 'Success' for pid in pids}
+    assert [instance.run_command.call_count for instance in instances] == [2, 2, 2]
+    # the three instances run concurrently: two rounds of two polls each
+    assert iblaws.compute.time.sleep.call_count == 4
+    instances[0].run_command.assert_any_call('/home/ubuntu/entrypoint.sh pid0', time_out_seconds=7_200, comment='pid0')
+
+
+def test_fleet_scheduler_requeues_failures(mocker):
+    mocker.patch('iblaws.compute.time.sleep')
+    instances = [_mock_instance(mocker, 'i-0', [['Failed'], ['Success'], ['InProgress', 'TimedOut']])]
+    scheduler = iblaws.compute.FleetScheduler(instances, max_retries=1, min_poll_interval=0)
+    results = scheduler.run(['pid0', 'pid1'])
+    # pid0 fails and is retried after pid1, pid1 succeeds, then the retry of pid0 times out
+    assert results == {'pid1': 'Success', 'pid0': 'TimedOut'}
+    assert scheduler.attempts == {'pid0': 2, 'pid1': 1}
+
+
+def test_start_fleet_registers_all_ips_at_once(mocker):
+    ec2 = mocker.Mock()
+    mocker.patch('iblaws.utils.get_service_client', return_value=ec2)
+    mocker.patch('iblaws.utils.ec2_start_instances', return_value={'i-1': '1.1.1.1', 'i-2': '2.2.2.2'})
+    update_rules = mocker.patch('iblaws.utils.ec2_update_security_group_rules')
+    writer = mocker.patch('iblaws.prefix_lists.get_prefix_list_writer').return_value
+    prepare = mocker.patch('iblaws.compute.InstanceManager.prepare_instance')
+
+    instances = iblaws.compute.InstanceManager.start_fleet(
+        'us-east-1', tags={'Flottille': 'iblsorter'}, prefix_list_id=iblaws.compute.HTTPS_PREFIX_LIST_ID
+    )
+    assert [im.instance_id for im in instances] == ['i-1', 'i-2']
+    update_rules.assert_called_once_with(
+        ec2, security_group_id=iblaws.compute.ALYX_SECURITY_GROUP_ID, rules={'i-1': '1.1.1.1/32', 'i-2': '2.2.2.2/32'}
+    )
+    writer.submit_many.assert_called_once_with([('replace', 'i-1', '1.1.1.1/32'), ('replace', 'i-2', '2.2.2.2/32')])
+    assert sorted(c.args[0] for c in prepare.call_args_list) == ['1.1.1.1', '2.2.2.2']
+
+
+def test_fleet_scheduler_dispatches_longest_first(mocker):
+    mocker.patch('iblaws.compute.time.sleep')
+    history = iblaws.history.RunHistory(':memory:')
+    # the predictions also schedule the status checks: short run times keep the test fast
+    for pid, run_seconds in [('short', 0.001), ('long', 0.05), ('medium', 0.01)]:
+        history.record(pid, 'Success', 'g6.4xlarge', run_seconds=run_seconds)
+    instance = _mock_instance(mocker, 'i-0', [['Success']] * 3)
+    instance.instance_type = 'g6.4xlarge'
+    scheduler = iblaws.compute.FleetScheduler([instance], min_poll_interval=0, history=history)
+    assert scheduler.run(['short', 'medium', 'long']) == {'long': 'Success', 'medium': 'Success', 'short': 'Success'}
+    assert [c.kwargs['comment'] for c in instance.run_command.call_args_list] == ['long', 'medium', 'short']
+    # the runs are recorded
+    assert [r.pid for r in history.runs()[3:]] == ['long', 'medium', 'short']
+    assert {r.instance_type for r in history.runs()} == {'g6.4xlarge'}
+
+
+def test_fleet_scheduler_records_the_phases(mocker):
+    mocker.patch('iblaws.compute.time.sleep')
+    history = iblaws.history.RunHistory(':memory:')
+    instance = _mock_instance(mocker, 'i-0', [['Success']] * 2)
+    instance.instance_type = 'g6.4xlarge'
+    instance.prepare_seconds = 30.0
+    report = 'sorting\niblaws-report sort=100.0 upload=5.5 data_bytes=1000 recording_seconds=600.0\n'
+    instance.ssm.get_command_invocation.return_value = {'StandardOutputContent': report}
+    scheduler = iblaws.compute.FleetScheduler([instance], min_poll_interval=0, history=history)
+    assert scheduler.run(['pid0', 'pid1']) == {'pid0': 'Success', 'pid1': 'Success'}
+    instance.ssm.get_command_invocation.assert_called_with(CommandId='i-0-cmd1', InstanceId='i-0')
+    runs = {r.pid: r for r in history.runs()}
+    # the preparation of the instance is recorded with its first pid only
+    assert (runs['pid0'].prepare_seconds, runs['pid1'].prepare_seconds) == (30.0, None)
+    assert {(r.sort_seconds, r.upload_seconds, r.data_bytes, r.recording_seconds) for r in runs.values()} == {
+        (100.0, 5.5, 1000, 600.0)
+    }
+
+
+def test_fleet_scheduler_requeues_interrupted_spot_pids(mocker):
+    mocker.patch('iblaws.compute.time.sleep')
+    ec2 = mocker.Mock()
+    # the interruption notice comes at the second check
+    requests = [{'InstanceId': 'i-0', 'Status': {'Code': 'marked-for-termination'}}]
+    ec2.get_paginator.return_value.paginate.side_effect = [[{'SpotInstanceRequests': []}], [{'SpotInstanceRequests': requests}]]
+    spot = _mock_instance(mocker, 'i-0', [['InProgress'] * 3, []])
+    spot.spot, spot.ec2 = True, ec2
+    replacement = _mock_instance(mocker, 'i-1', [['Success']])
+    replace = mocker.Mock(return_value=replacement)
+    scheduler = iblaws.compute.FleetScheduler(
+        [spot],
+        min_poll_interval=0,
+        replace=replace,
+        checkpoint_template='/home/ubuntu/checkpoint.sh {pid}',
+        interruption_poll_interval=0,
+    )
+    assert scheduler.run(['pid0']) == {'pid0': 'Success'}
+    # the pid is checkpointed, then resumed on the replacement without using its retry budget
+    spot.run_command.assert_called_with('/home/ubuntu/checkpoint.sh pid0', time_out_seconds=110, comment='checkpoint pid0')
+    replace.assert_called_once_with(spot)
+    replacement.run_command.assert_called_once()
+    assert scheduler.attempts == {'pid0': 1} and scheduler.interruptions == {'pid0': 1}
+    assert scheduler.instances == [replacement]
+
+
+def test_fleet_scheduler_cancels_stalled_commands(mocker, tmp_path):
+    mocker.patch('iblaws.compute.time.sleep')
+    monotonic = mocker.patch('iblaws.logs.time.monotonic', return_value=0.0)
+    tracker_poll = iblaws.commands.CommandTracker.poll
+
+    def poll(tracker, *args, **kwargs):
+        # each status check of the commands comes 400 s after the previous one
+        monotonic.return_value += 400
+        return tracker_poll(tracker, *args, **kwargs)
+
+    mocker.patch('iblaws.commands.CommandTracker.poll', autospec=True, side_effect=poll)
+    # the first attempt prints a progress bar then hangs until it is cancelled
+    instance = _mock_instance(mocker, 'i-0', [['InProgress', 'InProgress', 'Cancelled'], ['Success']])
+    instance.instance_type = 'g6.4xlarge'
+    tmp_path.joinpath('pid0-1.log').write_bytes(b'Extracting spikes:  45%|####5     | 450/1000\n')
+    history = iblaws.history.RunHistory(':memory:')
+    scheduler = iblaws.compute.FleetScheduler(
+        [instance],
+        min_poll_interval=0,
+        history=history,
+        log_uri_template=str(tmp_path / '{pid}-{attempt}.log'),
+        stall_timeout=600,
+    )
+    assert scheduler.run(['pid0']) == {'pid0': 'Success'}
+    instance.run_command.assert_any_call(
+        '/home/ubuntu/entrypoint.sh pid0', time_out_seconds=7_200, comment='pid0', log_uri=str(tmp_path / 'pid0-1.log')
+    )
+    instance.cancel_command.assert_called_once_with('i-0-cmd0')
+    assert [r.status for r in history.runs()] == ['Stalled', 'Success']
+    assert scheduler.logs['pid0'].source.path == tmp_path / 'pid0-2.log'
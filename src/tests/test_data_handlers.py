@@ -0,0 +1,96 @@
+import threading
+import uuid
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip('ibllib')
+
+from ibllightning.data_handlers import DatasetUploadError, ParallelS3Patcher  # noqa: E402
+
+SESSION = 'cortexlab/Subjects/KS023/2019-12-10/001'
+
+
+def _patcher(mocker, n_datasets=3, fail=None):
+    """A patcher whose Alyx and S3 requests are recorded with the thread sending them, the upload of `fail` fails."""
+    mocker.patch('ibllib.oneibl.patcher.get_s3_from_alyx', return_value=(mocker.MagicMock(), 'bucket'))
+    calls, records = [], {}
+
+    def record(*args):
+        calls.append((threading.current_thread().name, *args))
+
+    def register_dataset(file_list, **kwargs):
+        file = Path(file_list[0])
+        record('register', file.name)
+        records[file.name] = {
+            'id': str(uuid.uuid4()),
+            'revision': None,
+            'file_records': [
+                {'id': f'fr-{file.name}', 'data_repository': 'flatiron_cortexlab'},
+                {'id': f's3-{file.name}', 'data_repository': 's3_patcher'},
+            ],
+        }
+        return [records[file.name]]
+
+    def rest(endpoint, action, id=None, data=None):
+        record(endpoint, action, id, data)
+        if (endpoint, action) == ('datasets', 'read'):
+            name = next(name for name, r in records.items() if r['id'] == id)
+            return {
+                'file_records': [
+                    {'data_repository': 's3_patcher'},
+                    {
+                        'data_repository': 'flatiron_cortexlab',
+                        'data_repository_path': '/cortexlab/',
+                        'relative_path': f'{SESSION}/alf/{name}',
+                    },
+                ]
+            }
+
+    def upload(local_path, bucket, key):
+        record('upload', Path(local_path).name, key)
+        if Path(local_path).name == fail:
+            raise ConnectionError('connection reset')
+        return f'md5-{Path(local_path).name}'
+
+    one = mocker.Mock()
+    one.alyx.rest.side_effect = rest
+    patcher = ParallelS3Patcher(one=one, max_datasets=2)
+    mocker.patch.object(patcher, 'check_datasets', return_value=[])
+    mocker.patch.object(patcher, 'register_dataset', side_effect=register_dataset)
+    mocker.patch.object(patcher.uploader, 'upload', side_effect=upload)
+    files = [Path('/mnt/s0', SESSION, 'alf', f'spikes.attr{i}.npy') for i in range(n_datasets)]
+    return patcher, files, calls, records
+
+
+def test_parallel_s3_patcher(mocker):
+    patcher, files, calls, records = _patcher(mocker)
+    response = patcher.patch_dataset(files, versions=['1.0.0'] * 3)
+    assert [r['id'] for r in response] == [records[f.name]['id'] for f in files]
+    # all the Alyx requests are sent from the same thread, the datasets registered in order
+    alyx_calls = [c for c in calls if c[1] != 'upload']
+    assert {c[0] for c in alyx_calls} == {'alyx_0'}
+    assert all(c[0].startswith('upload') for c in calls if c[1] == 'upload')
+    assert [c[2] for c in alyx_calls if c[1] == 'register'] == [f.name for f in files]
+    for file in files:
+        dataset_id = records[file.name]['id']
+        # uploaded to the flatiron path of the dataset, with its UUID
+        key = f'patcher/cortexlab/{SESSION}/alf/{file.stem}.{dataset_id}.npy'
+        assert ('upload', file.name, key) in [c[1:] for c in calls]
+        # then the hash set and the flatiron file record flagged as missing
+        register = alyx_calls.index(('alyx_0', 'register', file.name))
+        set_hash = alyx_calls.index(('alyx_0', 'datasets', 'partial_update', dataset_id, {'hash': f'md5-{file.name}'}))
+        flag = alyx_calls.index(('alyx_0', 'files', 'partial_update', f'fr-{file.name}', {'exists': False}))
+        assert register < set_hash < flag
+        assert records[file.name]['hash'] == f'md5-{file.name}'
+
+
+def test_parallel_s3_patcher_failed_upload(mocker):
+    patcher, files, calls, records = _patcher(mocker, fail='spikes.attr1.npy')
+    with pytest.raises(DatasetUploadError, match='spikes.attr1.npy') as e:
+        patcher.patch_dataset(files)
+    assert isinstance(e.value.__cause__, ConnectionError)
+    # the dataset that failed keeps the flatiron file record of its registration and gets no hash
+    assert not [c for c in calls if c[1:3] == ('files', 'partial_update') and c[3] == 'fr-spikes.attr1.npy']
+    assert 'hash' not in records['spikes.attr1.npy']
+    assert ('alyx_0', 'files', 'partial_update', 'fr-spikes.attr0.npy', {'exists': False}) in calls
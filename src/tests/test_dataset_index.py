@@ -0,0 +1,59 @@
+import uuid
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+pytest.importorskip('one')
+
+from ibllightning.index import DatasetIndex  # noqa: E402
+
+
+def _tables(n_sessions=3, n_datasets=4):
+    eids = [str(uuid.uuid4()) for _ in range(n_sessions)]
+    sessions = pd.DataFrame(
+        {'lab': 'cortexlab', 'subject': 'KS023', 'date': ['2019-12-10'] * n_sessions, 'number': range(1, n_sessions + 1)},
+        index=pd.Index(eids, name='id'),
+    )
+    records = [
+        (eid, str(uuid.uuid4()), f'alf/probe00/#2024-05-06#/spikes.attr{i}.npy') for eid in eids for i in range(n_datasets)
+    ]
+    datasets = pd.DataFrame(
+        {'rel_path': [r[2] for r in records]},
+        index=pd.MultiIndex.from_tuples([r[:2] for r in records], names=['eid', 'id']),
+    )
+    return sessions, datasets
+
+
+def test_dataset_index(tmp_path):
+    sessions, datasets = _tables()
+    index = DatasetIndex(tmp_path)
+    assert len(index) == 0
+    assert index.update(sessions, datasets, stamp='v1') == {'added': 12, 'removed': 0}
+    assert index.update(sessions, datasets, stamp='v1') == {'added': 0, 'removed': 0}
+    eid, dataset_id = datasets.index[5]
+    expected = f'cortexlab/Subjects/KS023/2019-12-10/002/alf/probe00/#2024-05-06#/spikes.attr1.{dataset_id}.npy'
+    assert index.path(eid, 'alf/probe00/#2024-05-06#/spikes.attr1.npy') == expected
+    assert index.path(eid, 'alf/probe00/spikes.attr1.npy') is None
+    assert index.paths_from_ids([dataset_id, uuid.uuid4()]) == [expected, None]
+    rel_paths = ['alf/probe00/#2024-05-06#/spikes.attr1.npy', 'alf/probe00/spikes.attr1.npy']
+    assert index.session_paths_from_ids([dataset_id, dataset_id], rel_paths) == ['cortexlab/Subjects/KS023/2019-12-10/002', None]
+    # a new reader memory-maps the persisted index
+    reader = DatasetIndex(tmp_path)
+    assert isinstance(reader.ids, np.memmap)
+    assert reader.paths_from_ids(datasets.index.get_level_values('id')) == index.paths_from_ids(
+        datasets.index.get_level_values('id')
+    )
+    # incremental update: 3 datasets removed, 4 added from a new session with a session path column
+    new_sessions, new_datasets = _tables(n_sessions=1)
+    new_datasets['session_path'] = 'hoferlab/Subjects/SWC_043/2020-09-21/001'
+    tables = pd.concat([datasets.iloc[3:], new_datasets])
+    assert index.update(pd.concat([sessions, new_sessions]), tables, stamp='v2') == {'added': 4, 'removed': 3}
+    assert len(index) == 13
+    assert index.paths_from_ids(datasets.index.get_level_values('id')[:3]) == [None] * 3
+    assert index.paths_from_ids(datasets.index.get_level_values('id')[3:]) == reader.paths_from_ids(
+        datasets.index.get_level_values('id')[3:]
+    )
+    eid, dataset_id = new_datasets.index[0]
+    assert index.path(eid, new_datasets['rel_path'].iloc[0]).startswith('hoferlab/Subjects/SWC_043/2020-09-21/001/alf/')
+    assert len(list(tmp_path.glob('v*'))) == 1
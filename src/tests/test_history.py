@@ -0,0 +1,31 @@
+import pytest
+
+from iblaws.history import RunHistory
+
+
+def test_run_history(tmp_path):
+    history = RunHistory(tmp_path.joinpath('history.sqlite'))
+    history.record('pid0', 'Success', 'g6.4xlarge', timings={'queue': 5, 'sort': 3000, 'upload': 600}, recording_seconds=3600)
+    history.record('pid0', 'Success', 'g4dn.4xlarge', run_seconds=7200, recording_seconds=3600)
+    history.record('pid1', 'Failed', 'g6.4xlarge', run_seconds=10)
+    history.record('pid2', 'Success', 'g6.4xlarge', run_seconds=1200, recording_seconds=1200)
+    with pytest.raises(ValueError):
+        history.record('pid3', 'Success', timings={'decompress': 1})
+    history.close()
+    # the history persists across instances
+    history = RunHistory(tmp_path.joinpath('history.sqlite'))
+    assert [r.run_seconds for r in history.runs(pid='pid0')] == [3600, 7200]
+    assert history.runs(status='Failed')[0].queue_seconds is None
+    # same pid on the same machine, then on any machine if the type has no record
+    assert history.predict('pid0', 'g6.4xlarge') == 3600
+    assert history.predict('pid0', 'L4') == 5400
+    # new pid: the median rate of the machine, 1 s per recording second on g6, times the recording duration
+    assert history.predict('pid4', 'g6.4xlarge', recording_seconds=600) == 600
+    # no recording duration: the median of the runs on the machine, failed runs excluded
+    assert history.predict('pid1', 'g6.4xlarge') == 2400
+    assert RunHistory(':memory:').predict('pid0') is None
+    ordered, predictions = history.order_longest_first(
+        ['pid2', 'pid4', 'pid0', 'pid5'], 'g6.4xlarge', recording_seconds={'pid4': 6000}
+    )
+    assert ordered == ['pid4', 'pid0', 'pid5', 'pid2']
+    assert predictions['pid5'] == 2400
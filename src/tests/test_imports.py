@@ -0,0 +1,31 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+# modules that must not be imported by a worker that only needs the firewall decorator
+HEAVY_MODULES = ('boto3', 'botocore', 'paramiko', 'pydantic', 'dotenv', 'requests', 'one', 'ibllib')
+# generous budget in seconds, the import takes about 50 ms once the heavy modules are deferred, 600 ms otherwise
+IMPORT_TIME_BUDGET = 0.3
+
+SCRIPT = """
+import json, sys, time
+t0 = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - t0
+print(json.dumps({{'elapsed': elapsed, 'loaded': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def _import_in_subprocess(module):
+    script = SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+    result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True)
+    return json.loads(result.stdout)
+
+
+@pytest.mark.parametrize('module', ['iblaws.compute', 'iblaws.utils', 'ibllightning'])
+def test_import_is_lazy(module):
+    result = _import_in_subprocess(module)
+    assert result['loaded'] == []
+    assert result['elapsed'] < IMPORT_TIME_BUDGET
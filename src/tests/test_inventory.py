@@ -0,0 +1,79 @@
+import iblaws.inventory
+import iblaws.utils
+
+
+def _instance(instance_id, state='running', **kwargs):
+    return {
+        'InstanceId': instance_id,
+        'State': {'Name': state},
+        'InstanceType': 'g6.4xlarge',
+        'Tags': [{'Key': 'Flottille', 'Value': 'iblsorter'}],
+        'BlockDeviceMappings': [{'DeviceName': '/dev/sda1', 'Ebs': {'VolumeId': f'vol-{instance_id}'}}],
+        **kwargs,
+    }
+
+
+def _mock_ec2(mocker, instances):
+    ec2 = mocker.Mock()
+
+    def paginate(InstanceIds=None, Filters=None):
+        selected = [i for i in instances if InstanceIds is None or i['InstanceId'] in InstanceIds]
+        # two pages to exercise the pagination
+        return [{'Reservations': [{'Instances': selected[:1]}]}, {'Reservations': [{'Instances': selected[1:]}]}]
+
+    ec2.get_paginator.return_value.paginate.side_effect = paginate
+    return ec2
+
+
+def test_inventory_ttl_and_invalidation(mocker):
+    monotonic = mocker.patch('iblaws.inventory.time.monotonic', return_value=0.0)
+    instances = [_instance(f'i-{i}', PublicIpAddress=f'1.1.1.{i}') for i in range(3)]
+    ec2 = _mock_ec2(mocker, instances)
+    paginate = ec2.get_paginator.return_value.paginate
+    inventory = iblaws.inventory.InstanceInventory(ec2, ttl=30)
+
+    records = inventory.get_many(['i-0', 'i-1', 'i-2'])
+    assert paginate.call_count == 1
+    assert records['i-1'].public_ip == '1.1.1.1'
+    assert records['i-1'].tags == {'Flottille': 'iblsorter'}
+    assert records['i-1'].volumes == {'/dev/sda1': 'vol-i-1'}
+    # served from the cache within the TTL
+    assert inventory.get('i-2').state == 'running'
+    assert paginate.call_count == 1
+    # explicit invalidation after a state change
+    instances[2]['State']['Name'] = 'stopped'
+    inventory.invalidate(['i-2'])
+    assert inventory.get('i-2').state == 'stopped'
+    paginate.assert_called_with(InstanceIds=['i-2'])
+    # expired records are refreshed together
+    monotonic.return_value = 31.0
+    inventory.get_many(['i-0', 'i-1'])
+    paginate.assert_called_with(InstanceIds=['i-0', 'i-1'])
+    assert paginate.call_count == 3
+
+
+def test_inventory_select_is_cached(mocker):
+    ec2 = _mock_ec2(mocker, [_instance('i-0'), _instance('i-1')])
+    inventory = iblaws.inventory.get_inventory(ec2)
+    assert iblaws.inventory.get_inventory(ec2) is inventory
+    records = inventory.select(tags={'Flottille': 'iblsorter'}, states=['running'])
+    assert [r.instance_id for r in records] == ['i-0', 'i-1']
+    assert [r.instance_id for r in inventory.select(tags={'Flottille': 'iblsorter'}, states=['running'])] == ['i-0', 'i-1']
+    ec2.get_paginator.return_value.paginate.assert_called_once_with(
+        Filters=[{'Name': 'tag:Flottille', 'Values': ['iblsorter']}, {'Name': 'instance-state-name', 'Values': ['running']}]
+    )
+    iblaws.inventory.invalidate(ec2)
+    inventory.select(tags={'Flottille': 'iblsorter'}, states=['running'])
+    assert ec2.get_paginator.return_value.paginate.call_count == 2
+
+
+def test_public_ip_is_described_afresh(mocker):
+    instances = [_instance('i-0', PublicIpAddress='1.1.1.1')]
+    ec2 = _mock_ec2(mocker, instances)
+    paginate = ec2.get_paginator.return_value.paginate
+    assert iblaws.utils.ec2_get_public_ip(ec2, 'i-0') == '1.1.1.1'
+    # restarted outside of the helpers, with a new IP: the cached record is not used
+    instances[0]['PublicIpAddress'] = '2.2.2.2'
+    assert iblaws.utils.ec2_get_public_ip(ec2, 'i-0') == '2.2.2.2'
+    assert iblaws.utils.ec2_get_public_ip(ec2, 'i-0', max_age=None) == '2.2.2.2'
+    assert paginate.call_count == 2
@@ -0,0 +1,74 @@
+import json
+
+import iblaws.history
+import iblaws.lightning
+
+
+class FakeJob:
+    def __init__(self, statuses):
+        self._statuses = iter(statuses)
+        self._status = 'Pending'
+
+    @property
+    def status(self):
+        self._status = next(self._statuses, self._status)
+        return self._status
+
+
+class FakeStudio:
+    """Stand-in for `lightning_sdk.Studio`, the jobs of each pid go through the given lists of statuses."""
+
+    def __init__(self, statuses):
+        self.statuses = {pid: iter(attempts) for pid, attempts in statuses.items()}
+        self.jobs = []  # (name, command, job)
+
+    def run_job(self, command, machine, name):
+        job = FakeJob(next(self.statuses[command.split()[2]]))
+        self.jobs.append((name, command, job))
+        return job
+
+    def running(self):
+        return [name for name, _, job in self.jobs if job._status not in iblaws.lightning.TERMINAL_STATUSES]
+
+
+def test_job_fan_out(mocker, tmp_path):
+    studio = FakeStudio(
+        {
+            'pid0': [['Running', 'Completed']],
+            'pid1': [['Running', 'Running', 'Failed'], ['Completed']],
+            'pid2': [['Completed']],
+            'pid3': [['Failed'], ['Stopped']],
+        }
+    )
+    concurrency = []
+    mocker.patch('iblaws.lightning.time.sleep', side_effect=lambda _: concurrency.append(len(studio.running())))
+    history = iblaws.history.RunHistory(':memory:')
+    fan_out = iblaws.lightning.JobFanOut(
+        studio, machine='L4', max_concurrency=2, first_worker_id=7, history=history, summary_path=tmp_path / 'summary.json'
+    )
+    results = fan_out.run(['pid0', 'pid1', 'pid2', 'pid3'])
+    assert results == {'pid0': 'Completed', 'pid2': 'Completed', 'pid1': 'Completed', 'pid3': 'Stopped'}
+    assert fan_out.attempts == {'pid0': 1, 'pid1': 2, 'pid2': 1, 'pid3': 2}
+    # never more than two jobs at once, each one with one of the two worker ids
+    assert max(concurrency) == 2
+    assert {command.split()[-1] for _, command, _ in studio.jobs} == {'7', '8'}
+    assert studio.jobs[0][:2] == ('pid0-1', 'python spike_sort.py pid0 --worker-id 7')
+    # the worker ids of the jobs running together are distinct
+    running = {}
+    for run in sorted(fan_out.runs, key=lambda r: r.submitted_at):
+        running = {w: r for w, r in running.items() if r.finished_at > run.submitted_at}
+        assert run.worker_id not in running
+        running[run.worker_id] = run
+    summary = json.loads((tmp_path / 'summary.json').read_text())
+    assert summary['statuses'] == {'Completed': 3, 'Stopped': 1}
+    assert [a['status'] for a in summary['pids']['pid1']['attempts']] == ['Failed', 'Completed']
+    assert [r.status for r in history.runs(pid='pid3')] == ['Failed', 'Stopped']
+
+
+def test_job_fan_out_undeliverable(mocker):
+    mocker.patch('iblaws.lightning.time.sleep')
+    studio = mocker.Mock()
+    studio.run_job.side_effect = RuntimeError('quota exceeded')
+    fan_out = iblaws.lightning.JobFanOut(studio, machine='L4', max_retries=2)
+    assert fan_out.run(['pid0']) == {'pid0': 'Undeliverable'}
+    assert studio.run_job.call_count == 3
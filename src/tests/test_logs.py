@@ -0,0 +1,85 @@
+import asyncio
+import os
+import subprocess
+
+import botocore.exceptions
+import pytest
+
+import iblaws.logs
+
+
+def test_stream_command_keeps_output_and_status(tmp_path):
+    log_path, tmp_dir = tmp_path / 'pid0.log', tmp_path / 'tmp'
+    tmp_dir.mkdir()
+    command = iblaws.logs.stream_command("printf 'sorting\\n 50%%|##  | 1/2\\r100%%|####| 2/2\\n' && exit 3", str(log_path), 0.1)
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        subprocess.run(['sh', '-c', command], capture_output=True, check=True, env={**os.environ, 'TMPDIR': str(tmp_dir)})
+    assert e.value.returncode == 3
+    assert log_path.read_bytes() == e.value.stdout == b'sorting\n 50%|##  | 1/2\r100%|####| 2/2\n'
+    # the local copy of the log and the exit status file are removed
+    assert list(tmp_dir.iterdir()) == []
+
+
+def test_command_log_tails_incrementally(mocker, tmp_path):
+    monotonic = mocker.patch('iblaws.logs.time.monotonic', return_value=0.0)
+    log_path = tmp_path / 'pid0.log'
+    on_stall = mocker.Mock()
+    log = iblaws.logs.CommandLog(iblaws.logs.LocalLogSource(log_path), poll_interval=10, stall_timeout=60, on_stall=on_stall)
+    assert log.poll() == []  # not copied yet
+    log_path.write_bytes(b'Loading data\nExtracting spikes:  45%|####5     | 450/1000\rExtr')
+    assert log.poll() == []  # not due yet
+    monotonic.return_value = 10.0
+    events = log.poll()
+    assert [e.line for e in events] == ['Loading data', 'Extracting spikes:  45%|####5     | 450/1000']
+    assert (events[1].step, events[1].progress) == ('Extracting spikes', 0.45)
+    assert log.offset == log_path.stat().st_size
+    # the partial line is completed by the next copy
+    with open(log_path, 'ab') as fp:
+        fp.write(b'acting spikes: 100%|##########| 1000/1000\r\nDone')
+    monotonic.return_value = 20.0
+    assert [e.progress for e in log.poll()] == [1.0]
+    # no output for longer than the stall timeout
+    monotonic.return_value = 90.0
+    log.poll()
+    on_stall.assert_called_once_with(log)
+    assert log.stalled and list(log.lines)[-1] == 'Extracting spikes: 100%|##########| 1000/1000'
+    monotonic.return_value = 100.0
+    assert [e.line for e in log.poll(flush=True)] == ['Done']
+    on_stall.assert_called_once()
+
+
+def test_command_log_collects_the_report(tmp_path):
+    line = iblaws.logs.report_line(sort=3600.5, upload=240.0, data_bytes=123456789, recording_seconds=None)
+    assert line == 'iblaws-report sort=3600.5 upload=240.0 data_bytes=123456789'
+    assert iblaws.logs.parse_report(f'2025-01-01 12:00:00 {line}') == {'sort': 3600.5, 'upload': 240.0, 'data_bytes': 123456789}
+    assert iblaws.logs.parse_report('sorting done') == {}
+    log_path = tmp_path / 'pid0.log'
+    log_path.write_bytes(f'sorting\niblaws-report prepare=12 status=ok\n{line}'.encode())
+    log = iblaws.logs.CommandLog(iblaws.logs.LocalLogSource(log_path))
+    log.poll(force=True, flush=True)
+    assert log.report == {'prepare': 12, 'sort': 3600.5, 'upload': 240.0, 'data_bytes': 123456789}
+
+
+def test_command_log_streams(mocker, tmp_path):
+    mocker.patch('iblaws.logs.time.sleep')
+    log_path = tmp_path / 'pid0.log'
+    log_path.write_bytes(b'line 0\nline 1')
+    done = mocker.Mock(side_effect=[False, True, False, True])
+    log = iblaws.logs.CommandLog(iblaws.logs.LocalLogSource(log_path), poll_interval=0)
+    assert [e.line for e in log.events(done)] == ['line 0', 'line 1']
+
+    async def collect():
+        return [e.line async for e in iblaws.logs.CommandLog(iblaws.logs.LocalLogSource(log_path), poll_interval=0).aevents(done)]
+
+    assert asyncio.run(collect()) == ['line 0', 'line 1']
+
+
+def test_s3_log_source_reads_byte_ranges(mocker):
+    s3 = mocker.Mock()
+    s3.get_object.return_value = {'Body': mocker.Mock(read=mocker.Mock(return_value=b'new bytes'))}
+    source = iblaws.logs.log_source('s3://my-bucket/logs/pid0.log', s3_client=s3)
+    assert source.read(1024) == b'new bytes'
+    s3.get_object.assert_called_once_with(Bucket='my-bucket', Key='logs/pid0.log', Range='bytes=1024-')
+    # the log has no new bytes yet
+    s3.get_object.side_effect = botocore.exceptions.ClientError({'Error': {'Code': 'InvalidRange'}}, 'GetObject')
+    assert source.read(1033) == b''
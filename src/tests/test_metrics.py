@@ -0,0 +1,66 @@
+import json
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+import iblaws.metrics
+
+
+@pytest.fixture
+def metrics():
+    iblaws.metrics.reset()
+    iblaws.metrics.enable()
+    yield iblaws.metrics
+    iblaws.metrics.disable()
+    iblaws.metrics.reset()
+
+
+def _client():
+    client = boto3.client('ec2', region_name='eu-west-2', aws_access_key_id='testing', aws_secret_access_key='testing')
+    return iblaws.metrics.instrument(client)
+
+
+def test_api_calls_are_recorded(metrics):
+    ec2 = _client()
+    with Stubber(ec2) as stubber:
+        stubber.add_response('describe_instances', {'Reservations': [], 'ResponseMetadata': {'RetryAttempts': 2}})
+        stubber.add_response('describe_instances', {'Reservations': []})
+        stubber.add_client_error('describe_instances', service_error_code='RequestLimitExceeded')
+        stubber.add_client_error('describe_security_groups', service_error_code='InvalidGroup.NotFound')
+        ec2.describe_instances()
+        ec2.describe_instances()
+        with pytest.raises(ec2.exceptions.ClientError):
+            ec2.describe_instances()
+        with pytest.raises(ec2.exceptions.ClientError):
+            ec2.describe_security_groups()
+        with metrics.span('start'):
+            pass
+    snapshot = metrics.snapshot()
+    describe_instances, describe_security_groups = snapshot['calls']
+    assert describe_instances['operation'] == 'DescribeInstances'
+    assert describe_instances['region'] == 'eu-west-2'
+    assert describe_instances['service'] == 'ec2'
+    assert (describe_instances['calls'], describe_instances['errors'], describe_instances['retries']) == (3, 1, 2)
+    assert describe_instances['throttles'] == 1
+    assert describe_instances['latency']['count'] == 3
+    assert (describe_security_groups['errors'], describe_security_groups['throttles']) == (1, 0)
+    assert snapshot['spans']['start']['count'] == 1
+    assert json.loads(metrics.to_json()) == snapshot
+    prometheus = metrics.to_prometheus()
+    labels = 'service="ec2",operation="DescribeInstances",region="eu-west-2"'
+    assert f'iblaws_aws_api_calls_total{{{labels}}} 3' in prometheus
+    assert f'iblaws_aws_api_throttles_total{{{labels}}} 1' in prometheus
+    assert f'iblaws_aws_api_latency_seconds_bucket{{{labels},le="+Inf"}} 3' in prometheus
+    assert 'iblaws_span_duration_seconds_count{span="start"} 1' in prometheus
+
+
+def test_nothing_is_recorded_when_disabled():
+    iblaws.metrics.reset()
+    ec2 = _client()
+    with Stubber(ec2) as stubber:
+        stubber.add_response('describe_instances', {'Reservations': []})
+        ec2.describe_instances()
+        with iblaws.metrics.span('start'):
+            pass
+    assert iblaws.metrics.snapshot() == {'calls': [], 'spans': {}}
@@ -0,0 +1,97 @@
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+pytest.importorskip('one')
+
+from one.alf.io import AlfBunch  # noqa: E402
+from one.alf.path import ALFPath  # noqa: E402
+
+from ibllightning.index import DatasetIndex  # noqa: E402
+from ibllightning.one import OneLightningAI, strip_uuid, strip_uuid_keys  # noqa: E402
+
+
+def test_strip_uuid_keys():
+    dataset_id = str(uuid.uuid4())
+    times, intervals = np.arange(10), np.zeros((10, 2))
+    obj = AlfBunch({f'times.{dataset_id}': times, f'intervals_bpod.{dataset_id}': intervals, 'rate': 1})
+    obj[f'intervals_bpod.{dataset_id}metadata'] = {'units': 's'}
+    assert strip_uuid_keys(obj) is obj
+    assert list(obj) == ['times', 'intervals_bpod', 'rate', 'intervals_bpodmetadata']
+    assert obj['times'] is times and obj['intervals_bpod'] is intervals
+    assert strip_uuid('spikes.times') == 'spikes.times'
+    # a key with a UUID not separated by a dot is kept as is
+    assert strip_uuid(f'times{dataset_id}') == f'times{dataset_id}'
+    assert strip_uuid(f'times.{dataset_id}0') == f'times.{dataset_id}0'
+
+
+def _one(tmp_path, n_datasets=3):
+    """An offline OneLightningAI on a local folder, without the cache tables download."""
+    eid = str(uuid.uuid4())
+    sessions = pd.DataFrame(
+        {'lab': ['cortexlab'], 'subject': ['KS023'], 'date': ['2019-12-10'], 'number': [1]}, index=pd.Index([eid], name='id')
+    )
+    records = [(eid, str(uuid.uuid4()), f'alf/probe00/spikes.attr{i}.npy') for i in range(n_datasets)]
+    datasets = pd.DataFrame(
+        {'rel_path': [r[2] for r in records], 'file_size': None, 'hash': None, 'exists': True},
+        index=pd.MultiIndex.from_tuples([r[:2] for r in records], names=['eid', 'id']),
+    )
+    one = OneLightningAI.__new__(OneLightningAI)
+    one.mode, one.uuid_filenames, one.record_loaded = 'local', True, True
+    one._web_client = SimpleNamespace(cache_dir=tmp_path.joinpath('mount'))
+    one._cache = {'sessions': sessions, 'datasets': datasets, '_meta': {'created_time': 'v1'}}
+    one.dataset_index = DatasetIndex(tmp_path.joinpath('index'))
+    one._update_dataset_index()
+    return one
+
+
+def test_check_filesystem_uses_the_dataset_index(tmp_path):
+    one = _one(tmp_path)
+    one._cache['datasets'].iloc[2, one._cache['datasets'].columns.get_loc('exists')] = False
+    datasets = one._cache['datasets']
+    ids = datasets.index.get_level_values('id')
+    paths = [ALFPath(one.cache_dir, p) for p in one.dataset_index.paths_from_ids(ids)]
+    # only the dataset flagged as missing is looked up on the mount, by ONE
+    paths[2].parent.mkdir(parents=True)
+    paths[2].write_bytes(b'')
+    # the session paths come from the index, the sessions table is not read
+    one._cache['sessions'] = one._cache['sessions'].iloc[:0]
+    assert one._check_filesystem(datasets) == paths
+    assert not paths[0].exists()
+    # the dataset found by ONE is flagged in the cache and all the datasets are recorded as loaded
+    assert one._cache['datasets']['exists'].tolist() == [True, True, True]
+    assert sorted(one._cache['_loaded_datasets']) == sorted(ids)
+    assert one._check_filesystem(datasets.iloc[0]) == paths[:1]
+
+
+def test_load_retries_with_the_file_checks(tmp_path):
+    one = _one(tmp_path)
+    checks = []
+
+    def load(name):
+        checks.append(one._check_files)
+        if not one._check_files:
+            raise FileNotFoundError(name)
+        return name
+
+    assert one._load_checked(load, 'spikes.times') == 'spikes.times'
+    assert checks == [False, True] and not one._check_files
+
+
+def test_check_filesystem_falls_back_to_the_sessions_table(tmp_path):
+    one = _one(tmp_path)
+    # added by a remote query after the index was updated
+    eid = one._cache['sessions'].index[0]
+    new = pd.DataFrame(
+        {'rel_path': ['alf/probe00/spikes.depths.npy'], 'file_size': None, 'hash': None, 'exists': True},
+        index=pd.MultiIndex.from_tuples([(eid, str(uuid.uuid4()))], names=['eid', 'id']),
+    )
+    one._cache['datasets'] = pd.concat([one._cache['datasets'], new])
+    path = ALFPath(one.cache_dir, 'cortexlab/Subjects/KS023/2019-12-10/001/alf/probe00/spikes.depths.npy')
+    path = path.with_uuid(new.index[0][1])
+    path.parent.mkdir(parents=True)
+    path.write_bytes(b'')
+    assert one._check_filesystem(one._cache['datasets'])[-1] == path
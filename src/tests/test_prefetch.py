@@ -0,0 +1,44 @@
+import threading
+
+from ibllightning.prefetch import Prefetcher
+
+
+def _mount(tmp_path, pids):
+    files = {}
+    for pid in pids:
+        source = tmp_path.joinpath('mount', 'lab', pid, f'raw.{pid}.cbin')
+        source.parent.mkdir(parents=True)
+        source.write_bytes(pid.encode() * 1000)
+        files[pid] = [(source, f'lab/{pid}/raw.{pid}.cbin')]
+    return files
+
+
+def test_prefetcher(tmp_path):
+    pids = ['pid0', 'pid1', 'pid2']
+    files = _mount(tmp_path, pids)
+    resolved = []
+
+    def resolve(pid):
+        resolved.append(pid)
+        return files[pid]
+
+    prefetcher = Prefetcher(resolve, scratch_dir=tmp_path.joinpath('scratch'), depth=1, reserve=0)
+    staged = []
+    for pid, staging_dir in prefetcher.iterate(pids):
+        staged.append(staging_dir.joinpath(files[pid][0][1]))
+        assert staged[-1].read_bytes() == files[pid][0][0].read_bytes()
+        # the staging of the previous pid is removed, at most one pid is staged ahead
+        assert all(not s.exists() for s in staged[:-1])
+        assert len(resolved) <= pids.index(pid) + 2
+    assert not any(prefetcher.staging_root.iterdir())
+    # early exit of the loop removes the pids staged ahead
+    for pid, staging_dir in prefetcher.iterate(pids):
+        break
+    assert not any(prefetcher.staging_root.iterdir())
+    assert not any(t.name == 'prefetch' for t in threading.enumerate())
+    # no space to stage: the pids are yielded without staging folder
+    prefetcher = Prefetcher(lambda pid: files[pid], scratch_dir=tmp_path.joinpath('scratch'), reserve=2**62, timeout=0.1)
+    assert list(prefetcher.iterate(pids)) == [(pid, None) for pid in pids]
+    # the files that cannot be resolved are not staged
+    prefetcher = Prefetcher(lambda pid: [(tmp_path.joinpath('missing'), 'missing')], scratch_dir=tmp_path.joinpath('scratch'))
+    assert list(prefetcher.iterate(pids[:1])) == [('pid0', None)]
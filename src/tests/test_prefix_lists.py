@@ -0,0 +1,164 @@
+import threading
+
+import botocore.exceptions
+import pytest
+
+from iblaws.prefix_lists import (
+    PrefixListCapacityError,
+    PrefixListPool,
+    PrefixListWriter,
+    _Intent,
+    _plan,
+    lease_description,
+    parse_description,
+)
+
+
+def _client_error(code):
+    return botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': code}}, 'ModifyManagedPrefixList')
+
+
+def _mock_ec2(mocker, entries=None, versions=(1, 2)):
+    ec2 = mocker.Mock()
+    ec2.describe_managed_prefix_lists.side_effect = [
+        {'PrefixLists': [{'Version': v, 'State': 'modify-complete'}]} for v in versions
+    ]
+    ec2.get_managed_prefix_list_entries.return_value = {'Entries': entries or []}
+    return ec2
+
+
+def test_plan_merges_intents():
+    entries = [
+        {'Cidr': '1.1.1.1/32', 'Description': 'worker 1'},
+        {'Cidr': '2.2.2.2/32', 'Description': 'worker 2'},
+    ]
+    intents = [
+        _Intent('replace', 'worker 1', '3.3.3.3/32'),
+        _Intent('remove', 'worker 2'),
+        _Intent('add', 'worker 4', '4.4.4.4/32'),
+        _Intent('add', 'worker 5', '4.4.4.4/32'),  # CIDR taken by the previous intent
+        _Intent('add', 'worker 1', '5.5.5.5/32'),  # description exists
+        _Intent('remove', 'worker 6'),
+        _Intent('remove', 'worker 6', ignore_errors=True),
+    ]
+    add_entries, remove_entries, errors = _plan(entries, intents)
+    assert add_entries == [
+        {'Cidr': '3.3.3.3/32', 'Description': 'worker 1'},
+        {'Cidr': '4.4.4.4/32', 'Description': 'worker 4'},
+    ]
+    assert remove_entries == [{'Cidr': '1.1.1.1/32'}, {'Cidr': '2.2.2.2/32'}]
+    assert sorted(errors) == [3, 4, 5]
+    assert all(isinstance(e, ValueError) for e in errors.values())
+
+
+def test_writer_coalesces_concurrent_intents(mocker):
+    ec2 = _mock_ec2(mocker, entries=[{'Cidr': '1.1.1.1/32', 'Description': 'worker 1'}])
+    writer = PrefixListWriter(ec2, 'pl-test', linger=0.2)
+    futures = []
+
+    def submit(i):
+        futures.append(writer.submit('add', f'worker {i}', f'10.0.0.{i}/32'))
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(2, 10)]
+    for t in threads:
+        t.start()
+    writer.remove('worker 1')
+    for t in threads:
+        t.join()
+    assert [f.result() for f in futures] == [2] * 8
+    ec2.modify_managed_prefix_list.assert_called_once()
+    kwargs = ec2.modify_managed_prefix_list.call_args.kwargs
+    assert kwargs['CurrentVersion'] == 1
+    assert kwargs['RemoveEntries'] == [{'Cidr': '1.1.1.1/32'}]
+    assert len(kwargs['AddEntries']) == 8
+
+
+def test_writer_retries_on_version_conflict(mocker):
+    mocker.patch('iblaws.prefix_lists.time.sleep')
+    ec2 = _mock_ec2(mocker, versions=(1, 2, 3))
+    ec2.modify_managed_prefix_list.side_effect = [_client_error('PrefixListVersionMismatch'), {}]
+    writer = PrefixListWriter(ec2, 'pl-test')
+    assert writer.add('worker 1', '10.0.0.1') == 3
+    assert ec2.modify_managed_prefix_list.call_count == 2
+    assert ec2.modify_managed_prefix_list.call_args.kwargs['CurrentVersion'] == 2
+
+
+def test_writer_errors(mocker):
+    ec2 = _mock_ec2(mocker, entries=[{'Cidr': '1.1.1.1/32', 'Description': 'worker 1'}], versions=(1,))
+    writer = PrefixListWriter(ec2, 'pl-test')
+    with pytest.raises(ValueError, match='already exists'):
+        writer.add('worker 1', '10.0.0.1/32')
+    ec2.modify_managed_prefix_list.assert_not_called()
+    ec2.describe_managed_prefix_lists.side_effect = [{'PrefixLists': [{'Version': 1, 'State': 'modify-complete'}]}]
+    ec2.modify_managed_prefix_list.side_effect = _client_error('InvalidPrefixListModification')
+    with pytest.raises(botocore.exceptions.ClientError):
+        writer.remove('worker 1')
+
+
+def test_plan_leases():
+    entries = [
+        {'Cidr': '1.1.1.1/32', 'Description': 'worker 1 [exp=100]'},
+        {'Cidr': '2.2.2.2/32', 'Description': 'worker 2 [exp=300]'},
+        {'Cidr': '3.3.3.3/32', 'Description': 'researcher'},
+    ]
+    # sweeping removes the expired entries only, replacing renews the lease of the same description
+    intents = [_Intent('sweep', ''), _Intent('replace', 'worker 2 [exp=500]', '2.2.2.2/32')]
+    add_entries, remove_entries, errors = _plan(entries, intents, now=200)
+    assert add_entries == [{'Cidr': '2.2.2.2/32', 'Description': 'worker 2 [exp=500]'}]
+    assert remove_entries == [{'Cidr': '1.1.1.1/32'}]
+    assert not errors
+    assert parse_description('worker 2 [exp=500]') == ('worker 2', 500)
+    assert parse_description('researcher') == ('researcher', None)
+    assert lease_description('worker 2', 500.7) == 'worker 2 [exp=500]'
+
+
+class _FakeEC2:
+    """Prefix lists whose modifications apply immediately."""
+
+    def __init__(self, max_entries):
+        self.lists = {pl_id: {'max_entries': n, 'version': 1, 'entries': {}} for pl_id, n in max_entries.items()}
+        self.modifications = 0
+
+    def describe_managed_prefix_lists(self, PrefixListIds):
+        return {
+            'PrefixLists': [
+                {'PrefixListId': i, 'Version': self.lists[i]['version'], 'MaxEntries': self.lists[i]['max_entries']}
+                for i in PrefixListIds
+            ]
+        }
+
+    def get_managed_prefix_list_entries(self, PrefixListId, TargetVersion=None):
+        entries = self.lists[PrefixListId]['entries']
+        return {'Entries': [{'Cidr': cidr, 'Description': d} for cidr, d in entries.items()]}
+
+    def modify_managed_prefix_list(self, PrefixListId, CurrentVersion, AddEntries=(), RemoveEntries=(), DryRun=False):
+        prefix_list = self.lists[PrefixListId]
+        assert CurrentVersion == prefix_list['version']
+        for entry in RemoveEntries:
+            prefix_list['entries'].pop(entry['Cidr'])
+        prefix_list['entries'].update({e['Cidr']: e['Description'] for e in AddEntries})
+        assert len(prefix_list['entries']) <= prefix_list['max_entries']
+        prefix_list['version'] += 1
+        self.modifications += 1
+
+
+def test_prefix_list_pool():
+    ec2 = _FakeEC2({'pl-a': 2, 'pl-b': 2})
+    ec2.lists['pl-a']['entries'] = {'9.9.9.9/32': 'researcher', '1.1.1.1/32': 'worker 1 [exp=100]'}
+    pool = PrefixListPool(ec2, ['pl-a', 'pl-b'], ttl=60, budget=3)
+    assert pool.usage()['pl-a'] == {'max_entries': 2, 'entries': 2, 'leases': 0, 'expired': 1}
+    # the expired entry is swept to make room, in the same modification as the new entry
+    assert pool.lease('worker 2', '2.2.2.2/32') == 'pl-a'
+    assert ec2.modifications == 1
+    assert ec2.lists['pl-a']['entries']['2.2.2.2/32'].startswith('worker 2 [exp=')
+    # renewal in place, then spill over to the next list
+    assert pool.lease('worker 2', '2.2.2.2/32', ttl=120) == 'pl-a'
+    assert pool.lease('worker 3', '3.3.3.3/32') == 'pl-b'
+    assert pool.lease('worker 4', '4.4.4.4/32') == 'pl-b'
+    with pytest.raises(PrefixListCapacityError):
+        pool.lease('worker 5', '5.5.5.5/32')
+    pool.release('worker 4')
+    assert '4.4.4.4/32' not in ec2.lists['pl-b']['entries']
+    ec2.lists['pl-b']['entries']['3.3.3.3/32'] = 'worker 3 [exp=100]'
+    assert pool.sweep() == {'pl-a': 0, 'pl-b': 1}
+    assert ec2.lists['pl-b']['entries'] == {}
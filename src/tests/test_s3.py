@@ -0,0 +1,60 @@
+import hashlib
+import threading
+
+import pytest
+
+from iblaws.s3 import MIN_PART_SIZE, MultipartUploader
+
+
+class _FakeS3:
+    """In-memory S3 client recording the multipart uploads, optionally failing a part."""
+
+    def __init__(self, fail_part=None):
+        self.fail_part = fail_part
+        self.objects, self.parts, self.aborted = {}, {}, []
+        self.lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+    def create_multipart_upload(self, Bucket, Key):
+        return {'UploadId': f'upload-{Key}'}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if PartNumber == self.fail_part:
+            raise ConnectionError('connection reset')
+        with self.lock:
+            self.parts[(UploadId, PartNumber)] = Body
+        return {'ETag': f'etag-{PartNumber}'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        assert [p['ETag'] for p in MultipartUpload['Parts']] == [f'etag-{p["PartNumber"]}' for p in MultipartUpload['Parts']]
+        self.objects[(Bucket, Key)] = b''.join(self.parts[(UploadId, p['PartNumber'])] for p in MultipartUpload['Parts'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append(UploadId)
+
+
+def test_multipart_upload(tmp_path):
+    data = bytes(range(256)) * (MIN_PART_SIZE // 256 * 2 + 100)
+    large, small = tmp_path.joinpath('large.bin'), tmp_path.joinpath('small.bin')
+    large.write_bytes(data)
+    small.write_bytes(data[:1000])
+    s3 = _FakeS3()
+    with MultipartUploader(s3, max_concurrency=2, part_size=MIN_PART_SIZE) as uploader:
+        assert uploader.upload(large, 'bucket', 'large.bin') == hashlib.md5(data).hexdigest()
+        assert uploader.upload(small, 'bucket', 'small.bin') == hashlib.md5(data[:1000]).hexdigest()
+    assert s3.objects[('bucket', 'large.bin')] == data
+    assert s3.objects[('bucket', 'small.bin')] == data[:1000]
+    assert len(s3.parts) == 3
+    progress = uploader.progress()
+    assert (progress['files_uploaded'], progress['bytes_uploaded']) == (2, len(data) + 1000)
+    # a failed part aborts the upload
+    s3 = _FakeS3(fail_part=2)
+    with MultipartUploader(s3, max_concurrency=2, part_size=MIN_PART_SIZE) as uploader:
+        with pytest.raises(ConnectionError):
+            uploader.upload(large, 'bucket', 'large.bin')
+    assert s3.aborted == ['upload-large.bin']
+    assert ('bucket', 'large.bin') not in s3.objects
+    with pytest.raises(ValueError):
+        MultipartUploader(s3, part_size=1024)
@@ -0,0 +1,82 @@
+import botocore.exceptions
+import pytest
+
+import iblaws.compute
+import iblaws.inventory
+import iblaws.spot
+
+
+def test_interruption_watcher(mocker):
+    monotonic = mocker.patch('iblaws.spot.time.monotonic', return_value=0.0)
+    ec2 = mocker.Mock()
+    paginate = ec2.get_paginator.return_value.paginate
+    paginate.return_value = [
+        {'SpotInstanceRequests': [{'InstanceId': 'i-0', 'Status': {'Code': 'fulfilled'}}]},
+        {
+            'SpotInstanceRequests': [
+                {'InstanceId': 'i-1', 'Status': {'Code': 'marked-for-termination'}},
+                {'InstanceId': 'i-2', 'Status': {'Code': 'instance-terminated-by-user'}},
+            ]
+        },
+    ]
+    watcher = iblaws.spot.InterruptionWatcher(ec2, interval=15)
+    assert watcher.poll() == {}  # nothing to watch
+    watcher.watch(['i-0', 'i-1', 'i-2'])
+    assert watcher.poll() == {'i-1': 'marked-for-termination'}
+    paginate.assert_called_once_with(Filters=[{'Name': 'instance-id', 'Values': ['i-0', 'i-1', 'i-2']}])
+    # the next poll is due after the interval, without the interrupted instance
+    assert watcher.next_poll_delay() == 15 and watcher.poll() == {}
+    monotonic.return_value = 15.0
+    watcher.poll()
+    paginate.assert_called_with(Filters=[{'Name': 'instance-id', 'Values': ['i-0', 'i-2']}])
+
+
+def test_spot_replacer_avoids_reclaimed_pools(mocker):
+    def create_instance(ami_id, instance_type, instance_region, volume_id, spot, availability_zone):
+        if availability_zone == 'us-east-1b':
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'InsufficientInstanceCapacity'}}, 'RunInstances')
+        instance = iblaws.compute.InstanceManager(f'i-{instance_type}-{availability_zone}', instance_region)
+        instance.public_ip, instance.spot = '1.1.1.1', spot
+        return instance
+
+    create = mocker.patch('iblaws.compute.InstanceManager.create_instance', side_effect=create_instance)
+    prepare = mocker.patch('iblaws.compute.InstanceManager.prepare_instance')
+    reclaimed = iblaws.compute.InstanceManager('i-0', 'us-east-1')
+    record = iblaws.inventory.InstanceRecord('i-0', 'running', 'g6.4xlarge', availability_zone='us-east-1a')
+    mocker.patch('iblaws.inventory.InstanceInventory.get', return_value=record)
+    mocker.patch('iblaws.utils.get_service_client')
+
+    replacer = iblaws.spot.SpotReplacer('ami-0', ['g6.4xlarge', 'g5.4xlarge'], ['us-east-1a', 'us-east-1b'])
+    replacement = replacer(reclaimed)
+    # the reclaimed pool is skipped and the pool without capacity is excluded for the next replacements
+    assert replacement.instance_id == 'i-g5.4xlarge-us-east-1a' and replacement.spot
+    assert [c.args[1] + c.kwargs['availability_zone'][-1] for c in create.call_args_list] == [
+        'g6.4xlarge' + 'b',
+        'g5.4xlarge' + 'a',
+    ]
+    prepare.assert_called_once_with('1.1.1.1')
+    assert replacer.excluded == {('g6.4xlarge', 'us-east-1a'), ('g6.4xlarge', 'us-east-1b')}
+    create.side_effect = botocore.exceptions.ClientError({'Error': {'Code': 'InsufficientInstanceCapacity'}}, 'RunInstances')
+    with pytest.raises(iblaws.spot.SpotCapacityError):
+        replacer.launch('us-east-1')
+
+
+def test_spot_replacer_exclusions_expire(mocker):
+    monotonic = mocker.patch('iblaws.spot.time.monotonic', return_value=0.0)
+    create = mocker.patch('iblaws.compute.InstanceManager.create_instance')
+    mocker.patch('iblaws.compute.InstanceManager.prepare_instance')
+    record = iblaws.inventory.InstanceRecord('i-0', 'running', 'g6.4xlarge', availability_zone='us-east-1a')
+    mocker.patch('iblaws.inventory.InstanceInventory.get', return_value=record)
+    mocker.patch('iblaws.utils.get_service_client')
+
+    # without zone constraint, an interruption excludes the whole instance type
+    replacer = iblaws.spot.SpotReplacer('ami-0', ['g6.4xlarge'], cooldown=600)
+    with pytest.raises(iblaws.spot.SpotCapacityError):
+        replacer(iblaws.compute.InstanceManager('i-0', 'us-east-1'))
+    assert replacer.excluded == {('g6.4xlarge', 'us-east-1a'), ('g6.4xlarge', None)}
+    create.assert_not_called()
+    # the pool is eligible again after the cooldown
+    monotonic.return_value = 601.0
+    assert replacer.excluded == set()
+    replacer.launch('us-east-1')
+    assert create.call_args.args[1] == 'g6.4xlarge' and create.call_args.kwargs['availability_zone'] is None
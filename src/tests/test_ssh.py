@@ -0,0 +1,121 @@
+import paramiko
+import pytest
+
+import iblaws.ssh
+
+
+class _Channel:
+    """A channel whose command only exits once its outputs have been read, as when the window of the channel is full."""
+
+    def __init__(self, exit_status, stdout, stderr, chunk=4):
+        self.exit_status = exit_status
+        self.buffers = {'stdout': bytearray(stdout), 'stderr': bytearray(stderr)}
+        self.chunk = chunk
+
+    def _recv(self, name, nbytes):
+        buffer = self.buffers[name]
+        data = bytes(buffer[: min(nbytes, self.chunk)])
+        del buffer[: len(data)]
+        return data
+
+    def recv_ready(self):
+        return bool(self.buffers['stdout'])
+
+    def recv_stderr_ready(self):
+        return bool(self.buffers['stderr'])
+
+    def recv(self, nbytes):
+        return self._recv('stdout', nbytes)
+
+    def recv_stderr(self, nbytes):
+        return self._recv('stderr', nbytes)
+
+    def exit_status_ready(self):
+        return not any(self.buffers.values())
+
+    def recv_exit_status(self):
+        assert self.exit_status_ready(), 'the command blocks until its outputs are read'
+        return self.exit_status
+
+
+def _mock_exec(mocker, exit_status=0, stdout=b'', stderr=b''):
+    channel_stdin, channel_stdout, channel_stderr = mocker.MagicMock(), mocker.MagicMock(), mocker.MagicMock()
+    channel_stdout.channel = channel_stderr.channel = _Channel(exit_status, stdout, stderr)
+    # reading one stream to the end before the other would never return
+    channel_stdout.read.side_effect = channel_stderr.read.side_effect = AssertionError('blocking read')
+    return channel_stdin, channel_stdout, channel_stderr
+
+
+def test_ssh_session_waits_for_instance(mocker):
+    sleep = mocker.patch('iblaws.ssh.time.sleep')
+    ssh_client = mocker.patch('paramiko.SSHClient').return_value
+    ssh_client.connect.side_effect = [
+        paramiko.ssh_exception.NoValidConnectionsError({('1.2.3.4', 22): ConnectionRefusedError()}),
+        paramiko.ssh_exception.SSHException('Error reading SSH protocol banner'),
+        None,
+    ]
+    session = iblaws.ssh.SSHSession('1.2.3.4', '/tmp/key.pem', initial_delay=1)
+    assert session.client is ssh_client
+    assert [c.args[0] for c in sleep.call_args_list] == [1, 2]
+    ssh_client.get_transport.return_value.set_keepalive.assert_called_once_with(30)
+    # the connection is reused while the transport is active
+    assert session.client is ssh_client
+    assert ssh_client.connect.call_count == 3
+
+
+def test_ssh_session_gives_up(mocker):
+    mocker.patch('iblaws.ssh.time.sleep')
+    ssh_client = mocker.patch('paramiko.SSHClient').return_value
+    ssh_client.connect.side_effect = TimeoutError('timed out')
+    session = iblaws.ssh.SSHSession('1.2.3.4', '/tmp/key.pem', max_wait=0)
+    with pytest.raises(TimeoutError, match='SSH not available'):
+        session.run('true')
+
+
+def test_ssh_session_run_drains_both_streams(mocker):
+    ssh_client = mocker.patch('paramiko.SSHClient').return_value
+    stderr = b'warning: ' * 10_000
+    ssh_client.exec_command.return_value = _mock_exec(mocker, exit_status=1, stdout=b'done\n', stderr=stderr)
+    session = iblaws.ssh.SSHSession('1.2.3.4', '/tmp/key.pem')
+    result = session.run('sort', check=False)
+    assert (result.exit_status, result.stdout, result.stderr) == (1, 'done\n', stderr.decode())
+
+
+def test_prepare_volume(mocker):
+    ssh_client = mocker.patch('paramiko.SSHClient').return_value
+    stdout = b'device=/dev/nvme1n1\nformatted=1\nmounted=1\nsize_bytes=1000\navailable_bytes=900\n'
+    ssh_client.exec_command.return_value = _mock_exec(mocker, stdout=stdout)
+    session = iblaws.ssh.SSHSession('1.2.3.4', '/tmp/key.pem')
+    result = session.prepare_volume(volume_id='vol-0a30864212c68a728')
+    assert result == {'device': '/dev/nvme1n1', 'formatted': 1, 'mounted': 1, 'size_bytes': 1000, 'available_bytes': 900}
+    # the whole preparation is a single round-trip
+    ssh_client.exec_command.assert_called_once_with('bash -s', timeout=None)
+    script = ssh_client.exec_command.return_value[0].write.call_args.args[0]
+    assert 'serial=vol0a30864212c68a728' in script
+    assert '[ 0 -eq 1 ]' in script  # EBS volumes are not formatted by default
+
+    ssh_client.exec_command.return_value = _mock_exec(mocker, exit_status=3, stderr=b'no block device with serial AWS')
+    with pytest.raises(iblaws.ssh.RemoteCommandError, match='no block device'):
+        session.prepare_volume()
+
+
+def test_prepare_scratch(mocker):
+    ssh_client = mocker.patch('paramiko.SSHClient').return_value
+    mounted = b'devices=2\ndevice=/dev/md127\nformatted=1\nmounted=1\nsize_bytes=2000\navailable_bytes=1900\n'
+    probe = b'write_bytes_per_second=1500000000\nread_bytes_per_second=3000000000\n'
+    ssh_client.exec_command.side_effect = [_mock_exec(mocker, stdout=mounted), _mock_exec(mocker, stdout=probe)]
+    session = iblaws.ssh.SSHSession('1.2.3.4', '/tmp/key.pem')
+    result = session.prepare_scratch(fallback_volume_id='vol-0a30864212c68a728')
+    assert result['mode'] == 'instance-store'
+    assert (result['devices'], result['device'], result['read_bytes_per_second']) == (2, '/dev/md127', 3000000000)
+    # the preparation and the probe are two round-trips
+    assert ssh_client.exec_command.call_count == 2
+    # no instance store disk: the EBS volume is mounted instead, without throughput probe
+    volume = b'device=/dev/nvme1n1\nformatted=0\nmounted=1\nsize_bytes=1000\navailable_bytes=900\n'
+    ssh_client.exec_command.side_effect = [_mock_exec(mocker, stdout=b'devices=0\n'), _mock_exec(mocker, stdout=volume)]
+    result = session.prepare_scratch(fallback_volume_id='vol-0a30864212c68a728', probe_mib=0)
+    assert (result['mode'], result['devices'], result['device']) == ('volume', 0, '/dev/nvme1n1')
+    assert 'read_bytes_per_second' not in result
+    ssh_client.exec_command.side_effect = [_mock_exec(mocker, stdout=b'devices=0\n')]
+    with pytest.raises(RuntimeError, match='no instance store disk'):
+        session.prepare_scratch()
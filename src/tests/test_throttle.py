@@ -0,0 +1,84 @@
+import botocore.awsrequest
+import pytest
+
+import iblaws.metrics
+import iblaws.throttle
+import iblaws.utils
+
+THROTTLED = b'<Response><Errors><Error><Code>RequestLimitExceeded</Code><Message>Slow down</Message></Error></Errors></Response>'
+DESCRIBED = (
+    b'<DescribeInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/"><reservationSet/></DescribeInstancesResponse>'
+)
+
+
+class _Raw:
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+@pytest.fixture
+def aws_env(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_SECRET_KEY', 'testing')
+    monkeypatch.setenv('AWS_REGION', 'eu-west-2')
+    iblaws.utils.clear_client_cache()
+    iblaws.throttle.reset()
+    iblaws.metrics.reset()
+    iblaws.metrics.enable()
+    yield
+    iblaws.metrics.disable()
+    iblaws.metrics.reset()
+    iblaws.throttle.reset()
+    iblaws.utils.clear_client_cache()
+
+
+def test_rate_limiter(mocker):
+    monotonic = mocker.patch('iblaws.throttle.time.monotonic', return_value=0.0)
+    sleep = mocker.patch('iblaws.throttle.time.sleep')
+    limiter = iblaws.throttle.RateLimiter(rate=2, burst=2, max_rate=3)
+    # the burst, then the reserved tokens are served in order
+    assert [limiter.acquire() for _ in range(4)] == [0, 0, 0.5, 1.0]
+    assert [c.args[0] for c in sleep.call_args_list] == [0.5, 1.0]
+    monotonic.return_value = 2.0
+    assert limiter.acquire() == 0
+    # one decrease per cooldown, the concurrent throttling errors come from the same burst
+    limiter.on_throttle()
+    limiter.on_throttle()
+    assert limiter.rate == 1
+    assert limiter.acquire() == 1.0
+    monotonic.return_value = 3.5
+    limiter.on_throttle()
+    assert limiter.rate == 0.5
+    for _ in range(10):
+        limiter.on_success()
+    assert limiter.rate == 3
+
+
+def test_clients_share_an_adaptive_rate_limiter(aws_env, mocker):
+    mocker.patch('botocore.retries.standard.ExponentialBackoff.delay_amount', return_value=0)
+    ec2 = iblaws.utils.get_service_client(service_name='ec2')
+    limiter = iblaws.throttle.get_rate_limiter('ec2', 'eu-west-2')
+    # another client of the same service and region shares the limiter
+    iblaws.utils.get_service_client(service_name='ec2', max_pool_connections=2)
+    assert iblaws.throttle.get_rate_limiter('ec2', 'eu-west-2') is limiter
+    assert iblaws.throttle.get_rate_limiter('ec2', 'us-east-1') is not limiter
+    assert ec2.meta.config.retries == {'mode': 'standard', 'total_max_attempts': iblaws.throttle.MAX_ATTEMPTS}
+
+    # the first two attempts are throttled, the third one succeeds
+    bodies = iter([(503, THROTTLED), (503, THROTTLED), (200, DESCRIBED)])
+
+    def respond(request, **kwargs):
+        status, body = next(bodies)
+        return botocore.awsrequest.AWSResponse(request.url, status, {}, _Raw(body))
+
+    ec2.meta.events.register_last('before-send.ec2.DescribeInstances', respond)
+    acquire = mocker.spy(limiter, 'acquire')
+    rate = limiter.rate
+    assert ec2.describe_instances()['Reservations'] == []
+    assert acquire.call_count == 3
+    assert rate * limiter.decrease < limiter.rate < rate
+    [stats] = iblaws.metrics.snapshot()['calls']
+    assert (stats['calls'], stats['retries'], stats['throttles'], stats['throttled_attempts']) == (1, 2, 0, 2)
@@ -0,0 +1,220 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import iblaws.utils
+
+
+@pytest.fixture
+def aws_env(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_SECRET_KEY', 'testing')
+    monkeypatch.setenv('AWS_REGION', 'eu-west-2')
+    iblaws.utils.clear_client_cache()
+    yield
+    iblaws.utils.clear_client_cache()
+
+
+def test_get_service_client_is_shared(aws_env):
+    ec2 = iblaws.utils.get_service_client(service_name='ec2')
+    assert iblaws.utils.get_service_client(service_name='ec2', region_name='eu-west-2') is ec2
+    assert iblaws.utils.get_service_client(service_name='ec2', region_name='us-east-1') is not ec2
+    assert iblaws.utils.get_service_client(service_name='ssm') is not ec2
+    assert ec2.meta.region_name == 'eu-west-2'
+    assert ec2.meta.config.max_pool_connections == iblaws.utils.MAX_POOL_CONNECTIONS
+    ec2_small_pool = iblaws.utils.get_service_client(service_name='ec2', max_pool_connections=2)
+    assert ec2_small_pool is not ec2
+    assert ec2_small_pool.meta.config.max_pool_connections == 2
+
+
+def test_get_service_client_thread_safe(aws_env, mocker):
+    load_dotenv = mocker.patch('dotenv.load_dotenv')
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        clients = list(
+            executor.map(lambda _: iblaws.utils.get_service_client(service_name='ssm', region_name='us-east-1'), range(64))
+        )
+    assert len(set(map(id, clients))) == 1
+    load_dotenv.assert_called_once()
+
+
+def test_clear_client_cache_reloads_credentials(aws_env, monkeypatch):
+    ec2 = iblaws.utils.get_service_client(service_name='ec2')
+    monkeypatch.setenv('AWS_ACCESS_KEY', 'rotated')
+    assert iblaws.utils.get_service_client(service_name='ec2') is ec2
+    iblaws.utils.clear_client_cache()
+    assert iblaws.utils.get_credentials()['aws_access_key_id'] == 'rotated'
+    assert iblaws.utils.get_service_client(service_name='ec2') is not ec2
+
+
+def _paginator(mocker, pages):
+    paginator = mocker.Mock()
+    paginator.paginate.return_value = pages
+    return paginator
+
+
+def test_ssm_list_running_commands(mocker):
+    invocations = [
+        {'CommandId': f'cmd{i}', 'InstanceId': f'i-{i % 3}', 'Status': 'InProgress', 'Comment': f'pid{i}'} for i in range(6)
+    ]
+    ssm = mocker.Mock()
+    ssm.get_paginator.return_value = _paginator(
+        mocker, [{'CommandInvocations': invocations[:3]}, {'CommandInvocations': invocations[3:]}]
+    )
+    ec2 = mocker.Mock()
+    ec2.get_paginator.return_value = _paginator(
+        mocker, [{'Reservations': [{'Instances': [{'InstanceId': 'i-1'}]}, {'Instances': [{'InstanceId': 'i-2'}]}]}]
+    )
+    # fleet wide
+    running = iblaws.utils.ssm_list_running_commands(ssm_client=ssm)
+    assert [r['CommandId'] for r in running] == [f'cmd{i}' for i in range(6)]
+    assert running[0]['Comment'] == 'pid0' and running[0]['StatusDetails'] is None
+    ssm.get_paginator.assert_called_with('list_command_invocations')
+    ssm.get_paginator.return_value.paginate.assert_called_with(Filters=[{'key': 'Status', 'value': 'InProgress'}])
+    # a single instance is filtered server-side
+    iblaws.utils.ssm_list_running_commands('i-0', ssm_client=ssm)
+    assert ssm.get_paginator.return_value.paginate.call_args.kwargs['InstanceId'] == 'i-0'
+    # tags resolve to instance ids
+    running = iblaws.utils.ssm_list_running_commands(tags={'Flottille': 'iblsorter'}, ssm_client=ssm, ec2_client=ec2)
+    assert [r['InstanceId'] for r in running] == ['i-1', 'i-2', 'i-1', 'i-2']
+    ec2.get_paginator.return_value.paginate.assert_called_once_with(Filters=[{'Name': 'tag:Flottille', 'Values': ['iblsorter']}])
+    assert iblaws.utils.ssm_list_running_commands(['i-0'], tags={'Flottille': 'iblsorter'}, ssm_client=ssm, ec2_client=ec2) == []
+
+
+def test_ec2_start_instances_bulk(mocker):
+    ec2 = mocker.Mock()
+    ec2.get_paginator.side_effect = lambda name: _paginator(
+        mocker,
+        [
+            {
+                'Reservations': [
+                    {
+                        'Instances': [
+                            {'InstanceId': 'i-1', 'State': {'Name': 'running'}, 'PublicIpAddress': '1.1.1.1'},
+                            {'InstanceId': 'i-2', 'State': {'Name': 'running'}},
+                        ]
+                    }
+                ]
+            }
+        ],
+    )
+    public_ips = iblaws.utils.ec2_start_instances(ec2, tags={'Flottille': 'iblsorter'})
+    assert public_ips == {'i-1': '1.1.1.1', 'i-2': None}
+    ec2.start_instances.assert_called_once_with(InstanceIds=['i-1', 'i-2'])
+    ec2.get_waiter.assert_called_once_with('instance_running')
+    ec2.get_waiter.return_value.wait.assert_called_once_with(InstanceIds=['i-1', 'i-2'])
+    assert iblaws.utils.ec2_stop_instances(ec2, instance_ids=[]) == []
+    ec2.stop_instances.assert_not_called()
+    with pytest.raises(ValueError):
+        iblaws.utils.ec2_stop_instances(ec2)
+
+
+def test_ec2_update_security_group_rules(mocker):
+    ec2 = mocker.Mock()
+    ec2.describe_security_groups.return_value = {
+        'SecurityGroups': [
+            {
+                'IpPermissions': [
+                    {
+                        'IpProtocol': 'tcp',
+                        'FromPort': 443,
+                        'ToPort': 443,
+                        'IpRanges': [
+                            {'CidrIp': '1.1.1.1/32', 'Description': 'i-1'},
+                            {'CidrIp': '9.9.9.9/32', 'Description': 'researcher'},
+                        ],
+                        'PrefixListIds': [{'PrefixListId': 'pl-1'}],
+                    }
+                ]
+            }
+        ]
+    }
+    iblaws.utils.ec2_update_security_group_rules(ec2, 'sg-1', {'i-1': '2.2.2.2/32', 'i-2': '3.3.3.3/32'})
+    ec2.describe_security_groups.assert_called_once()
+    ec2.revoke_security_group_ingress.assert_called_once_with(
+        GroupId='sg-1',
+        IpPermissions=[
+            {'IpProtocol': 'tcp', 'FromPort': 443, 'ToPort': 443, 'IpRanges': [{'CidrIp': '1.1.1.1/32', 'Description': 'i-1'}]}
+        ],
+    )
+    ec2.authorize_security_group_ingress.assert_called_once_with(
+        GroupId='sg-1',
+        IpPermissions=[
+            {'IpProtocol': 'tcp', 'FromPort': 443, 'ToPort': 443, 'IpRanges': [{'CidrIp': '2.2.2.2/32', 'Description': 'i-1'}]},
+            {'IpProtocol': 'all', 'IpRanges': [{'CidrIp': '3.3.3.3/32', 'Description': 'i-2'}]},
+        ],
+    )
+
+
+def test_ec2_reconcile_security_group_rules(mocker):
+    ec2 = mocker.Mock()
+    ec2.describe_security_groups.return_value = {
+        'SecurityGroups': [
+            {
+                'IpPermissions': [
+                    {
+                        'IpProtocol': '-1',
+                        'IpRanges': [
+                            {'CidrIp': '1.1.1.1/32', 'Description': 'i-1'},
+                            {'CidrIp': '2.2.2.2/32', 'Description': 'i-2'},
+                            {'CidrIp': '2.2.2.3/32', 'Description': 'i-2'},
+                            {'CidrIp': '4.4.4.4/32', 'Description': 'i-old'},
+                        ],
+                    }
+                ]
+            }
+        ]
+    }
+    # nothing to do: a single describe call
+    diff = iblaws.utils.ec2_reconcile_security_group_rules(ec2, 'sg-1', {'i-1': '1.1.1.1/32'})
+    assert diff == {'revoke': [], 'authorize': [], 'unchanged': ['i-1']}
+    assert iblaws.utils.ec2_update_security_group_rule(ec2, 'sg-1', 'i-1', '1.1.1.1/32') == diff
+    ec2.revoke_security_group_ingress.assert_not_called()
+    ec2.authorize_security_group_ingress.assert_not_called()
+    # dry run: the duplicate of i-2 and the stale owner of the address of i-3 are revoked
+    desired = {'i-1': '1.1.1.1/32', 'i-2': '2.2.2.2/32', 'i-3': '4.4.4.4/32'}
+    diff = iblaws.utils.ec2_reconcile_security_group_rules(ec2, 'sg-1', desired, dry_run=True)
+    assert diff == {
+        'revoke': [
+            {'IpProtocol': '-1', 'IpRanges': [{'CidrIp': '2.2.2.3/32', 'Description': 'i-2'}]},
+            {'IpProtocol': '-1', 'IpRanges': [{'CidrIp': '4.4.4.4/32', 'Description': 'i-old'}]},
+        ],
+        'authorize': [{'IpProtocol': 'all', 'IpRanges': [{'CidrIp': '4.4.4.4/32', 'Description': 'i-3'}]}],
+        'unchanged': ['i-1', 'i-2'],
+    }
+    ec2.revoke_security_group_ingress.assert_not_called()
+    iblaws.utils.ec2_reconcile_security_group_rules(ec2, 'sg-1', desired)
+    ec2.revoke_security_group_ingress.assert_called_once_with(GroupId='sg-1', IpPermissions=diff['revoke'])
+    ec2.authorize_security_group_ingress.assert_called_once_with(GroupId='sg-1', IpPermissions=diff['authorize'])
+
+
+def test_ec2_reconcile_security_group_rules_shared_cidr(mocker):
+    ec2 = mocker.Mock()
+    ec2.describe_security_groups.return_value = {
+        'SecurityGroups': [
+            {'IpPermissions': [{'IpProtocol': '-1', 'IpRanges': [{'CidrIp': '1.1.1.1/32', 'Description': 'i-1'}]}]}
+        ]
+    }
+    # the rule kept for i-1 is not revoked for i-2, and i-3 and i-4 do not authorize the same rule twice
+    desired = {'i-1': '1.1.1.1/32', 'i-2': '1.1.1.1/32', 'i-3': '5.5.5.5/32', 'i-4': '5.5.5.5/32'}
+    diff = iblaws.utils.ec2_reconcile_security_group_rules(ec2, 'sg-1', desired)
+    assert diff == {
+        'revoke': [],
+        'authorize': [{'IpProtocol': 'all', 'IpRanges': [{'CidrIp': '5.5.5.5/32', 'Description': 'i-3'}]}],
+        'unchanged': ['i-1'],
+    }
+    ec2.revoke_security_group_ingress.assert_not_called()
+
+
+def test_managed_prefix_list_items_ignore_the_lease_expiry(mocker):
+    ec2 = mocker.Mock()
+    ec2.describe_managed_prefix_lists.side_effect = [{'PrefixLists': [{'Version': v}]} for v in (1, 2, 2, 3)]
+    ec2.get_managed_prefix_list_entries.return_value = {
+        'Entries': [{'Cidr': '1.1.1.1/32', 'Description': 'Worker #07 [exp=1760000000]'}]
+    }
+    with pytest.raises(ValueError, match='already exists'):
+        iblaws.utils.ec2_add_managed_prefix_list_item(ec2, 'pl-1', 'Worker #07', '2.2.2.2/32')
+    ec2.modify_managed_prefix_list.assert_not_called()
+    iblaws.utils.ec2_remove_managed_prefix_list_item(ec2, 'pl-1', 'Worker #07')
+    ec2.modify_managed_prefix_list.assert_called_once_with(
+        DryRun=False, PrefixListId='pl-1', CurrentVersion=2, RemoveEntries=[{'Cidr': '1.1.1.1/32'}]
+    )
@@ -0,0 +1,169 @@
+import datetime
+
+import botocore.exceptions
+import pytest
+
+import iblaws.compute
+import iblaws.inventory
+import iblaws.warm_pool
+from iblaws.warm_pool import CLAIM_TAG, HIBERNATED, IN_USE, POOL_TAG, STOPPED
+
+
+def _record(instance_id, pool_state, instance_type='g6.4xlarge', day=1):
+    return iblaws.inventory.InstanceRecord(
+        instance_id,
+        'stopped',
+        instance_type,
+        launch_time=datetime.datetime(2025, 1, day),
+        tags={'Flottille': 'iblsorter', POOL_TAG: pool_state},
+    )
+
+
+@pytest.fixture
+def aws(mocker):
+    """
+    Mock EC2 and SSM clients, the SSM agents of all instances being online, and an empty inventory.
+
+    The claims are read back from the claim tags written, except for the instances in `stolen` claimed by another
+    process in between.
+    """
+    clients = {'ec2': mocker.Mock(), 'ssm': mocker.Mock(), 'stolen': set()}
+    mocker.patch('iblaws.warm_pool.time.sleep')
+    claims = {}
+
+    def create_tags(Resources, Tags):
+        if Tags[0]['Key'] == CLAIM_TAG:
+            claims.update({i: 'another-process' if i in clients['stolen'] else Tags[0]['Value'] for i in Resources})
+
+    def get_many(instance_ids, max_age=None):
+        return {
+            i: iblaws.inventory.InstanceRecord(i, 'stopped', 'g6.4xlarge', tags={POOL_TAG: STOPPED, CLAIM_TAG: claims.get(i)})
+            for i in instance_ids
+        }
+
+    clients['ec2'].create_tags.side_effect = create_tags
+    mocker.patch('iblaws.utils.get_service_client', side_effect=lambda service_name, region_name: clients[service_name])
+    online = [{'InstanceId': f'i-{i}', 'PingStatus': 'Online'} for i in range(10)]
+    clients['ssm'].get_paginator.return_value.paginate.return_value = [{'InstanceInformationList': online}]
+    clients['inventory'] = mocker.patch('iblaws.inventory.get_inventory').return_value
+    clients['inventory'].select.return_value = []
+    clients['inventory'].get_many.side_effect = get_many
+    mocker.patch('iblaws.compute.register_alyx_access')
+    return clients
+
+
+def _tags(ec2, key=POOL_TAG):
+    return [
+        (c.kwargs['Resources'], c.kwargs['Tags'][0]['Value'])
+        for c in ec2.create_tags.call_args_list
+        if c.kwargs['Tags'][0]['Key'] == key
+    ]
+
+
+def test_warm_pool_acquire(mocker, aws):
+    parked = [_record('i-1', STOPPED), _record('i-2', HIBERNATED, day=2), _record('i-3', HIBERNATED, 'g6.xlarge')]
+    aws['inventory'].select.side_effect = lambda tags, states, max_age: parked if STOPPED in tags[POOL_TAG] else []
+    start = mocker.patch('iblaws.utils.ec2_start_instances', return_value={'i-2': '2.2.2.2', 'i-1': '1.1.1.1'})
+    prepare = mocker.patch('iblaws.compute.InstanceManager.prepare_instance')
+    cold = iblaws.compute.InstanceManager('i-4', 'us-east-1')
+    cold.public_ip = '4.4.4.4'
+    create = mocker.patch('iblaws.compute.InstanceManager.create_instance', return_value=cold)
+
+    pool = iblaws.warm_pool.WarmPool('us-east-1', 'ami-0', 'g6.4xlarge')
+    instances = pool.acquire(3, refill=False)
+    assert [(im.instance_id, im.public_ip) for im in instances] == [('i-2', '2.2.2.2'), ('i-1', '1.1.1.1'), ('i-4', '4.4.4.4')]
+    # the hibernated instance of the right type first, claimed before being started in one call
+    assert _tags(aws['ec2']) == [(['i-2', 'i-1'], IN_USE)]
+    start.assert_called_once_with(aws['ec2'], instance_ids=['i-2', 'i-1'])
+    # the hibernated instance kept its mounts, the stopped one and the cold one are prepared
+    assert sorted(c.args[0] for c in prepare.call_args_list) == ['1.1.1.1', '4.4.4.4']
+    create.assert_called_once_with('ami-0', 'g6.4xlarge', 'us-east-1', volume_id='AWS', tags={POOL_TAG: IN_USE}, hibernation=True)
+
+
+def test_warm_pool_refill_and_release(mocker, aws):
+    def stop(ec2, instance_ids, hibernate=False):
+        if hibernate and 'i-1' in instance_ids:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'UnsupportedHibernationConfiguration'}}, 'StopInstances')
+
+    stop = mocker.patch('iblaws.utils.ec2_stop_instances', side_effect=stop)
+    prepare = mocker.patch('iblaws.compute.InstanceManager.prepare_instance')
+    created = [iblaws.compute.InstanceManager(f'i-{i}', 'us-east-1') for i in range(2)]
+    mocker.patch('iblaws.compute.InstanceManager.create_instance', side_effect=created)
+
+    pool = iblaws.warm_pool.WarmPool('us-east-1', 'ami-0', 'g6.4xlarge', size=2, max_workers=1)
+    pool.refill(wait=True)
+    assert prepare.call_count == 2
+    # the instances are parked hibernated, or stopped when the hibernation fails
+    assert sorted(_tags(aws['ec2'])) == [(['i-0'], HIBERNATED), (['i-1'], STOPPED)]
+    assert stop.call_count == 3
+
+    # the pool is full: nothing to refill
+    parked = [_record('i-5', HIBERNATED), _record('i-6', HIBERNATED)]
+    aws['inventory'].select.side_effect = lambda tags, states, max_age: parked if STOPPED in tags[POOL_TAG] else []
+    assert pool.refill() is None
+    # the released instances beyond the size of the pool are terminated
+    parked.pop()
+    assert pool.release(created) == {'i-0': HIBERNATED, 'i-1': 'terminated'}
+    aws['ec2'].terminate_instances.assert_called_once_with(InstanceIds=['i-1'])
+
+
+def test_warm_pool_acquire_gives_back_failed_instances(mocker, aws):
+    parked = [_record('i-1', STOPPED), _record('i-2', STOPPED, day=2)]
+    aws['inventory'].select.side_effect = lambda tags, states, max_age: parked if STOPPED in tags[POOL_TAG] else []
+    mocker.patch('iblaws.utils.ec2_start_instances', return_value={'i-1': '1.1.1.1', 'i-2': '2.2.2.2'})
+    stop = mocker.patch('iblaws.utils.ec2_stop_instances')
+
+    def prepare(self, public_ip):
+        if self.instance_id == 'i-2':
+            raise RuntimeError('mount failed')
+
+    mocker.patch('iblaws.compute.InstanceManager.prepare_instance', prepare)
+    create = mocker.patch('iblaws.compute.InstanceManager.create_instance')
+
+    pool = iblaws.warm_pool.WarmPool('us-east-1', 'ami-0', 'g6.4xlarge', hibernate=False)
+    with pytest.raises(RuntimeError, match='mount failed'):
+        pool.acquire(2, refill=False)
+    # the instance that could not be resumed is terminated, the other one is parked back instead of staying in use
+    aws['ec2'].terminate_instances.assert_called_once_with(InstanceIds=['i-2'])
+    stop.assert_called_once_with(aws['ec2'], instance_ids=['i-1'])
+    assert _tags(aws['ec2']) == [(['i-1', 'i-2'], IN_USE), (['i-1'], STOPPED)]
+    create.assert_not_called()
+
+    # a failure of the SSM agents parks all the instances back
+    mocker.patch('iblaws.compute.InstanceManager.prepare_instance')
+    mocker.patch.object(pool, '_wait_for_ssm', side_effect=iblaws.warm_pool.WarmPoolError('not online'))
+    with pytest.raises(iblaws.warm_pool.WarmPoolError):
+        pool.acquire(2, refill=False)
+    assert _tags(aws['ec2'])[-1] == (['i-1', 'i-2'], STOPPED)
+
+
+def test_warm_pool_acquire_contended(mocker, aws):
+    parked = [_record('i-1', HIBERNATED), _record('i-2', HIBERNATED, day=2), _record('i-3', STOPPED)]
+    aws['inventory'].select.side_effect = lambda tags, states, max_age: parked if STOPPED in tags[POOL_TAG] else []
+    # another process claims i-1 at the same time
+    aws['stolen'].add('i-1')
+    start = mocker.patch('iblaws.utils.ec2_start_instances', return_value={'i-2': '2.2.2.2', 'i-3': '3.3.3.3'})
+    mocker.patch('iblaws.compute.InstanceManager.prepare_instance')
+    create = mocker.patch('iblaws.compute.InstanceManager.create_instance')
+
+    pool = iblaws.warm_pool.WarmPool('us-east-1', 'ami-0', 'g6.4xlarge')
+    instances = pool.acquire(2, refill=False)
+    assert [im.instance_id for im in instances] == ['i-2', 'i-3']
+    # i-1 is lost to the other process, the next parked instance is claimed in its place
+    assert [ids for ids, _ in _tags(aws['ec2'], CLAIM_TAG)] == [['i-1', 'i-2'], ['i-3']]
+    assert _tags(aws['ec2']) == [(['i-2'], IN_USE), (['i-3'], IN_USE)]
+    start.assert_called_once_with(aws['ec2'], instance_ids=['i-2', 'i-3'])
+    create.assert_not_called()
+
+
+def test_warm_pool_park_falls_back_to_stop(mocker, aws):
+    def stop(ec2, instance_ids, hibernate=False):
+        if hibernate:
+            raise botocore.exceptions.WaiterError('InstanceStopped', 'Max attempts exceeded', {})
+
+    stop = mocker.patch('iblaws.utils.ec2_stop_instances', side_effect=stop)
+    pool = iblaws.warm_pool.WarmPool('us-east-1', 'ami-0', 'g6.4xlarge')
+    # a hibernation that does not complete stops the instance instead of failing the provisioning
+    assert pool._park(['i-7']) == STOPPED
+    assert [c.kwargs.get('hibernate', False) for c in stop.call_args_list] == [True, False]
+    assert _tags(aws['ec2']) == [(['i-7'], STOPPED)]